@@ -0,0 +1,482 @@
+import json
+import mmap
+import os
+import shutil
+import struct
+import sys
+import tempfile
+from array import array
+from bisect import bisect_left
+from functools import lru_cache
+from itertools import accumulate
+
+# Binary on-disk index
+#
+# The file starts with a header (magic, format version, number of sections) and a
+# table of (name, offset, length) entries, followed by the sections themselves.
+# Every section starts on an 8-byte boundary and all integers are little-endian.
+#
+#   meta              JSON object: index_version, num_docs, num_terms, avg_doc_length and extra metadata
+#   terms             sorted term dictionary, UTF-8 strings stored back to back
+#   terms.offsets     u64 start of each term in `terms` (num_terms + 1 entries)
+#   df                u32 document frequency of each term
+#   postings          per term, (docid gap, tf) pairs encoded as varints
+#   postings.offsets  u64 start of each term's postings (num_terms + 1 entries)
+#   doc_ids           external document IDs by ordinal, stored like `terms`
+#   doc_ids.offsets   u64 start of each document ID
+#   doc_lengths       u32 length of each document by ordinal
+#
+# Each term's postings are also split into blocks of BLOCK_SIZE postings, so that
+# top-k retrieval can skip whole blocks without decoding them. Blocks only record
+# where they end; the gap coding runs on from one block to the next.
+#
+#   blocks.offsets    u64 first block of each term (num_terms + 1 entries)
+#   block_last_doc    u32 ordinal of the last posting in each block
+#   block_ends        u64 end of each block in `postings`
+#   block_max_tf      u32 largest tf in each block
+#   block_min_length  u32 shortest document in each block
+#   block_max_ratio   f64 largest tf / document length in each block
+#
+# These bound the score of any document in a block under models like BM25 or
+# language models, whatever their parameters.
+#
+# Optional sections, present if the index was written with them:
+#
+#   vectors           per document, (term id gap, tf) pairs encoded as varints
+#   vectors.offsets   u64 start of each document's vector
+#   positions         per term, the positions of the term in each of its postings
+#   positions.index   u64 start of each term's positions
+#   field_tfs         per term, the tf of the term in each field of each posting
+#   field_tfs.index   u64 start of each term's field tfs
+#   field_lengths     u32 length of each field of each document, by ordinal then
+#                     field; the field names are in meta["fields"]
+
+MAGIC = b"SEIDX"
+FORMAT_VERSION = 1
+INDEX_VERSION = 2  # Layout of the sections written by write_index, recorded in `meta`
+BLOCK_SIZE = 128
+_HEADER = struct.Struct("<5sBI")
+_SECTION = struct.Struct("<16sQQ")
+_ALIGNMENT = 8
+SPOOL_SIZE = 64 << 20  # Bytes of postings write_index keeps in memory before spilling them to a temporary file
+
+
+# Varint coding: 7 bits per byte, high bit set on every byte but the last
+def encode_varint(value, out):
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+def decode_varints(data):
+    values = []
+    value = shift = 0
+    for byte in data:
+        value |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            values.append(value)
+            value = shift = 0
+    return values
+
+# Postings are (doc ordinal, tf) pairs sorted by ordinal; ordinals are stored as
+# gaps from `previous`, the ordinal before the first posting
+def encode_postings(postings, previous=0):
+    out = bytearray()
+    for doc, tf in postings:
+        encode_varint(doc - previous, out)
+        encode_varint(tf, out)
+        previous = doc
+    return bytes(out)
+
+def decode_postings(data, previous=0):
+    values = decode_varints(data)
+    if values:
+        values[0] += previous
+    return list(zip(accumulate(values[0::2]), values[1::2]))
+
+# Positions of a term in each of its postings, as gaps from the previous position in
+# the same document; a posting's tf is the number of its positions
+def encode_positions(position_lists, out):
+    for positions in position_lists:
+        previous = 0
+        for position in positions:
+            encode_varint(position - previous, out)
+            previous = position
+
+def decode_positions(data, tfs):
+    values = decode_varints(data)
+    position_lists = []
+    start = 0
+    for tf in tfs:
+        position_lists.append(tuple(accumulate(values[start:start + tf])))
+        start += tf
+    return position_lists
+
+# Term frequency of a term in each field of each of its postings; a posting's tf is
+# the sum of its field tfs
+def encode_field_tfs(field_tf_lists, out):
+    for field_tfs in field_tf_lists:
+        for tf in field_tfs:
+            encode_varint(tf, out)
+
+def decode_field_tfs(data, num_fields):
+    values = decode_varints(data)
+    return [tuple(values[start:start + num_fields]) for start in range(0, len(values), num_fields)]
+
+
+# Typed view of a section; zero-copy on little-endian machines
+def _array(typecode, data):
+    if sys.byteorder == "little":
+        return data.cast(typecode)
+    values = array(typecode)
+    values.frombytes(data)
+    values.byteswap()
+    return values
+
+def _array_bytes(typecode, values):
+    values = array(typecode, values)
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values.tobytes()
+
+def pack_strings(strings):
+    blob = bytearray()
+    offsets = array("Q", [0])
+    for string in strings:
+        blob += string.encode("utf-8")
+        offsets.append(len(blob))
+    return bytes(blob), _array_bytes("Q", offsets)
+
+# Read-only sequence of strings stored by pack_strings; entries are decoded on access
+class StringTable:
+    def __init__(self, blob, offsets):
+        self._blob = blob
+        self._offsets = _array("Q", offsets)
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        return bytes(self._blob[self._offsets[i]:self._offsets[i + 1]]).decode("utf-8")
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    # Position of a string in a sorted table, or None
+    def find(self, string):
+        i = bisect_left(self, string)
+        return i if i < len(self) and self[i] == string else None
+
+# Sections are bytes, or binary files that are copied in chunks
+def write_sections(path, sections):
+    position = _HEADER.size + _SECTION.size * len(sections)
+    table = []
+    for name, data in sections:
+        if len(name) > 16:
+            raise ValueError(f"section name {name!r} is longer than 16 bytes")
+        position += -position % _ALIGNMENT
+        length = data.seek(0, os.SEEK_END) if hasattr(data, "read") else len(data)
+        table.append((name, position, length))
+        position += length
+
+    # Writing to a temporary file first so readers never see a half-written index
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as f:
+        f.write(_HEADER.pack(MAGIC, FORMAT_VERSION, len(sections)))
+        for name, offset, length in table:
+            f.write(_SECTION.pack(name.encode("ascii"), offset, length))
+        for (name, offset, length), (_, data) in zip(table, sections):
+            f.write(b"\0" * (offset - f.tell()))
+            if hasattr(data, "read"):
+                data.seek(0)
+                shutil.copyfileobj(data, f)
+            else:
+                f.write(data)
+    os.replace(temp_path, path)
+
+# Memory-mapping a file written by write_sections; sections are zero-copy views of the mapping
+def open_sections(path):
+    with open(path, "rb") as f:
+        data = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+    magic, version, count = _HEADER.unpack_from(data, 0)
+    if magic != MAGIC:
+        raise ValueError(f"{path} is not a binary index file")
+    if version != FORMAT_VERSION:
+        raise ValueError(f"{path} has index format version {version}, expected {FORMAT_VERSION}")
+    sections = {}
+    for i in range(count):
+        name, offset, length = _SECTION.unpack_from(data, _HEADER.size + i * _SECTION.size)
+        sections[name.rstrip(b"\0").decode("ascii")] = data[offset:offset + length]
+    return sections
+
+
+# Writing an index from a {term: [(doc ordinal, tf), ...]} mapping, or from
+# (term, postings) pairs in term order. Postings are encoded one term at a time and
+# spilled to a temporary file past SPOOL_SIZE, so pairs streamed from disk (see
+# index_builder.py) are never all in memory. `doc_vectors`, if given, are the
+# [(term, tf), ...] of every document in ordinal order, stored as forward vectors.
+# A positional index takes postings as (doc ordinal, tf, positions) instead. With
+# `fields` (their names), the postings end with the tf of the term in each field,
+# and `field_lengths` holds the length of each field of each document, flattened by
+# ordinal then field.
+def write_index(path, doc_ids, doc_lengths, postings, metadata=None, doc_vectors=None, positional=False,
+                fields=None, field_lengths=None):
+    if hasattr(postings, "items"):
+        postings = ((term, postings[term]) for term in sorted(postings))
+    terms = []
+    df = array("I")
+    postings_offsets = array("Q", [0])
+    postings_blob = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+    position = 0
+    blocks_offsets = array("Q", [0])
+    block_last_doc, block_ends, block_max_tf, block_min_length = array("I"), array("Q"), array("I"), array("I")
+    block_max_ratio = array("d")
+    positions_blob = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+    positions_offsets = array("Q", [0])
+    field_tfs_blob = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+    field_tfs_offsets = array("Q", [0])
+    for term, term_postings in postings:
+        if terms and term <= terms[-1]:
+            raise ValueError(f"postings of {term!r} are out of term order")
+        terms.append(term)
+        term_postings = sorted(term_postings)
+        if positional:
+            term_positions = bytearray()
+            encode_positions((posting[2] for posting in term_postings), term_positions)
+            positions_offsets.append(positions_offsets[-1] + positions_blob.write(term_positions))
+        if fields:
+            term_field_tfs = bytearray()
+            encode_field_tfs((posting[-1] for posting in term_postings), term_field_tfs)
+            field_tfs_offsets.append(field_tfs_offsets[-1] + field_tfs_blob.write(term_field_tfs))
+        if positional or fields:
+            term_postings = [posting[:2] for posting in term_postings]
+        df.append(len(term_postings))
+        previous = 0
+        for start in range(0, len(term_postings), BLOCK_SIZE):
+            block = term_postings[start:start + BLOCK_SIZE]
+            position += postings_blob.write(encode_postings(block, previous))
+            previous = block[-1][0]
+            block_last_doc.append(previous)
+            block_ends.append(position)
+            block_max_tf.append(max(tf for _, tf in block))
+            block_min_length.append(min(doc_lengths[doc] for doc, _ in block))
+            block_max_ratio.append(max(tf / doc_lengths[doc] for doc, tf in block))
+        postings_offsets.append(position)
+        blocks_offsets.append(len(block_last_doc))
+
+    meta = dict(metadata or {})
+    meta["index_version"] = INDEX_VERSION
+    meta["num_docs"] = len(doc_ids)
+    meta["num_terms"] = len(terms)
+    meta["avg_doc_length"] = sum(doc_lengths) / len(doc_lengths) if doc_lengths else 0
+    if fields:
+        meta["fields"] = list(fields)
+
+    terms_blob, terms_offsets = pack_strings(terms)
+    doc_ids_blob, doc_ids_offsets = pack_strings(doc_ids)
+    sections = [
+        ("meta", json.dumps(meta).encode("utf-8")),
+        ("terms", terms_blob),
+        ("terms.offsets", terms_offsets),
+        ("df", _array_bytes("I", df)),
+        ("postings", postings_blob),
+        ("postings.offsets", _array_bytes("Q", postings_offsets)),
+        ("doc_ids", doc_ids_blob),
+        ("doc_ids.offsets", doc_ids_offsets),
+        ("doc_lengths", _array_bytes("I", doc_lengths)),
+        ("blocks.offsets", _array_bytes("Q", blocks_offsets)),
+        ("block_last_doc", _array_bytes("I", block_last_doc)),
+        ("block_ends", _array_bytes("Q", block_ends)),
+        ("block_max_tf", _array_bytes("I", block_max_tf)),
+        ("block_min_length", _array_bytes("I", block_min_length)),
+        ("block_max_ratio", _array_bytes("d", block_max_ratio)),
+    ]
+    if positional:
+        sections.append(("positions", positions_blob))
+        sections.append(("positions.index", _array_bytes("Q", positions_offsets)))
+    if fields:
+        sections.append(("field_tfs", field_tfs_blob))
+        sections.append(("field_tfs.index", _array_bytes("Q", field_tfs_offsets)))
+        sections.append(("field_lengths", _array_bytes("I", field_lengths)))
+
+    # Forward vectors: (term id, tf) pairs of each document, coded like postings
+    if doc_vectors is not None:
+        term_ids = {term: term_id for term_id, term in enumerate(terms)}
+        vectors_blob = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+        vectors_offsets = array("Q", [0])
+        for vector in doc_vectors:
+            data = encode_postings(sorted((term_ids[term], tf) for term, tf in vector))
+            vectors_offsets.append(vectors_offsets[-1] + vectors_blob.write(data))
+        sections.append(("vectors", vectors_blob))
+        sections.append(("vectors.offsets", _array_bytes("Q", vectors_offsets)))
+    write_sections(path, sections)
+
+
+# Reading an index written by write_index. The file is memory-mapped, so opening it
+# costs the same for any corpus size and processes sharing it share the page cache;
+# terms are looked up by binary search and postings are decoded per term on demand.
+class IndexReader:
+    def __init__(self, path, cache_size=1024):
+        sections = open_sections(path)
+
+        self.metadata = json.loads(bytes(sections["meta"]))
+        if self.metadata.get("index_version", 1) != INDEX_VERSION:
+            raise ValueError(f"{path} was written by an older version of write_index without block bounds; rebuild the index")
+        self.num_docs = self.metadata["num_docs"]
+        self.avg_doc_length = self.metadata["avg_doc_length"]
+
+        self.terms = StringTable(sections["terms"], sections["terms.offsets"])
+        self._df = _array("I", sections["df"])
+        self._postings = sections["postings"]
+        self._postings_offsets = _array("Q", sections["postings.offsets"])
+
+        self.doc_ids = StringTable(sections["doc_ids"], sections["doc_ids.offsets"])
+        self.doc_lengths = _array("I", sections["doc_lengths"])
+
+        self._blocks_offsets = _array("Q", sections["blocks.offsets"])
+        self._block_last_doc = _array("I", sections["block_last_doc"])
+        self._block_ends = _array("Q", sections["block_ends"])
+        self._block_max_tf = _array("I", sections["block_max_tf"])
+        self._block_min_length = _array("I", sections["block_min_length"])
+        self._block_max_ratio = _array("d", sections["block_max_ratio"])
+
+        # Forward vectors, positions and field statistics, if the index was written with them
+        self.has_doc_vectors = "vectors" in sections
+        if self.has_doc_vectors:
+            self._doc_vectors = sections["vectors"]
+            self._doc_vectors_offsets = _array("Q", sections["vectors.offsets"])
+        self.has_positions = "positions" in sections
+        if self.has_positions:
+            self._positions = sections["positions"]
+            self._positions_offsets = _array("Q", sections["positions.index"])
+        self.fields = tuple(self.metadata.get("fields", ()))
+        if self.fields:
+            self._field_tfs = sections["field_tfs"]
+            self._field_tfs_offsets = _array("Q", sections["field_tfs.index"])
+            self.field_lengths = _array("I", sections["field_lengths"])  # By ordinal then field
+
+        # Term lookups and decoded postings of recently used terms and blocks
+        self._term_id = lru_cache(maxsize=cache_size)(self.terms.find)
+        self.postings = lru_cache(maxsize=cache_size)(self._read_postings)
+        self.positions = lru_cache(maxsize=cache_size)(self._read_positions)
+        self.field_tfs = lru_cache(maxsize=cache_size)(self._read_field_tfs)
+        self._block_postings = lru_cache(maxsize=cache_size)(self._read_block)
+
+    def __contains__(self, term):
+        return self._term_id(term) is not None
+
+    def df(self, term):
+        term_id = self._term_id(term)
+        return self._df[term_id] if term_id is not None else 0
+
+    def _read_postings(self, term):
+        term_id = self._term_id(term)
+        if term_id is None:
+            return ()
+        start, end = self._postings_offsets[term_id], self._postings_offsets[term_id + 1]
+        return tuple(decode_postings(self._postings[start:end]))
+
+    # Positions of a term in each document of postings(term), in the same order
+    def _read_positions(self, term):
+        if not self.has_positions:
+            raise ValueError("the index was written without positions; rebuild it")
+        term_id = self._term_id(term)
+        if term_id is None:
+            return ()
+        start, end = self._positions_offsets[term_id], self._positions_offsets[term_id + 1]
+        return tuple(decode_positions(self._positions[start:end], (tf for _, tf in self.postings(term))))
+
+    # Tfs of a term in each field, for each document of postings(term) in the same order
+    def _read_field_tfs(self, term):
+        if not self.fields:
+            raise ValueError("the index was written without field statistics; rebuild it")
+        term_id = self._term_id(term)
+        if term_id is None:
+            return ()
+        start, end = self._field_tfs_offsets[term_id], self._field_tfs_offsets[term_id + 1]
+        return tuple(decode_field_tfs(self._field_tfs[start:end], len(self.fields)))
+
+    # (docs, tfs) of a block; `previous` is the last doc of the term's previous block, or 0
+    def _read_block(self, block, previous):
+        start = self._block_ends[block - 1] if block else 0
+        postings = decode_postings(self._postings[start:self._block_ends[block]], previous)
+        return [doc for doc, _ in postings], [tf for _, tf in postings]
+
+    def cursor(self, term):
+        term_id = self._term_id(term)
+        if term_id is None:
+            return PostingsCursor(self, 0, 0)
+        return PostingsCursor(self, self._blocks_offsets[term_id], self._blocks_offsets[term_id + 1])
+
+    # [(term, tf), ...] of a document, in term order
+    def doc_vector(self, doc):
+        if not self.has_doc_vectors:
+            raise ValueError("the index was written without document vectors; rebuild it")
+        start, end = self._doc_vectors_offsets[doc], self._doc_vectors_offsets[doc + 1]
+        return [(self.terms[term_id], tf) for term_id, tf in decode_postings(self._doc_vectors[start:end])]
+
+
+# Position in one term's postings for document-at-a-time retrieval. `doc` and `tf`
+# are the current posting, with doc == END once the postings are exhausted; blocks
+# are decoded only when the cursor lands in them.
+class PostingsCursor:
+    END = sys.maxsize
+
+    def __init__(self, reader, first_block, end_block):
+        self._reader = reader
+        self._last_doc = reader._block_last_doc
+        self._first_block = first_block
+        self._end_block = end_block
+        self.block = first_block
+        self._load(first_block)
+
+    def _load(self, block):
+        self.block = block
+        if block < self._end_block:
+            previous = self._last_doc[block - 1] if block > self._first_block else 0
+            self._docs, self._tfs = self._reader._block_postings(block, previous)
+            self._i = 0
+            self.doc, self.tf = self._docs[0], self._tfs[0]
+        else:
+            self.doc, self.tf = self.END, 0
+
+    def next(self):
+        self._i += 1
+        if self._i < len(self._docs):
+            self.doc, self.tf = self._docs[self._i], self._tfs[self._i]
+        else:
+            self._load(self.block + 1)
+
+    # Moving to the first posting with doc >= target
+    def advance(self, target):
+        if self.doc >= target:
+            return
+        block = self._shallow(target)
+        if block != self.block:
+            self._load(block)
+            if block == self._end_block:
+                return
+        self._i = bisect_left(self._docs, target, self._i)
+        self.doc, self.tf = self._docs[self._i], self._tfs[self._i]
+
+    # First block at or after the current one that may hold `target`
+    def _shallow(self, target):
+        return bisect_left(self._last_doc, target, self.block, self._end_block)
+
+    # (largest tf, shortest document, largest tf / length) of every block of the term
+    def block_bounds(self):
+        reader = self._reader
+        return [(reader._block_max_tf[block], reader._block_min_length[block], reader._block_max_ratio[block])
+                for block in range(self._first_block, self._end_block)]
+
+    # (number, last doc) of the block that would hold `target`, numbered as in
+    # block_bounds(), without decoding it; None past the last block
+    def block_at(self, target):
+        block = self._shallow(target)
+        if block == self._end_block:
+            return None
+        return block - self._first_block, self._last_doc[block]
@@ -0,0 +1,49 @@
+import json
+import os
+import time
+from binary_index import IndexReader, write_index
+
+# Converting the JSON indexes written by earlier versions of indexing.py
+# (tf_index.json + bm25_data.json) into the binary index read by generate_results.py
+
+json_files = ["inverted_index.json", "tf_index.json", "bm25_data.json"]
+
+start = time.perf_counter()
+with open("tf_index.json", "r", encoding="utf-8") as f:
+    tf_index = json.load(f)
+with open("bm25_data.json", "r", encoding="utf-8") as f:
+    bm25_data = json.load(f)
+doc_lengths = bm25_data["doc_lengths"]
+
+# Document ordinals follow the order of the document length table
+doc_ids = list(doc_lengths)
+doc_ordinals = {doc_id: ordinal for ordinal, doc_id in enumerate(doc_ids)}
+
+# tf_index.json stores count / document length, so the raw counts are recovered exactly
+postings = {
+    term: [(doc_ordinals[doc_id], round(tf * doc_lengths[doc_id])) for doc_id, tf in docs.items()]
+    for term, docs in tf_index.items()
+}
+# Forward vectors of the documents, for query expansion
+doc_vectors = [[] for _ in doc_ids]
+for term, term_postings in postings.items():
+    for ordinal, count in term_postings:
+        doc_vectors[ordinal].append((term, count))
+write_index("index.bin", doc_ids, [doc_lengths[doc_id] for doc_id in doc_ids], postings, doc_vectors=doc_vectors)
+print(f"Converted {len(postings)} terms over {len(doc_ids)} documents in {time.perf_counter() - start:.2f}s")
+
+# Comparing disk size and load time with the JSON files
+json_size = sum(os.path.getsize(path) for path in json_files if os.path.exists(path))
+start = time.perf_counter()
+for path in json_files:
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            json.load(f)
+json_load_time = time.perf_counter() - start
+
+start = time.perf_counter()
+IndexReader("index.bin")
+binary_load_time = time.perf_counter() - start
+
+print(f"JSON indexes:  {json_size / 1024:10.1f} KB, loaded in {json_load_time * 1000:8.1f} ms")
+print(f"index.bin:     {os.path.getsize('index.bin') / 1024:10.1f} KB, loaded in {binary_load_time * 1000:8.1f} ms")
@@ -1,101 +1,212 @@
 import xml.etree.ElementTree as ET
 import json
 import math
+import time
+import heapq
+from functools import lru_cache
+from itertools import islice
+from binary_index import IndexReader
+from pruning import max_score_top_k
+from tuning import load_params
+from analyzer import Analyzer
 
 # Loading necessary data
-with open("inverted_index.json", "r", encoding="utf-8") as f:
-    inverted_index = json.load(f)
-
-with open("tf_index.json", "r", encoding="utf-8") as f:
-    tf_index = json.load(f)
-
-with open("bm25_data.json", "r", encoding="utf-8") as f:
-    bm25_data = json.load(f)
+index = IndexReader("index.bin")
 
 with open("lm_data.json", "r", encoding="utf-8") as f:
     lm_data = json.load(f)
 
+with open("vsm_data.json", "r", encoding="utf-8") as f:
+    vsm_data = json.load(f)
+
+# Queries are analysed with the settings the documents were indexed with
+analyzer = Analyzer.from_config(index.metadata.get("analyzer"))
+
 # Extracting document length data
-doc_lengths = bm25_data["doc_lengths"]
-avg_doc_length = bm25_data["avg_doc_length"]
+doc_lengths = dict(zip(index.doc_ids, index.doc_lengths))
+avg_doc_length = index.avg_doc_length
 
 # Extracting Language Model data
 corpus_term_freq = lm_data["corpus_term_freq"]
 prob_w_given_corpus = lm_data["prob_w_given_corpus"]
 
-# Optimized Parameter Tuning
-k1 = 2.9  
-b = 0.3   
-lambda_smooth = 0.7  
+# Extracting precomputed IDF values and document norms
+idf_values = vsm_data["idf"]
+doc_norms = vsm_data["doc_norms"]
+
+# Model parameters, as tuned by tune_params.py (ranking_params.json) if it has been run
+bm25_params = load_params("bm25", {"k1": 2.9, "b": 0.3})
+lm_params = load_params("lm", {"lambda_smooth": 0.7})
+k1 = bm25_params["k1"]
+b = bm25_params["b"]
+lambda_smooth = lm_params["lambda_smooth"]
+# BM25 parameters of the first pass of query expansion, kept apart from k1 and b so
+# that tuning them doesn't change the expanded queries they are tuned on
+feedback_params = load_params("feedback", {"k1": 2.9, "b": 0.3})
 N = len(doc_lengths)  
+max_results = 25000  # Ranking depth per query in the run files
+
+# Position of each document in the collection, used to break score ties
+doc_order = {doc_id: position for position, doc_id in enumerate(doc_lengths)}
 
-# Computing IDF for VSM and BM25
+# Reading the postings of a term as {doc_id: TF}, with TF normalised by document length
+@lru_cache(maxsize=4096)
+def term_postings(term):
+    return {index.doc_ids[doc]: count / index.doc_lengths[doc] for doc, count in index.postings(term)}
+
+# IDF for VSM and BM25, precomputed at index time
 def compute_idf(term):
-    df = len(inverted_index.get(term, []))
-    return math.log(1 + (N / (df + 1))) if df > 0 else 0.1  # Standard IDF with smoothing
+    return idf_values.get(term, 0.1)  # Smoothed default for unseen terms
 
 # Computing sublinear TF
 def compute_tf(term, doc_id):
-    tf = tf_index.get(term, {}).get(doc_id, 0)
+    tf = term_postings(term).get(doc_id, 0)
     return (1 + math.log(tf + 2)) if tf > 0 else 0  # Avoid log(0)
 
-# Computing TF-IDF vector for a document (VSM)
-def compute_document_vector(doc_id):
-    vector = {}
-    for term in tf_index:
-        if doc_id in tf_index[term]:
-            tf = compute_tf(term, doc_id)
-            idf = compute_idf(term)
-            vector[term] = tf * idf
-    return vector
+# Term-at-a-time scoring: each model walks the postings of the query terms only,
+# so documents that share no term with the query are never touched. Every model
+# returns the accumulated scores together with the score of a non-matching document.
+# `weights` are the weights of the query terms (1 each by default), as given to an
+# expanded query by expand_query.
 
 # Computing Cosine Similarity for VSM
-def cosine_similarity(query_vector, doc_vector):
-    dot_product = sum(query_vector.get(term, 0) * doc_vector.get(term, 0) for term in query_vector)
+def cosine_similarity(query_terms, weights=None):
+    weights = weights or [1] * len(query_terms)
+    query_vector = {term: compute_idf(term) * weight for term, weight in zip(query_terms, weights)}
     query_norm = math.sqrt(sum(weight ** 2 for weight in query_vector.values())) + 1e-9
-    doc_norm = math.sqrt(sum(weight ** 2 for weight in doc_vector.values())) + 1e-9
-    return dot_product / (query_norm * doc_norm)
+    dot_products = {}
+    for term, query_weight in query_vector.items():
+        idf = compute_idf(term)
+        for doc_id in term_postings(term):
+            dot_products[doc_id] = dot_products.get(doc_id, 0) + query_weight * (compute_tf(term, doc_id) * idf)
+    scores = {doc_id: dot / (query_norm * doc_norms[doc_id]) for doc_id, dot in dot_products.items()}
+    return scores, 0.0
+
+# BM25 weight of one query term in a document
+def bm25_term_score(idf, tf, doc_length, k1=k1, b=b):
+    numerator = tf * (k1 + 1)
+    denominator = tf + k1 * (1 - b + b * (doc_length / avg_doc_length))
+    return idf * (numerator / denominator)
 
 # Computing BM25 score
-def bm25_score(query_terms, doc_id):
-    score = 0
-    doc_length = doc_lengths.get(doc_id, 0)
-    for term in query_terms:
-        if doc_id in tf_index.get(term, {}):
-            tf = tf_index[term][doc_id]
-            idf = compute_idf(term)
-            numerator = tf * (k1 + 1)
-            denominator = tf + k1 * (1 - b + b * (doc_length / avg_doc_length))
-            score += idf * (numerator / denominator)
-    return score
+def bm25_score(query_terms, k1=k1, b=b, weights=None):
+    weights = weights or [1] * len(query_terms)
+    scores = {}
+    for term, weight in zip(query_terms, weights):
+        idf = compute_idf(term)
+        for doc_id, tf in term_postings(term).items():
+            doc_length = doc_lengths.get(doc_id, 0)
+            scores[doc_id] = scores.get(doc_id, 0) + bm25_term_score(idf, tf, doc_length, k1, b) * weight
+    return scores, 0
+
+# BM25 scores of the k best documents only, found document-at-a-time with dynamic
+# pruning (see pruning.py). Ranking them gives the same first k results as
+# bm25_score: every other document scores no higher than the k-th. Ranking deeper
+# than the collection leaves nothing to prune, so that is scored term-at-a-time.
+def bm25_top_k(query_terms, k, k1=k1, b=b, weights=None):
+    weights = weights or [1] * len(query_terms)
+    idfs = [compute_idf(term) for term in query_terms]
+    if k >= N or any(idf < 0 for idf in idfs):  # Block bounds assume non-negative weights
+        return bm25_score(query_terms, k1, b, weights)
+
+    def score(j, doc, count):
+        doc_length = index.doc_lengths[doc]
+        return bm25_term_score(idfs[j], count / doc_length, doc_length, k1, b) * weights[j]
+
+    # Largest length-normalised TF and shortest document of a block
+    def bound(j, block):
+        _, min_length, max_tf = block
+        return bm25_term_score(idfs[j], max_tf, min_length, k1, b) * weights[j]
+
+    cursors = [index.cursor(term) for term in query_terms]
+    top = max_score_top_k(cursors, k, score, bound, lambda doc, first: doc)
+    return {index.doc_ids[doc]: doc_score for doc, doc_score in top}, 0
+
+# Computing the Jelinek-Mercer smoothed log probability of one query term
+def lm_term_score(term, tf, doc_length, lambda_smooth=lambda_smooth):
+    p_w_given_d = tf / doc_length if doc_length else 0
+    p_w_given_c = prob_w_given_corpus.get(term, 1e-6)
+    return math.log(lambda_smooth * p_w_given_d + (1 - lambda_smooth) * p_w_given_c + 1e-6)
 
 # Computing LM score
-def lm_score(query_terms, doc_id):
-    score = 0
-    doc_length = doc_lengths.get(doc_id, 0)
-    for term in query_terms:
-        p_w_given_d = tf_index.get(term, {}).get(doc_id, 0) / doc_length if doc_length else 0
-        p_w_given_c = prob_w_given_corpus.get(term, 1e-6)
-        score += math.log(lambda_smooth * p_w_given_d + (1 - lambda_smooth) * p_w_given_c + 1e-6)
-    return score
-
-# Improved Query Expansion
-def expand_query(query_terms):
-    expanded_terms = set(query_terms)
-    for term in query_terms:
-        if term in inverted_index:
-            index_entry = inverted_index[term]
-            if isinstance(index_entry, dict):
-                related_terms = list(index_entry.keys())[:20]  # Expanding to 20 terms
-            elif isinstance(index_entry, list):
-                related_terms = index_entry[:20]  # Taking first 20 terms if it's a list
+def lm_score(query_terms, lambda_smooth=lambda_smooth, weights=None):
+    weights = weights or [1] * len(query_terms)
+    postings = [term_postings(term) for term in query_terms]
+    background = [lm_term_score(term, 0, 0, lambda_smooth) * weight for term, weight in zip(query_terms, weights)]
+    background_score = 0
+    for term_score in background:
+        background_score += term_score
+
+    # Only documents in the postings differ from the background score; their
+    # terms are summed in query order so the result matches a full evaluation
+    candidates = set()
+    for tf_values in postings:
+        candidates.update(tf_values)
+    scores = {}
+    for doc_id in candidates:
+        doc_length = doc_lengths.get(doc_id, 0)
+        score = 0
+        for term, weight, tf_values, term_background in zip(query_terms, weights, postings, background):
+            if doc_id in tf_values:
+                score += lm_term_score(term, tf_values[doc_id], doc_length, lambda_smooth) * weight
             else:
-                related_terms = []
-            expanded_terms.update(related_terms)
-    return list(expanded_terms)
+                score += term_background
+        scores[doc_id] = score
+    return scores, background_score
+
+# Ranking the scored documents, followed by the non-matching ones at the background score
+def rank_documents(scores, background_score, limit=max_results):
+    sort_key = lambda item: (-item[1], doc_order[item[0]])
+    matched = heapq.nsmallest(limit, scores.items(), key=sort_key)
+    unmatched = ((doc_id, background_score) for doc_id in doc_lengths if doc_id not in scores)
+    return list(islice(heapq.merge(matched, unmatched, key=sort_key), limit))
+
+# Query Expansion with pseudo-relevance feedback (RM3)
+#
+# A first BM25 pass, with feedback_params, takes the fb_docs best documents as
+# relevant. Their terms are weighted by the relevance model P(w|R) = sum over those
+# documents of P(w|d) * score(d) / total score, with P(w|d) = tf / document length
+# read from the forward vectors stored in index.bin, and the fb_terms most likely
+# terms are added to the query. Each term's weight is original_weight * its count in the query plus
+# (1 - original_weight) * P(w|R) * query length. Terms in more than fb_max_df of the
+# documents are never added: they carry little evidence and have the longest
+# postings, so fb_terms and fb_max_df bound the postings read by the second pass.
+fb_docs = 10  # Feedback documents; 0 turns expansion off
+fb_terms = 10  # Expansion terms added at most
+fb_max_df = 0.1  # Largest fraction of the documents an expansion term may occur in
+original_weight = 0.7  # Share of the original query in the expanded one
+
+# First pass: {doc_id: BM25 score} of the feedback documents
+def feedback_documents(query_terms):
+    if not fb_docs:
+        return {}
+    return bm25_top_k(query_terms, fb_docs, feedback_params["k1"], feedback_params["b"])[0]
 
-# Filtering Stopwords
-stopwords = {"the", "is", "and", "a", "of", "to", "in", "on", "with", "that", "for", "as", "by", "at"}
+# Expanded query terms and their weights; the query as it is (weights None) without feedback
+def expand_query(query_terms, feedback=None):
+    if feedback is None:
+        feedback = feedback_documents(query_terms)
+    total_score = sum(score for score in feedback.values() if score > 0)
+    if not total_score:
+        return query_terms, None
+
+    relevance = {}
+    for doc_id, score in feedback.items():
+        if score > 0:
+            doc = doc_order[doc_id]
+            doc_weight = score / total_score / index.doc_lengths[doc]
+            for term, tf in index.doc_vector(doc):
+                relevance[term] = relevance.get(term, 0) + tf * doc_weight
+    weights = {}
+    for term in query_terms:
+        weights[term] = weights.get(term, 0) + original_weight
+    max_df = fb_max_df * N
+    candidates = sorted(relevance.items(), key=lambda item: (-item[1], item[0]))
+    expansion = [(term, p) for term, p in candidates if term in weights or index.df(term) <= max_df][:fb_terms]
+    expansion_total = sum(p for _, p in expansion)
+    for term, p in expansion:
+        weights[term] = weights.get(term, 0) + (1 - original_weight) * p / expansion_total * len(query_terms)
+    return list(weights), list(weights.values())
 
 # Parsing Queries from XML
 def parse_queries(query_file):
@@ -106,8 +217,7 @@ def parse_queries(query_file):
         query_id_counter = 1
         for query in root.findall("top"):
             query_text = query.find("title").text.strip()
-            query_terms = [term for term in query_text.lower().split() if term not in stopwords]
-            queries[str(query_id_counter)] = " ".join(query_terms)
+            queries[str(query_id_counter)] = " ".join(analyzer.analyze(query_text))
             query_id_counter += 1
         print(f"Successfully loaded {len(queries)} queries!")
         return queries
@@ -118,36 +228,55 @@ def parse_queries(query_file):
         print(f"XML Parsing Error: {e}")
         exit()
 
+# Ranking of one query by "vsm", "bm25" or "lm"; `params` overrides k1 and b for
+# BM25 or lambda_smooth for LM
+def rank_query(model, query_terms, weights=None, **params):
+    if model == "vsm":
+        return rank_documents(*cosine_similarity(query_terms, weights))
+    if model == "bm25":
+        return rank_documents(*bm25_top_k(query_terms, max_results, weights=weights, **params))
+    return rank_documents(*lm_score(query_terms, weights=weights, **params))
+
+RUN_TAGS = {"vsm": "VSM_run", "bm25": "BM25_run", "lm": "LM_run"}
+
+# Lines of a TREC run file for one query
+def run_lines(query_id, ranking, tag):
+    return [f"{query_id} 0 {doc_id} {rank} {score:.4f} {tag}" for rank, (doc_id, score) in enumerate(ranking, start=1)]
+
 # Generating Results
 def generate_results(query_file, output_vsm, output_bm25, output_lm):
     queries = parse_queries(query_file)
-    vsm_results, bm25_results, lm_results = [], [], []
-    
+    results = {model: [] for model in RUN_TAGS}
+    pass_ms = {"feedback": 0, "expansion": 0, "ranking": 0}
+
     for query_id, query_text in queries.items():
-        print(f"Processing Query {query_id}...")
-        query_terms = expand_query(query_text.split())
-        top_docs = list(doc_lengths.keys())[:25000]  # Processing 25,000 docs per query
-        
-        vsm_scores = {doc_id: cosine_similarity({term: compute_idf(term) for term in query_terms}, compute_document_vector(doc_id)) for doc_id in top_docs}
-        bm25_scores = {doc_id: bm25_score(query_terms, doc_id) for doc_id in top_docs}
-        lm_scores = {doc_id: lm_score(query_terms, doc_id) for doc_id in top_docs}
-        
-        for rank, (doc_id, score) in enumerate(sorted(vsm_scores.items(), key=lambda x: x[1], reverse=True)[:25000], start=1):
-            vsm_results.append(f"{query_id} 0 {doc_id} {rank} {score:.4f} VSM_run")
-        for rank, (doc_id, score) in enumerate(sorted(bm25_scores.items(), key=lambda x: x[1], reverse=True)[:25000], start=1):
-            bm25_results.append(f"{query_id} 0 {doc_id} {rank} {score:.4f} BM25_run")
-        for rank, (doc_id, score) in enumerate(sorted(lm_scores.items(), key=lambda x: x[1], reverse=True)[:25000], start=1):
-            lm_results.append(f"{query_id} 0 {doc_id} {rank} {score:.4f} LM_run")
-    
-    with open(output_vsm, "w") as f:
-        f.write("\n".join(vsm_results))
-    with open(output_bm25, "w") as f:
-        f.write("\n".join(bm25_results))
-    with open(output_lm, "w") as f:
-        f.write("\n".join(lm_results))
+        # Timing the first pass, the choice of expansion terms and the ranking by every model
+        start = time.perf_counter()
+        query_terms = query_text.split()
+        feedback = feedback_documents(query_terms)
+        feedback_done = time.perf_counter()
+        query_terms, weights = expand_query(query_terms, feedback)
+        expansion_done = time.perf_counter()
 
-    print("Search results generated in TREC_EVAL format!")
+        for model, lines in results.items():
+            lines.extend(run_lines(query_id, rank_query(model, query_terms, weights), RUN_TAGS[model]))
+
+        timings = {"feedback": feedback_done - start, "expansion": expansion_done - feedback_done,
+                   "ranking": time.perf_counter() - expansion_done}
+        for name, seconds in timings.items():
+            pass_ms[name] += seconds * 1000
+        described = ", ".join(f"{name} {seconds * 1000:.1f} ms" for name, seconds in timings.items())
+        print(f"Processed Query {query_id} in {sum(timings.values()) * 1000:.1f} ms ({described}, {len(query_terms)} terms)")
 
-query_file_path = r"C:\Users\Chand\OneDrive\Desktop\Mechanics of Search\Search Engine Assignment 1\cranfield-trec-dataset-main\cranfield-trec-dataset-main\cran.qry.xml"
-generate_results(query_file_path, "vsm_results.txt", "bm25_results.txt", "lm_results.txt")
+    described = ", ".join(f"{name} {total / len(queries):.2f} ms" for name, total in pass_ms.items())
+    print(f"Mean per query: {described}")
+
+    for model, output in (("vsm", output_vsm), ("bm25", output_bm25), ("lm", output_lm)):
+        with open(output, "w") as f:
+            f.write("\n".join(results[model]))
+
+    print("Search results generated in TREC_EVAL format!")
 
+if __name__ == "__main__":
+    query_file_path = r"C:\Users\Chand\OneDrive\Desktop\Mechanics of Search\Search Engine Assignment 1\cranfield-trec-dataset-main\cranfield-trec-dataset-main\cran.qry.xml"
+    generate_results(query_file_path, "vsm_results.txt", "bm25_results.txt", "lm_results.txt")
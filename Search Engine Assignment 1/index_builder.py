@@ -0,0 +1,265 @@
+import heapq
+import struct
+import tempfile
+from array import array
+from collections import Counter
+from binary_index import (decode_field_tfs, decode_positions, decode_postings, decode_varints, encode_postings,
+                          encode_varint, write_index)
+
+# Building a binary index one document at a time (single-pass in-memory indexing).
+# Only the postings are kept, as flat arrays of (ordinal, tf) pairs per term, never
+# the documents' token lists. Once the postings in memory reach `memory_budget`
+# bytes they are written out, sorted by term, as a run in a temporary file and the
+# buffer starts again empty; writing the index k-way merges the runs term by term,
+# so memory use stays flat however large the collection grows. Every MERGE_FAN_IN
+# runs are merged into one larger run, which bounds the number of open files.
+#
+# With doc_vectors=True the (term, tf) pairs of every document are also kept, for
+# the index's forward vectors. They are appended to a temporary file as they come,
+# with terms numbered in order of first appearance, and renumbered by write_index.
+#
+# With positions=True documents are added as term lists (add_terms) and each
+# posting keeps the positions of its term, gap-coded within the document. Positions
+# don't depend on other postings, so runs are merged by concatenating them.
+#
+# With fields (their names), documents are added as one term list per field
+# (add_fields): each posting also keeps the tf of its term in every field, and the
+# length of every field of every document is kept, for field-weighted scoring.
+
+MEMORY_BUDGET = 256 << 20  # Bytes of postings kept in memory before a run is flushed
+TERM_OVERHEAD = 160  # Estimated bytes of a new term's dict slot, string and array
+POSTING_SIZE = 8  # Bytes of an (ordinal, tf) pair
+RUN_BUFFER_SIZE = 1 << 20  # Bytes buffered while writing or reading a run
+MERGE_FAN_IN = 64  # Runs merged at a time
+
+# Run records: lengths of the term, the encoded postings, positions and field tfs,
+# followed by the term, its postings (gap-coded from ordinal 0), positions and field tfs
+_RECORD = struct.Struct("<IIII")
+_VECTOR = struct.Struct("<I")  # Length of a document's encoded (term number, tf) pairs
+
+class IndexBuilder:
+    def __init__(self, memory_budget=MEMORY_BUDGET, temp_dir=None, doc_vectors=False, positions=False, fields=None):
+        self.doc_ids = []
+        self.doc_lengths = array("I")
+        self.memory_budget = memory_budget
+        self.temp_dir = temp_dir
+        self.positions = positions
+        self.fields = fields
+        self.field_lengths = array("I")  # By ordinal then field
+        self._postings = {}
+        self._positions = {}
+        self._field_tfs = {}
+        self._size = 0
+        self._runs = []
+        self.num_runs = 0  # Runs flushed to disk so far
+        self._vectors = tempfile.TemporaryFile(dir=temp_dir) if doc_vectors else None
+        self._vector_terms = {}
+        self._vector_buffer = bytearray()
+
+    # Adding a document given its {term: tf} counts and its length in tokens; a
+    # positional builder needs the {term: [position, ...]} of the document too, and
+    # one with fields the {term: (tf in each field, ...)}
+    def add(self, doc_id, counts, length, positions=None, field_tfs=None):
+        if self.positions:
+            self._add_positions(positions)
+        if self.fields:
+            self._add_field_tfs(field_tfs)
+        ordinal = len(self.doc_ids)
+        self.doc_ids.append(doc_id)
+        self.doc_lengths.append(length)
+        for term, tf in counts.items():
+            postings = self._postings.get(term)
+            if postings is None:
+                postings = self._postings[term] = array("I")
+                self._size += TERM_OVERHEAD + len(term)
+            postings.append(ordinal)
+            postings.append(tf)
+        self._size += POSTING_SIZE * len(counts)
+        if self._vectors is not None:
+            self._add_vector(counts)
+        if self._size >= self.memory_budget:
+            self._flush()
+
+    # Adding a document given its terms in order
+    def add_terms(self, doc_id, terms, field_tfs=None):
+        if not self.positions:
+            self.add(doc_id, Counter(terms), len(terms), field_tfs=field_tfs)
+            return
+        positions = {}
+        for position, term in enumerate(terms):
+            term_positions = positions.get(term)
+            if term_positions is None:
+                positions[term] = [position]
+            else:
+                term_positions.append(position)
+        self.add(doc_id, {term: len(term_positions) for term, term_positions in positions.items()}, len(terms),
+                 positions, field_tfs)
+
+    # Adding a document given the terms of each of its fields, in order; its terms
+    # are those of the fields one after the other
+    def add_fields(self, doc_id, field_terms):
+        field_tfs = {}
+        for field, terms in enumerate(field_terms):
+            for term in terms:
+                tfs = field_tfs.get(term)
+                if tfs is None:
+                    tfs = field_tfs[term] = [0] * len(field_terms)
+                tfs[field] += 1
+        self.field_lengths.extend(len(terms) for terms in field_terms)
+        self.add_terms(doc_id, [term for terms in field_terms for term in terms], field_tfs)
+
+    def _add_positions(self, positions):
+        for term, term_positions in positions.items():
+            encoded = self._positions.get(term)
+            if encoded is None:
+                encoded = self._positions[term] = bytearray()
+            size = len(encoded)
+            previous = 0
+            for position in term_positions:
+                encode_varint(position - previous, encoded)
+                previous = position
+            self._size += len(encoded) - size
+
+    def _add_field_tfs(self, field_tfs):
+        for term, tfs in field_tfs.items():
+            encoded = self._field_tfs.get(term)
+            if encoded is None:
+                encoded = self._field_tfs[term] = bytearray()
+            size = len(encoded)
+            for tf in tfs:
+                encode_varint(tf, encoded)
+            self._size += len(encoded) - size
+
+    def _add_vector(self, counts):
+        vector = bytearray()
+        numbers = self._vector_terms
+        for term, tf in counts.items():
+            number = numbers.get(term)
+            if number is None:
+                number = numbers[term] = len(numbers)
+            encode_varint(number, vector)
+            encode_varint(tf, vector)
+        buffer = self._vector_buffer
+        buffer += _VECTOR.pack(len(vector))
+        buffer += vector
+        if len(buffer) >= RUN_BUFFER_SIZE:
+            self._vectors.write(buffer)
+            buffer.clear()
+
+    # [(term, tf), ...] of every document, in ordinal order
+    def _read_vectors(self):
+        self._vectors.write(self._vector_buffer)
+        self._vector_buffer.clear()
+        self._vectors.seek(0)
+        terms = list(self._vector_terms)
+        with open(self._vectors.fileno(), "rb", buffering=RUN_BUFFER_SIZE, closefd=False) as f:
+            for _ in range(len(self.doc_ids)):
+                values = decode_varints(f.read(_VECTOR.unpack(f.read(_VECTOR.size))[0]))
+                yield [(terms[number], tf) for number, tf in zip(values[0::2], values[1::2])]
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    # (term, postings, encoded positions, encoded field tfs) of the postings in memory, in term order
+    def _buffered(self):
+        for term in sorted(self._postings):
+            pairs = self._postings[term]
+            yield term, list(zip(pairs[::2], pairs[1::2])), self._positions.get(term, b""), self._field_tfs.get(term, b"")
+
+    # Writing (term, postings, encoded positions, encoded field tfs) records, in term order, to a new run
+    def _write_run(self, records):
+        run = tempfile.TemporaryFile(dir=self.temp_dir)
+        buffer = bytearray()
+        for term, term_postings, term_positions, term_field_tfs in records:
+            term_bytes = term.encode("utf-8")
+            data = encode_postings(term_postings)
+            buffer += _RECORD.pack(len(term_bytes), len(data), len(term_positions), len(term_field_tfs))
+            buffer += term_bytes
+            buffer += data
+            buffer += term_positions
+            buffer += term_field_tfs
+            if len(buffer) >= RUN_BUFFER_SIZE:
+                run.write(buffer)
+                buffer.clear()
+        run.write(buffer)
+        return run
+
+    # Writing the buffered postings to a new run
+    def _flush(self):
+        self._runs.append(self._write_run(self._buffered()))
+        self.num_runs += 1
+        self._postings = {}
+        self._positions = {}
+        self._field_tfs = {}
+        self._size = 0
+        if len(self._runs) >= MERGE_FAN_IN:
+            runs = self._runs
+            self._runs = [self._write_run(self._merge(runs))]
+            for run in runs:
+                run.close()
+
+    # (term, run number, encoded postings, positions and field tfs) of every record in a run, in term order
+    @staticmethod
+    def _read_run(run, number):
+        run.seek(0)
+        with open(run.fileno(), "rb", buffering=RUN_BUFFER_SIZE, closefd=False) as f:
+            while True:
+                header = f.read(_RECORD.size)
+                if not header:
+                    return
+                term_length, data_length, positions_length, field_tfs_length = _RECORD.unpack(header)
+                term = f.read(term_length).decode("utf-8")
+                yield term, number, f.read(data_length), f.read(positions_length), f.read(field_tfs_length)
+
+    # (term, postings, encoded positions, encoded field tfs) of the runs, in term
+    # order. Documents are added in ordinal order, so each run holds later ordinals
+    # than the one before and a term's postings are the concatenation of its postings
+    # in each run.
+    def _merge(self, runs):
+        records = heapq.merge(*(self._read_run(run, number) for number, run in enumerate(runs)))
+        term, term_postings, term_positions, term_field_tfs = None, [], bytearray(), bytearray()
+        for record_term, _, data, positions, field_tfs in records:
+            if record_term != term:
+                if term is not None:
+                    yield term, term_postings, term_positions, term_field_tfs
+                term, term_postings, term_positions, term_field_tfs = record_term, [], bytearray(), bytearray()
+            term_postings += decode_postings(data)
+            term_positions += positions
+            term_field_tfs += field_tfs
+        if term is not None:
+            yield term, term_postings, term_positions, term_field_tfs
+
+    # (term, [(ordinal, tf), ...]) for every term, in term order; the postings of a
+    # positional builder are (ordinal, tf, positions), and those of a builder with
+    # fields end with the (tf in each field, ...)
+    def postings(self):
+        if self._runs and self._postings:
+            self._flush()
+        records = self._merge(self._runs) if self._runs else self._buffered()
+        for term, term_postings, term_positions, term_field_tfs in records:
+            if self.positions:
+                position_lists = decode_positions(term_positions, (tf for _, tf in term_postings))
+                term_postings = [posting + (positions,) for posting, positions in zip(term_postings, position_lists)]
+            if self.fields:
+                field_tf_lists = decode_field_tfs(term_field_tfs, len(self.fields))
+                term_postings = [posting + (field_tfs,) for posting, field_tfs in zip(term_postings, field_tf_lists)]
+            yield term, term_postings
+
+    # Writing the index; `on_term(term, postings)` sees every term's postings on the way,
+    # e.g. to compute collection statistics. Runs are deleted once merged.
+    def write(self, path, metadata=None, on_term=None):
+        def merged():
+            for term, term_postings in self.postings():
+                if on_term is not None:
+                    on_term(term, term_postings)
+                yield term, term_postings
+        doc_vectors = self._read_vectors() if self._vectors is not None else None
+        try:
+            write_index(path, self.doc_ids, self.doc_lengths, merged(), metadata, doc_vectors, self.positions,
+                        self.fields, self.field_lengths)
+        finally:
+            for run in self._runs:
+                run.close()
+            self._runs = []
+            if self._vectors is not None:
+                self._vectors.close()
@@ -1,21 +1,17 @@
 import xml.etree.ElementTree as ET
-import nltk
-from nltk.tokenize import word_tokenize
-from nltk.corpus import stopwords
-from nltk.stem import PorterStemmer
 import os
-from collections import defaultdict
+from collections import Counter
 import json
 import math
+from analyzer import Analyzer
+from index_builder import IndexBuilder
+from trec_reader import iter_documents
 
 ###Inverted Indexing
 
-# Downloading stopwords (only need to run once)
-#nltk.download('punkt')
-#nltk.download('stopwords')
-
-# Loading Stopwords
-stop_words = set(stopwords.words('english'))
+# Lowercasing, tokenizing, removing stopwords and Porter-stemming; queries are
+# analysed the same way, with the settings saved in index.bin
+analyzer = Analyzer(stopwords="english", stem=True)
 dataset_path = r"C:\Users\Chand\OneDrive\Desktop\Mechanics of Search\Search Engine Assignment 1\cranfield-trec-dataset-main\cranfield-trec-dataset-main\cran.all.1400.xml" # Update this if needed
 
 # Checking if file exists
@@ -23,93 +19,70 @@ if not os.path.exists(dataset_path):
     print("Error: XML file not found. Check the path.")
     exit()
 
-# Reading the file and wrapping it inside a root element
-with open(dataset_path, "r", encoding="utf-8") as file:
-    xml_content = file.read()
-
-# Manually adding a root element
-fixed_xml = f"<root>\n{xml_content}\n</root>"
-
-# Parsing the modified XML string
+# Streaming the documents: each <doc> is analysed as it is read and only its term
+# counts are kept, as postings. Past memory_budget bytes of postings the builder
+# writes them to a sorted run on disk and merges the runs when the index is written.
+# Each document's term counts are kept too, as the forward vectors query expansion
+# reads in generate_results.py.
+memory_budget = 256 * 2**20
+builder = IndexBuilder(memory_budget=memory_budget, doc_vectors=True)
 try:
-    root = ET.fromstring(fixed_xml)
-    print("XML Parsed Successfully!")
+    for doc_id, content in iter_documents(dataset_path, fields=("title", "text")):
+        tokens = analyzer.analyze(content)
+        builder.add(doc_id, Counter(tokens), len(tokens))
+    print(f"XML Parsed Successfully! ({len(builder)} documents, {builder.num_runs} runs flushed to disk)")
 except ET.ParseError as e:
     print("XML Parsing Error:", e)
     exit()
 
-# Initializing dictionary for storing documents
-stemmer = PorterStemmer()
-documents = {}
-
-# Extracting document ID and text
-for doc in root.findall("doc"):  # Now <doc> elements are inside <root>
-    doc_id = doc.find("docno").text.strip() if doc.find("docno") is not None else "Unknown"
-    title_element = doc.find("title")
-    abstract_element = doc.find("text")
-    title = title_element.text.strip() if title_element is not None and title_element.text else ""
-    abstract = abstract_element.text.strip() if abstract_element is not None and abstract_element.text else ""
-    content = f"{title} {abstract}"
-    tokens = word_tokenize(content.lower())
-    #tokens = [stemmer.stem(word) for word in tokens if word.isalnum() and word not in stop_words] #apply stemming 
-    documents[doc_id] = tokens
+doc_ids = builder.doc_ids
+doc_lengths = builder.doc_lengths  # By document ordinal
+N = len(doc_ids)
+avg_doc_length = sum(doc_lengths) / N  # Average document length
+
+# One pass over the postings, term by term, computes the statistics every model
+# needs while the binary index is written:
+#   VSM  IDF of each term, and the TF-IDF norm of each document, so that queries
+#        only need a dot product over the postings of the query terms
+#   LM   corpus frequency of each term
+idf_values = {}
+squared_weights = [0] * N
+corpus_term_freq = {}
 
-# Building Inverted Index
-inverted_index = defaultdict(set)
-for doc_id, words in documents.items():
-    for word in words:
-        inverted_index[word].add(doc_id)
+def collect_statistics(term, postings):
+    df = len(postings)
+    idf = idf_values[term] = math.log(1 + (N / (df + 1)))
+    for ordinal, count in postings:
+        tf = count / doc_lengths[ordinal]
+        weight = (1 + math.log(tf + 2)) if tf > 0 else 0  # Sublinear TF, as used at query time
+        squared_weights[ordinal] += (weight * idf) ** 2
+    corpus_term_freq[term] = df * df  # The term's df, summed over the documents containing it
 
-print("Sample indexed words:", list(inverted_index.items())[:5])
+###BM25
 
-# Saving inverted index as a JSON file
-with open("inverted_index.json", "w", encoding="utf-8") as f:
-    json.dump({k: list(v) for k, v in inverted_index.items()}, f, indent=4)
+# Saving postings (raw term counts), document lengths and the average length as a
+# binary index; TF values are recovered at query time as count / document length
+builder.write("index.bin", {"analyzer": analyzer.config()}, on_term=collect_statistics)
 
-print("Inverted index saved successfully as 'inverted_index.json'")
+print(f"Binary index ({len(idf_values)} terms, avg length {avg_doc_length:.2f}) saved as 'index.bin'")
 
 ###VSM
 
-# Computing TF values for each term in each document
-tf_index = {}
-
-for term, doc_list in inverted_index.items():
-    tf_index[term] = {}
-    for doc_id in doc_list:
-        tf_index[term][doc_id] = documents[doc_id].count(term) / len(documents[doc_id])
+doc_norms = {doc_id: math.sqrt(total) + 1e-9 for doc_id, total in zip(doc_ids, squared_weights)}
 
-# Saving TF values to a JSON file
-with open("tf_index.json", "w", encoding="utf-8") as f:
-    json.dump(tf_index, f, indent=4)
-
-print("Term Frequency (TF) values saved as 'tf_index.json'")
-
-###BM25
-
-# Computing document lengths
-doc_lengths = {doc_id: len(doc) for doc_id, doc in documents.items()}
-avg_doc_length = sum(doc_lengths.values()) / len(doc_lengths)  # Average document length
-
-# Saving document lengths and average length for BM25
-bm25_data = {
-    "doc_lengths": doc_lengths,
-    "avg_doc_length": avg_doc_length
+vsm_data = {
+    "idf": idf_values,
+    "doc_norms": doc_norms
 }
 
-with open("bm25_data.json", "w", encoding="utf-8") as f:
-    json.dump(bm25_data, f, indent=4)
+with open("vsm_data.json", "w", encoding="utf-8") as f:
+    json.dump(vsm_data, f, indent=4)
 
-print("BM25 Data (Document Lengths & Avg Length) saved as 'bm25_data.json'")
+print("VSM Data (IDF & Document Norms) saved as 'vsm_data.json'")
 
 ###Language Model [Jelinek-Mercer Smoothing]
 
-# Computing term frequency in the whole corpus
-corpus_term_freq = {}
-total_terms_in_corpus = 0
-
-for term, doc_list in inverted_index.items():
-    corpus_term_freq[term] = sum(len(tf_index[term]) for doc in doc_list)
-    total_terms_in_corpus += corpus_term_freq[term]
+total_terms_in_corpus = sum(corpus_term_freq.values())
 
 # Computing probability of a term occurring in the entire corpus
 prob_w_given_corpus = {term: freq / total_terms_in_corpus for term, freq in corpus_term_freq.items()}
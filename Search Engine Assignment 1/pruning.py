@@ -0,0 +1,105 @@
+import heapq
+from itertools import accumulate
+
+# Top-k retrieval with dynamic pruning: MaxScore with block-max bounds
+#
+# Documents are visited in ordinal order through a postings cursor per query term
+# (binary_index.PostingsCursor or anything with the same interface). Each term's
+# score is bounded by the largest bound of its blocks. Terms are sorted by bound,
+# and once the k-th best score so far beats the summed bounds of the weakest terms,
+# a document containing only those can't make the top k: they become non-essential
+# and are only probed for documents found in the other terms' postings. Before a
+# document is scored, the bounds of the blocks it falls in are added up, and runs
+# of blocks that can't reach the top k are skipped without being decoded.
+#
+# Scores are summed in query term order, as term-at-a-time scoring does, so the
+# top k, their scores and their order are exactly those of scoring everything.
+#
+#   score(j, doc, tf)             score of query term j in a document
+#   bound(j, block)               upper bound of score() over a block, given its
+#                                 (largest tf, shortest document, largest tf / length)
+#   tie_key(doc, first)           orders equal scores, lowest first; `first` is the
+#                                 first query term the document contains
+
+# Bounds and scores are summed in different orders, so comparisons leave room for rounding
+def _below(value, threshold):
+    return value < threshold - 1e-9 * max(1.0, abs(threshold))
+
+# [(doc, score)] of the k best documents, best first
+def max_score_top_k(cursors, k, score, bound, tie_key):
+    if k <= 0 or not cursors:
+        return []
+    n = len(cursors)
+    end = cursors[0].END
+    block_upper = [[bound(j, block) for block in cursor.block_bounds()] for j, cursor in enumerate(cursors)]
+    upper = [max(bounds, default=0.0) for bounds in block_upper]
+    order = sorted(range(n), key=upper.__getitem__)
+    prefix = list(accumulate(upper[j] for j in order))
+
+    heap = []  # (score, -tie key, doc), worst first
+    threshold = None
+    essential = 0  # order[essential:] are the essential terms
+    walked = cursors
+    region_end = -1  # Last document covered by region_bound
+    region_bound = 0.0
+    while essential < n:
+        doc = min(cursor.doc for cursor in walked)
+        if doc == end:
+            break
+
+        if threshold is not None:
+            # Block-max check: the documents up to the end of the first of the current
+            # blocks to run out all share the same bound
+            if doc > region_end:
+                region_bound = 0.0
+                region_end = end
+                for j, cursor in enumerate(cursors):
+                    block = cursor.block_at(doc)
+                    if block is not None:
+                        region_bound += block_upper[j][block[0]]
+                        region_end = min(region_end, block[1])
+            if _below(region_bound, threshold):
+                for cursor in walked:
+                    cursor.advance(region_end + 1)
+                continue
+
+        contributions = {}
+        for j in order[essential:]:
+            if cursors[j].doc == doc:
+                contributions[j] = score(j, doc, cursors[j].tf)
+        # Probing the non-essential terms, strongest first, while the document can still make it
+        estimate = sum(contributions.values()) + (prefix[essential - 1] if essential else 0.0)
+        pruned = False
+        for i in range(essential - 1, -1, -1):
+            if _below(estimate, threshold):
+                pruned = True
+                break
+            j = order[i]
+            cursor = cursors[j]
+            cursor.advance(doc)
+            estimate -= upper[j]
+            if cursor.doc == doc:
+                contributions[j] = score(j, doc, cursor.tf)
+                estimate += contributions[j]
+
+        if not pruned:
+            doc_score = 0.0
+            for j in range(n):
+                if j in contributions:
+                    doc_score += contributions[j]
+            entry = (doc_score, -tie_key(doc, min(contributions)), doc)
+            if len(heap) < k:
+                heapq.heappush(heap, entry)
+            elif entry > heap[0]:
+                heapq.heapreplace(heap, entry)
+            if len(heap) == k:
+                threshold = heap[0][0]
+                while essential < n and _below(prefix[essential], threshold):
+                    essential += 1
+                    walked = [cursors[j] for j in order[essential:]]
+
+        for cursor in walked:
+            if cursor.doc == doc:
+                cursor.next()
+
+    return [(doc, doc_score) for doc_score, _, doc in sorted(heap, reverse=True)]
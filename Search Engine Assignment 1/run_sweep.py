@@ -0,0 +1,132 @@
+import argparse
+import itertools
+import multiprocessing
+import os
+import time
+import generate_results as gr
+import ir_eval
+
+# Parallel run generation for parameter sweeps
+#
+# Every configuration (VSM, BM25 for each k1 x b, LM for each lambda) is split into
+# chunks of queries that a process pool ranks in parallel. The workers are forked
+# after generate_results has loaded the index, so they share its memory-mapped
+# index and the pages of the loaded JSON data instead of loading their own copies.
+# Each configuration gets one TREC run file in --output-dir, byte-identical to the
+# file generate_results.py writes for the same parameters, and the time spent per
+# model is printed and saved to summary.txt. Every run is also evaluated in-process
+# against the qrels (see ir_eval.py), with no trec_eval round trip per grid point.
+#
+#   python run_sweep.py --k1 1.2 2.0 2.9 --b 0.3 0.75 --lambda 0.5 0.7
+
+QUERY_FILE = os.path.join("cranfield-trec-dataset-main", "cranfield-trec-dataset-main", "cran.qry.xml")
+QRELS_FILE = os.path.join("trec_eval-9.0.7", "trec_eval-9.0.7", "cranqrel.trec.txt")
+CHUNK_SIZE = 16  # Queries per task
+
+# [(model, params, run file name)] for a parameter grid
+def configurations(models, k1_values, b_values, lambda_values):
+    configs = []
+    if "vsm" in models:
+        configs.append(("vsm", {}, "vsm_results.txt"))
+    if "bm25" in models:
+        for k1, b in itertools.product(k1_values, b_values):
+            configs.append(("bm25", {"k1": k1, "b": b}, f"bm25_k1={k1:g}_b={b:g}.txt"))
+    if "lm" in models:
+        for lambda_smooth in lambda_values:
+            configs.append(("lm", {"lambda_smooth": lambda_smooth}, f"lm_lambda={lambda_smooth:g}.txt"))
+    return configs
+
+# Run file lines for a chunk of queries under one configuration, and the seconds it took
+def run_chunk(task):
+    config_index, chunk_index, model, params, queries = task
+    start = time.perf_counter()
+    lines = []
+    for query_id, query_text in queries:
+        query_terms, weights = gr.expand_query(query_text.split())
+        lines.extend(gr.run_lines(query_id, gr.rank_query(model, query_terms, weights, **params), gr.RUN_TAGS[model]))
+    return config_index, chunk_index, lines, time.perf_counter() - start
+
+def run_sweep(queries, configs, output_dir, workers=None, chunk_size=CHUNK_SIZE):
+    queries = list(queries.items())
+    chunks = [queries[i:i + chunk_size] for i in range(0, len(queries), chunk_size)]
+    tasks = [(c, i, model, params, chunk) for c, (model, params, _) in enumerate(configs) for i, chunk in enumerate(chunks)]
+
+    results = [[None] * len(chunks) for _ in configs]
+    model_seconds = {}
+    start = time.perf_counter()
+    if workers == 1:
+        outputs = map(run_chunk, tasks)
+        pool = None
+    else:
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context("fork" if "fork" in methods else None)
+        pool = context.Pool(workers)
+        outputs = pool.imap_unordered(run_chunk, tasks)
+    try:
+        for config_index, chunk_index, lines, seconds in outputs:
+            results[config_index][chunk_index] = lines
+            model = configs[config_index][0]
+            model_seconds[model] = model_seconds.get(model, 0) + seconds
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    wall_time = time.perf_counter() - start
+
+    os.makedirs(output_dir, exist_ok=True)
+    runs = []
+    for (_, _, name), chunk_lines in zip(configs, results):
+        lines = [line for lines in chunk_lines for line in lines]
+        with open(os.path.join(output_dir, name), "w") as f:
+            f.write("\n".join(lines))
+        runs.append(lines)
+    return runs, model_seconds, wall_time
+
+def summary_table(configs, model_seconds, wall_time, num_queries, workers):
+    counts = {}
+    for model, _, _ in configs:
+        counts[model] = counts.get(model, 0) + 1
+    rows = [f"{'model':<6} {'runs':>5} {'seconds':>10} {'ms/query':>10}"]
+    for model in counts:
+        seconds = model_seconds.get(model, 0)
+        rows.append(f"{model:<6} {counts[model]:>5} {seconds:>10.2f} {seconds * 1000 / (counts[model] * num_queries):>10.1f}")
+    rows.append(f"{len(configs)} runs of {num_queries} queries on {workers} workers in {wall_time:.2f}s wall time "
+                f"({sum(model_seconds.values()):.2f}s of ranking)")
+    return "\n".join(rows)
+
+# Measures of every run, best MAP first
+def evaluation_table(configs, runs, qrels, k=10):
+    rows = []
+    for (_, _, name), lines in zip(configs, runs):
+        metrics = ir_eval.evaluate(qrels, ir_eval.rank_run(ir_eval.parse_run(lines)), (k,))
+        rows.append((metrics["map"], name, metrics))
+    rows.sort(key=lambda row: row[0], reverse=True)
+    table = [f"{'run':<28} {'MAP':>7} {f'P@{k}':>7} {f'nDCG@{k}':>8} {f'R@{k}':>7} {'MRR':>7}"]
+    for _, name, metrics in rows:
+        table.append(f"{name:<28} {metrics['map']:>7.4f} {metrics[f'P_{k}']:>7.4f} {metrics[f'ndcg_cut_{k}']:>8.4f} "
+                     f"{metrics[f'recall_{k}']:>7.4f} {metrics['recip_rank']:>7.4f}")
+    return "\n".join(table)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate TREC run files for a grid of model parameters in parallel")
+    parser.add_argument("--queries", default=QUERY_FILE)
+    parser.add_argument("--models", nargs="+", default=list(gr.RUN_TAGS), choices=list(gr.RUN_TAGS))
+    parser.add_argument("--k1", type=float, nargs="+", default=[gr.k1])
+    parser.add_argument("--b", type=float, nargs="+", default=[gr.b])
+    parser.add_argument("--lambda", dest="lambda_values", type=float, nargs="+", default=[gr.lambda_smooth])
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="1 to run serially in this process")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    parser.add_argument("--output-dir", default="runs")
+    parser.add_argument("--qrels", default=QRELS_FILE, help="Qrels to evaluate the runs against; empty to skip")
+    args = parser.parse_args()
+
+    queries = gr.parse_queries(args.queries)
+    configs = configurations(args.models, args.k1, args.b, args.lambda_values)
+    runs, model_seconds, wall_time = run_sweep(queries, configs, args.output_dir, args.workers, args.chunk_size)
+
+    summary = summary_table(configs, model_seconds, wall_time, len(queries), args.workers)
+    if args.qrels:
+        summary += "\n\n" + evaluation_table(configs, runs, ir_eval.read_qrels(args.qrels))
+    print(summary)
+    with open(os.path.join(args.output_dir, "summary.txt"), "w") as f:
+        f.write(summary + "\n")
@@ -0,0 +1,31 @@
+import xml.etree.ElementTree as ET
+
+# Streaming reader for TREC-style collections such as cran.all.1400.xml: a sequence
+# of <doc> elements with no enclosing root element. The file is fed to a pull parser
+# in chunks, inside a made-up root, and every <doc> is handed on and dropped as soon
+# as its end tag has been read, so memory use doesn't grow with the collection.
+
+CHUNK_SIZE = 1 << 16  # Characters read at a time
+
+# (docno, text) of every document, the text being `fields` joined by spaces
+def iter_documents(path, fields=("title", "text"), chunk_size=CHUNK_SIZE):
+    parser = ET.XMLPullParser(events=("start", "end"))
+    parser.feed("<root>")
+    root = None
+    with open(path, "r", encoding="utf-8") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            parser.feed(chunk if chunk else "</root>")
+            for event, element in parser.read_events():
+                if event == "start":
+                    if root is None:
+                        root = element
+                elif element.tag == "doc":
+                    docno = element.findtext("docno")
+                    doc_id = docno.strip() if docno is not None else "Unknown"
+                    texts = (element.findtext(field) for field in fields)
+                    yield doc_id, " ".join(text.strip() if text else "" for text in texts)
+                    root.clear()
+            if not chunk:
+                parser.close()
+                return
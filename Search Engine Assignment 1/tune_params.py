@@ -0,0 +1,173 @@
+import argparse
+import time
+import numpy as np
+import generate_results as gr
+import ir_eval
+import tuning
+from run_sweep import QUERY_FILE, QRELS_FILE
+
+# Tuning k1 and b for BM25 and lambda_smooth for LM against the Cranfield qrels
+#
+# Scores only depend on the parameters through a few statistics, which are read from
+# the index once for every query: for each (query term, candidate document) pair the
+# length-normalised TF and the document length, and for each query term its weight,
+# df, IDF and corpus probability. Queries are expanded once: the first pass of the
+# expansion has its own BM25 parameters (feedback_params in generate_results.py),
+# which tuning leaves as they are, so a run expands queries the same way. Every
+# setting is then scored for all queries at once with the same arithmetic as
+# generate_results.py (bm25_term_score, lm_term_score), adding up terms in query
+# order, so the scores match a run to the last digit. The rankings are evaluated the
+# way trec_eval reads a run file: scores rounded to the 4 printed decimals, ties by
+# document ID in reverse.
+#
+#   python tune_params.py --models bm25 lm --metric map
+#
+# writes the best setting of every measure to ranking_params.json, and the one for
+# --metric becomes the parameters generate_results.py and run_sweep.py use. The
+# first-pass parameters are saved with them, and the chosen setting is checked
+# against a run of generate_results.py with it.
+
+K1_VALUES = [0.4, 0.8, 1.2, 1.6, 2.0, 2.4, 2.8, 3.2]
+B_VALUES = [0.0, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0]
+LAMBDA_VALUES = [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9]
+# Valid values of each parameter; the search may go past the grid within them
+DOMAINS = {"k1": (0.01, None), "b": (0.0, 1.0), "lambda_smooth": (0.01, 0.99)}
+METRICS = ("map", "ndcg_cut_10", "P_10", "recall_10", "recip_rank")
+
+# Term statistics of every query, as flat arrays
+#
+#   per query term: query row, position in the query, weight, df, IDF, corpus probability
+#   per posting:    query term (index into the above), document ordinal, TF, document length
+def query_statistics(queries):
+    term_rows, term_positions, term_weights, dfs, idfs, corpus_probs = [], [], [], [], [], []
+    entry_terms, docs, counts = [], [], []
+    for row, query_text in enumerate(queries):
+        query_terms, weights = gr.expand_query(query_text.split())
+        for position, term in enumerate(query_terms):
+            postings = gr.index.postings(term)
+            slot = len(term_rows)
+            term_rows.append(row)
+            term_positions.append(position)
+            term_weights.append(weights[position] if weights else 1)
+            dfs.append(len(postings))
+            idfs.append(gr.compute_idf(term))
+            corpus_probs.append(gr.prob_w_given_corpus.get(term, 1e-6))
+            entry_terms.extend([slot] * len(postings))
+            docs.extend(doc for doc, _ in postings)
+            counts.extend(count for _, count in postings)
+
+    lengths = np.array(gr.index.doc_lengths, dtype=np.float64)
+    docs = np.array(docs, dtype=np.int64)
+    entry_terms = np.array(entry_terms, dtype=np.int64)
+    term_rows = np.array(term_rows, dtype=np.int64)
+    return {
+        "term_rows": term_rows,
+        "term_positions": np.array(term_positions, dtype=np.int64),
+        "weight": np.array(term_weights, dtype=np.float64),
+        "df": np.array(dfs, dtype=np.int64),
+        "idf": np.array(idfs),
+        "corpus_prob": np.array(corpus_probs),
+        "entry_terms": entry_terms,
+        "entry_rows": term_rows[entry_terms],
+        "docs": docs,
+        "tf": np.array(counts, dtype=np.float64) / lengths[docs],
+        "length": lengths[docs],
+    }
+
+# Measures of a run of `model` with `params`, ranked by generate_results.py and read
+# back as trec_eval reads the run file
+def run_measures(model, params, queries, qrels):
+    lines = []
+    for query_id, query_text in queries.items():
+        query_terms, weights = gr.expand_query(query_text.split())
+        lines.extend(gr.run_lines(query_id, gr.rank_query(model, query_terms, weights, **params), gr.RUN_TAGS[model]))
+    return ir_eval.evaluate(qrels, ir_eval.rank_run(ir_eval.parse_run(lines)))
+
+class ScoreTuner:
+    def __init__(self, stats, num_queries, num_docs):
+        self.stats = stats
+        self.shape = (num_queries, num_docs)
+        # Query terms and postings by position in the query, to add them up in query order
+        positions = stats["term_positions"]
+        entry_positions = positions[stats["entry_terms"]]
+        self.by_position = [(np.flatnonzero(positions == position), np.flatnonzero(entry_positions == position))
+                            for position in range(positions.max() + 1 if len(positions) else 0)]
+
+    # Scores of every document: the sum, in query order, of each term's score in the
+    # documents it occurs in and `background` (per query term) in the others
+    def _accumulate(self, entry_scores, background=None):
+        stats = self.stats
+        scores = np.zeros(self.shape)
+        for terms, entries in self.by_position:
+            term_scores = np.zeros(self.shape)
+            if background is not None:
+                term_scores[stats["term_rows"][terms]] = background[terms, None]
+            term_scores[stats["entry_rows"][entries], stats["docs"][entries]] = entry_scores[entries]
+            scores += term_scores
+        return scores
+
+    def bm25(self, k1, b):
+        stats = self.stats
+        idf = stats["idf"][stats["entry_terms"]]
+        weight = stats["weight"][stats["entry_terms"]]
+        return self._accumulate(gr.bm25_term_score(idf, stats["tf"], stats["length"], k1, b) * weight)
+
+    def lm(self, lambda_smooth):
+        stats = self.stats
+        # lm_term_score: lambda * P(w|d) + (1 - lambda) * P(w|C), with P(w|d) = tf / length
+        corpus_prob = stats["corpus_prob"]
+        p_w_given_d = stats["tf"] / stats["length"]
+        entry_scores = np.log(lambda_smooth * p_w_given_d + (1 - lambda_smooth) * corpus_prob[stats["entry_terms"]] + 1e-6)
+        background = np.log((1 - lambda_smooth) * corpus_prob + 1e-6) * stats["weight"]
+        return self._accumulate(entry_scores * stats["weight"][stats["entry_terms"]], background)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tune BM25 and LM parameters against the qrels")
+    parser.add_argument("--queries", default=QUERY_FILE)
+    parser.add_argument("--qrels", default=QRELS_FILE)
+    parser.add_argument("--models", nargs="+", default=["bm25", "lm"], choices=["bm25", "lm"])
+    parser.add_argument("--k1", type=float, nargs="+", default=K1_VALUES)
+    parser.add_argument("--b", type=float, nargs="+", default=B_VALUES)
+    parser.add_argument("--lambda", dest="lambda_values", type=float, nargs="+", default=LAMBDA_VALUES)
+    parser.add_argument("--rounds", type=int, default=2, help="Rounds of finer grids around the best settings")
+    parser.add_argument("--metric", default="map", choices=METRICS, help="Measure the saved parameters are chosen for")
+    parser.add_argument("--output", default=tuning.PARAMS_FILE)
+    args = parser.parse_args()
+
+    queries = gr.parse_queries(args.queries)
+    qrels = ir_eval.read_qrels(args.qrels)
+    query_ids = sorted(query_id for query_id in queries if query_id in qrels)
+
+    start = time.perf_counter()
+    doc_ids = list(gr.index.doc_ids)
+    stats = query_statistics([queries[query_id] for query_id in query_ids])
+    tuner = ScoreTuner(stats, len(query_ids), len(doc_ids))
+    positions = {doc_id: position for position, doc_id in enumerate(doc_ids)}
+    judged, ideal, num_rel = tuning.judgements(qrels, query_ids, len(doc_ids), positions.get)
+    # trec_eval breaks ties by document ID in reverse
+    tie_rank = np.argsort(np.argsort(doc_ids)[::-1])
+    print(f"Statistics of {len(query_ids)} queries ({len(stats['docs'])} postings) in {time.perf_counter() - start:.2f}s")
+
+    grids = {"bm25": {"k1": args.k1, "b": args.b}, "lm": {"lambda_smooth": args.lambda_values}}
+    for model in args.models:
+        score = getattr(tuner, model)
+
+        def evaluate_setting(**params):
+            return tuning.evaluate_scores(score(**params), tie_rank, judged, ideal, num_rel, decimals=4)
+
+        start = time.perf_counter()
+        results, best = tuning.search(evaluate_setting, grids[model], METRICS, args.rounds, DOMAINS)
+        elapsed = time.perf_counter() - start
+        print(f"\n{model}: {len(results)} settings in {elapsed:.2f}s ({elapsed * 1000 / len(results):.1f} ms each)")
+        names = list(grids[model])
+        for metric, setting in best.items():
+            described = ", ".join(f"{name}={value:g}" for name, value in zip(names, setting))
+            print(f"  best {metric:<12} {results[setting][metric]:.4f}  {described}")
+        tuning.save_params(model, names, results, best, args.metric, args.output)
+
+        setting = dict(zip(names, best[args.metric]))
+        measured = run_measures(model, setting, queries, qrels)[args.metric]
+        assert abs(measured - results[best[args.metric]][args.metric]) < 1e-9, \
+            f"{model}: a run with the best {args.metric} setting scores {measured:.4f}, not {results[best[args.metric]][args.metric]:.4f}"
+    tuning.save_fixed_params("feedback", gr.feedback_params, args.output)
+    print(f"\nSaved the best {args.metric} settings to {args.output}")
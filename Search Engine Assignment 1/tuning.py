@@ -0,0 +1,121 @@
+import itertools
+import json
+import os
+import numpy as np
+import ir_eval
+
+# Tuning ranking model parameters against relevance judgements
+#
+# A tuner gathers once everything its model's scores depend on apart from the
+# parameters (term statistics of every query and candidate document), and hands
+# search() a function that scores all queries for one setting with NumPy, as a
+# (queries x documents) matrix. Each setting is then ranked and evaluated in memory
+# (see ir_eval.py), which takes milliseconds instead of a run per setting.
+#
+# The best setting of each measure is saved to ranking_params.json, from which the
+# scorers read their parameters:
+#
+#   {"bm25": {"k1": 1.2, "b": 0.75, "tuned_for": "map", "best": {"map": {...}, ...}}, ...}
+
+PARAMS_FILE = "ranking_params.json"
+
+# Parameters of `model` saved by a tuner, or `defaults` for the ones it hasn't saved
+def load_params(model, defaults, path=PARAMS_FILE):
+    if not os.path.exists(path):
+        return dict(defaults)
+    with open(path, "r", encoding="utf-8") as f:
+        saved = json.load(f).get(model, {})
+    return {name: saved.get(name, value) for name, value in defaults.items()}
+
+# Relevance of every document to every query, with the ideal gains and number of
+# relevant documents of each query. `find_doc` gives a document ID's column, or None.
+def judgements(qrels, query_ids, num_docs, find_doc, relevance_level=1):
+    judged = np.zeros((len(query_ids), num_docs))
+    for row, query_id in enumerate(query_ids):
+        for doc_id, relevance in qrels[query_id].items():
+            position = find_doc(doc_id)
+            if position is not None:
+                judged[row, position] = relevance
+    ideal, num_rel = ir_eval.ideal_gains(qrels, query_ids, num_docs, relevance_level)
+    return judged, ideal, num_rel
+
+# Measures of a matrix of scores, ranked by score and then by `tie_rank`, lowest
+# first. Documents scoring -inf aren't retrieved. With `decimals`, scores are rounded
+# first, as trec_eval reads them from a run file.
+def evaluate_scores(scores, tie_rank, judged, ideal, num_rel, k_values=ir_eval.K_VALUES, depth=None, decimals=None):
+    if decimals is not None:
+        scores = np.round(scores, decimals)
+    order = np.lexsort((np.broadcast_to(tie_rank, scores.shape), -scores), axis=-1)[:, :depth]
+    gains = np.take_along_axis(judged, order, axis=1)
+    gains[np.take_along_axis(scores, order, axis=1) == -np.inf] = 0
+    return ir_eval.average(ir_eval.measures(gains, ideal, num_rel, k_values))
+
+# Coarse-to-fine search over {parameter: [values]}: every setting of the grid, then
+# `rounds` of 3 x 3 ... grids around the best setting of each measure, halving the
+# spacing each round. A best value on the edge of the values tried so far is
+# stepped past by the grid's full spacing instead, so an optimum outside the grid
+# is followed. Values stay within `domains`, {parameter: (lowest, highest)}, where
+# None is unbounded. A warning is printed for every best value left on the edge of
+# the values tried or on a limit of its domain. Returns the measures of every
+# setting tried and the best setting of each measure.
+def search(evaluate_setting, grid, metrics, rounds=2, domains=None):
+    names = list(grid)
+    grid_steps = [min(np.diff(sorted(set(values))), default=0.0) for values in grid.values()]
+    steps = list(grid_steps)
+    limits = [(domains or {}).get(name, (None, None)) for name in names]
+
+    def clamp(value, low, high):
+        if low is not None:
+            value = max(value, low)
+        if high is not None:
+            value = min(value, high)
+        return round(value, 6)
+
+    results = {}
+    pending = list(itertools.product(*grid.values()))
+    for _ in range(rounds + 1):
+        for setting in pending:
+            if setting not in results:
+                results[setting] = evaluate_setting(**dict(zip(names, setting)))
+        best = {metric: max(results, key=lambda setting: results[setting][metric]) for metric in metrics}
+
+        tried = [(min(values), max(values)) for values in zip(*results)]
+        steps = [step / 2 for step in steps]
+        pending = []
+        for setting in best.values():
+            around = []
+            for value, step, grid_step, (lowest, highest), (low, high) in zip(setting, steps, grid_steps, tried, limits):
+                below = value - (grid_step if value == lowest else step)
+                above = value + (grid_step if value == highest else step)
+                around.append([clamp(below, low, high), value, clamp(above, low, high)])
+            pending.extend(itertools.product(*around))
+
+    for metric, setting in best.items():
+        for name, value, (lowest, highest), (low, high) in zip(names, setting, tried, limits):
+            if value in (low, high):
+                print(f"Warning: the best {metric} setting has {name}={value:g}, the limit of its valid range; "
+                      f"the scores may still improve past it")
+            elif value in (lowest, highest):
+                print(f"Warning: the best {metric} setting has {name}={value:g}, the edge of the values tried; "
+                      f"the optimum may lie further out")
+    return results, best
+
+# Saving the best settings of `model`, the one chosen for `metric` as its parameters,
+# next to those of the other models already in the file
+def save_params(model, names, results, best, metric, path=PARAMS_FILE):
+    entry = dict(zip(names, best[metric]))
+    entry["tuned_for"] = metric
+    entry["best"] = {measure: {**dict(zip(names, setting)), measure: round(results[setting][measure], 4)}
+                     for measure, setting in best.items()}
+    save_fixed_params(model, entry, path)
+
+# Saving parameters that were held fixed while tuning, e.g. those of a first pass the
+# tuned scores depend on, so that the scorers keep using them
+def save_fixed_params(model, entry, path=PARAMS_FILE):
+    params = {}
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            params = json.load(f)
+    params[model] = entry
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(params, f, indent=4)
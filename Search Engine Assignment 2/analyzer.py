@@ -0,0 +1,78 @@
+import re
+
+# Text analysis shared by indexing and querying
+#
+# Text is lowercased and split into runs of letters and digits, stopwords are
+# dropped and, optionally, the remaining tokens are Porter-stemmed. Stems are
+# memoised per token in a dict, so each distinct word is stemmed once however often
+# it occurs, in one text or across the batch given to analyze_many().
+#
+# An index records the configuration it was analysed with (Analyzer.config()), and
+# queries are analysed with Analyzer.from_config() on that record, so index-time and
+# query-time analysis can't drift apart.
+
+TOKEN_PATTERN = re.compile(r"[^\W_]+")  # Letters and digits, as str.isalnum
+
+# NLTK's English stopwords, less the contractions the tokenizer splits anyway
+STOPWORD_LISTS = {
+    "english": frozenset("""
+        i me my myself we our ours ourselves you your yours yourself yourselves he him his himself
+        she her hers herself it its itself they them their theirs themselves what which who whom
+        this that these those am is are was were be been being have has had having do does did
+        doing a an the and but if or because as until while of at by for with about against between
+        into through during before after above below to from up down in out on off over under again
+        further then once here there when where why how all any both each few more most other some
+        such no nor not only own same so than too very s t can will just don should now d ll m o re
+        ve y ain aren couldn didn doesn hadn hasn haven isn ma mightn mustn needn shan shouldn wasn
+        weren won wouldn
+    """.split()),
+    "none": frozenset(),
+}
+STEM_CACHE_SIZE = 1 << 18  # Distinct tokens whose stems are kept
+
+# {token: stem}, stemming tokens on first lookup; once full, new tokens are stemmed without being kept
+class StemCache(dict):
+    def __init__(self, stem, maxsize=STEM_CACHE_SIZE):
+        super().__init__()
+        self.stem = stem
+        self.maxsize = maxsize
+
+    def __missing__(self, token):
+        stem = self.stem(token)
+        if len(self) < self.maxsize:
+            self[token] = stem
+        return stem
+
+class Analyzer:
+    def __init__(self, stopwords="english", stem=False):
+        self.stopwords = stopwords
+        self.stem = stem
+        self._stopwords = STOPWORD_LISTS[stopwords]
+        if stem:
+            from nltk.stem import PorterStemmer
+            self._stems = StemCache(PorterStemmer().stem)
+
+    # Settings to store with an index, and the analyzer they describe
+    def config(self):
+        return {"stopwords": self.stopwords, "stem": self.stem}
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(**(config or {}))
+
+    def tokens(self, text):
+        stopwords = self._stopwords
+        return [token for token in TOKEN_PATTERN.findall(text.lower()) if token not in stopwords]
+
+    def analyze(self, text):
+        tokens = self.tokens(text)
+        if self.stem:
+            stems = self._stems
+            tokens = [stems[token] for token in tokens]
+        return tokens
+
+    def analyze_many(self, texts):
+        if not self.stem:
+            return [self.tokens(text) for text in texts]
+        stems = self._stems
+        return [[stems[token] for token in self.tokens(text)] for text in texts]
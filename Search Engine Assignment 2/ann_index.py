@@ -0,0 +1,146 @@
+import json
+import os
+import numpy as np
+from binary_index import open_sections, write_sections
+from embedding_store import EmbeddingStore, top_k
+from segment_index import indexed_urls
+
+# IVF (inverted file) index for approximate nearest neighbour search over the
+# unit-length CLIP image embeddings. Spherical k-means splits the embeddings into
+# lists around a set of centroids; a query is scored against the centroids and
+# only the vectors in the n_probe closest lists are compared with it exactly.
+#
+# `<prefix>.ivf` is written with write_sections and memory-mapped when opened:
+#
+#   meta          JSON object: n_lists, dim, n_probe
+#   centroids     float32 matrix of unit-length centroids (n_lists x dim)
+#   list_offsets  u64 start of each list in `list_rows` (n_lists + 1 entries)
+#   list_rows     u32 embedding rows, grouped by list
+
+N_PROBE = 8  # Lists scanned per query by default
+_CHUNK = 65536  # Rows assigned to centroids at a time during training
+
+def _nearest_centroids(vectors, centroids):
+    assignment = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), _CHUNK):
+        block = np.asarray(vectors[start:start + _CHUNK], dtype=np.float32)
+        assignment[start:start + _CHUNK] = np.argmax(block @ centroids.T, axis=1)
+    return assignment
+
+# Spherical k-means; returns the centroids and the list each vector belongs to
+def train_ivf(vectors, n_lists=None, n_iter=20, seed=0):
+    n_lists = n_lists or max(1, int(np.sqrt(len(vectors))))
+    n_lists = min(n_lists, len(vectors))
+    rng = np.random.default_rng(seed)
+    centroids = np.asarray(vectors[np.sort(rng.choice(len(vectors), n_lists, replace=False))], dtype=np.float32)
+
+    for _ in range(n_iter):
+        assignment = _nearest_centroids(vectors, centroids)
+        sums = np.zeros_like(centroids)
+        for start in range(0, len(vectors), _CHUNK):
+            np.add.at(sums, assignment[start:start + _CHUNK], np.asarray(vectors[start:start + _CHUNK], dtype=np.float32))
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        empty = norms[:, 0] == 0
+        centroids = sums / np.where(norms > 0, norms, 1)
+        # Reseeding empty lists with random vectors
+        if empty.any():
+            centroids[empty] = np.asarray(vectors[rng.choice(len(vectors), int(empty.sum()), replace=False)], dtype=np.float32)
+
+    return centroids, _nearest_centroids(vectors, centroids)
+
+class IVFIndex:
+    def __init__(self, centroids, list_offsets, list_rows, vectors, n_probe=N_PROBE):
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.list_rows = list_rows
+        self.vectors = vectors
+        self.n_probe = n_probe
+
+    # Lists of the given rows of `vectors` (all of them by default). Without any rows
+    # the index has no lists, and finds nothing.
+    @classmethod
+    def build(cls, vectors, n_lists=None, n_probe=N_PROBE, rows=None, **kwargs):
+        if len(vectors if rows is None else rows) == 0:
+            centroids, assignment = np.zeros((0, vectors.shape[1]), dtype=np.float32), np.zeros(0, dtype=np.int64)
+        else:
+            centroids, assignment = train_ivf(vectors if rows is None else vectors[rows], n_lists, **kwargs)
+        return cls._from_assignment(centroids, assignment, vectors, n_probe, rows)
+
+    # Lists of the given rows of `vectors` around existing centroids, without training
+    @classmethod
+    def relist(cls, centroids, vectors, n_probe=N_PROBE, rows=None):
+        assignment = _nearest_centroids(vectors if rows is None else vectors[rows], centroids)
+        return cls._from_assignment(centroids, assignment, vectors, n_probe, rows)
+
+    @classmethod
+    def _from_assignment(cls, centroids, assignment, vectors, n_probe, rows):
+        list_rows = np.argsort(assignment, kind="stable").astype(np.uint32)
+        if rows is not None:
+            list_rows = np.asarray(rows, dtype=np.uint32)[list_rows]
+        list_offsets = np.zeros(len(centroids) + 1, dtype=np.uint64)
+        list_offsets[1:] = np.cumsum(np.bincount(assignment, minlength=len(centroids)))
+        return cls(centroids, list_offsets, list_rows, vectors, n_probe)
+
+    @classmethod
+    def open(cls, path, vectors):
+        sections = open_sections(path)
+        meta = json.loads(bytes(sections["meta"]))
+        centroids = np.frombuffer(sections["centroids"], dtype="<f4").reshape(meta["n_lists"], meta["dim"])
+        list_offsets = np.frombuffer(sections["list_offsets"], dtype="<u8")
+        list_rows = np.frombuffer(sections["list_rows"], dtype="<u4")
+        return cls(centroids, list_offsets, list_rows, vectors, meta["n_probe"])
+
+    def save(self, path):
+        meta = {"n_lists": len(self.centroids), "dim": self.centroids.shape[1], "n_probe": self.n_probe}
+        write_sections(path, [
+            ("meta", json.dumps(meta).encode("utf-8")),
+            ("centroids", np.asarray(self.centroids, dtype="<f4").tobytes()),
+            ("list_offsets", np.asarray(self.list_offsets, dtype="<u8").tobytes()),
+            ("list_rows", np.asarray(self.list_rows, dtype="<u4").tobytes()),
+        ])
+
+    # Approximate top-k rows for a unit-length query, with their cosine similarities
+    def search(self, query_vector, k, n_probe=None):
+        query_vector = np.asarray(query_vector, dtype=np.float32)
+        if not len(self.centroids):
+            return np.zeros(0, dtype=np.uint32), np.zeros(0, dtype=np.float32)
+        n_probe = min(n_probe or self.n_probe, len(self.centroids))
+        lists = top_k(self.centroids @ query_vector, n_probe)
+        rows = np.sort(np.concatenate([self.list_rows[int(self.list_offsets[l]):int(self.list_offsets[l + 1])] for l in lists]))
+        scores = np.asarray(self.vectors[rows], dtype=np.float32) @ query_vector
+        best = top_k(scores, k)
+        return rows[best], scores[best]
+
+# Building the IVF index for the embedding store written by embed_images.py, over
+# the embeddings of the images in `keep` if given. The store also keeps embeddings
+# of images that aren't indexed, such as the near-duplicates dedup.py compares
+# them with, which dense retrieval has no use for.
+def build_ivf_file(prefix="image_embeddings", n_lists=None, keep=None):
+    store = EmbeddingStore(prefix)
+    ivf = IVFIndex.build(store.vectors, n_lists, rows=_rows(store, keep))
+    ivf.save(prefix + ".ivf")
+    return ivf
+
+# Updating the IVF index after a crawl delta: the embeddings of the images in
+# `keep` are listed again around the centroids it has, which is much quicker than
+# training them. The index is built if there is none, or it has no lists.
+def update_ivf_file(prefix="image_embeddings", keep=None):
+    if not os.path.exists(prefix + ".ivf"):
+        return build_ivf_file(prefix, keep=keep)
+    store = EmbeddingStore(prefix)
+    old = IVFIndex.open(prefix + ".ivf", store.vectors)
+    if not len(old.centroids):
+        return build_ivf_file(prefix, keep=keep)
+    ivf = IVFIndex.relist(np.array(old.centroids), store.vectors, old.n_probe, _rows(store, keep))
+    ivf.save(prefix + ".ivf")
+    return ivf
+
+# Embedding rows of the images in `keep`, or None for all of them
+def _rows(store, keep):
+    if keep is None:
+        return None
+    return sorted(row for row in map(store.row, keep) if row is not None)
+
+if __name__ == "__main__":
+    ivf = build_ivf_file(keep=indexed_urls())
+    print(f"Saved IVF index with {len(ivf.centroids)} lists over {len(ivf.list_rows)} embeddings to image_embeddings.ivf")
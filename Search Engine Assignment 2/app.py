@@ -1,18 +1,23 @@
-from flask import Flask, render_template, request
-import json
+from flask import Flask, jsonify, render_template, request
 import math
 import torch
 import clip
 import numpy as np
 from PIL import Image
-from collections import defaultdict
-import nltk
-from nltk.tokenize import word_tokenize
-from nltk.corpus import stopwords
 import re
-
-nltk.download('punkt')
-nltk.download('stopwords')
+import os
+import heapq
+import threading
+from collections import namedtuple
+from segment_index import SegmentedIndex
+from embedding_store import EmbeddingStore
+from ann_index import IVFIndex
+from search_cache import FileWatcher, LRUCache, normalize_query
+from micro_batcher import MicroBatcher
+from image_cache import CACHE_DIR, THUMBNAIL_DIR, ImageCache
+from pruning import max_score_top_k
+from tuning import load_params
+from analyzer import Analyzer
 
 app = Flask(__name__)
 
@@ -20,155 +25,391 @@ app = Flask(__name__)
 device = "cuda" if torch.cuda.is_available() else "cpu"
 model, preprocess = clip.load("ViT-B/32", device=device)
 
-# Load data
-with open("image_surrogates.json", "r", encoding="utf-8") as f:
-    documents = json.load(f)
-
-with open("index/inverted_index.json", "r", encoding="utf-8") as f:
-    inverted_index = json.load(f)
-
-with open("index/tf_index.json", "r", encoding="utf-8") as f:
-    tf_index = json.load(f)
-
-with open("index/bm25_data.json", "r", encoding="utf-8") as f:
-    bm25_data = json.load(f)
-
-with open("image_embeddings.json", "r", encoding="utf-8") as f:
-    image_embeddings = json.load(f)
-
-# Map image_url to embedding
-embedding_dict = {img["image_url"]: np.array(img["embedding"]) for img in image_embeddings}
-
-stop_words = set(stopwords.words('english'))
-
-doc_lengths = bm25_data["doc_lengths"]
-avg_doc_length = bm25_data["avg_doc_length"]
-N = len(documents)
-k1 = 2.9
-b = 0.3
-
-def preprocess(text):
-    tokens = word_tokenize(text.lower())
-    return [t for t in tokens if t.isalnum() and t not in stop_words]
-
-def compute_idf(term):
-    df = len(inverted_index.get(term, []))
-    return math.log(1 + (N / (df + 1))) if df > 0 else 0.1
-
-def clean_display_title(text):
-    blacklist = {
-        "a", "an", "the", "close", "view", "photo", "image", "standing", "in", "on", "by",
-        "bush", "area", "kruger", "park", "wildlife", "zoo", "africa"
-    }
-    words = text.lower().strip().split()
-    filtered = [word for word in words if word not in blacklist]
-    if not filtered:
-        return text.title()
-    final_words = filtered[:3]
-    return " ".join(w.capitalize() for w in final_words)
-
-def cosine_similarity(a, b):
-    a = a / np.linalg.norm(a)
-    b = b / np.linalg.norm(b)
-    return np.dot(a, b)
-
-def bm25_search(query, top_k=20):
-    query_terms = preprocess(query)
-    scores = defaultdict(float)
-
-    for term in query_terms:
-        if term not in inverted_index:
-            continue
-        idf_score = compute_idf(term)
-        for doc_id in inverted_index[term]:
-            tf = tf_index.get(doc_id, {}).get(term, 0)
-            doc_len = doc_lengths.get(doc_id, 0)
-            numerator = tf * (k1 + 1)
-            denominator = tf + k1 * (1 - b + b * doc_len / avg_doc_length)
-            scores[doc_id] += idf_score * (numerator / (denominator + 1e-6))
-
-    ranked = sorted(scores.items(), key=lambda x: x[1], reverse=True)[:5]
-
-    # Group and pick best image per source page
-    grouped = defaultdict(list)
-    for doc_id, score in ranked:
-        doc = documents[int(doc_id)]
-        key = (doc["title"], doc["source_page"])
-        doc["score"] = round(score, 4)
-        grouped[key].append(doc)
-
-    results = []
-    for group in grouped.values():
-        def image_score(d):
-            alt = d.get("alt_text", "").lower()
-            filename = d.get("image_url", "").split("/")[-1].lower()
-            score = 0
-            if any(x in alt for x in ["animal", "photo", "rabbit", "turtle", "mouse", "hyena", "elephant", "lion"]):
-                score += 2
-            score += len(alt) * 0.5
-            if any(x in filename for x in ["animal", "jpg", "jpeg", "leopard", "frog", "owl", "elephant"]):
-                score += 1
-            return score
-
-        best = max(group, key=image_score)
-
-        # Fallback logic for display title
-        alt = best.get("alt_text", "").strip()
-        animal_name = best.get("animal_name", "").strip()
-        title = best.get("title", "").strip()
-        query_lower = query.lower()
-
-        if query_lower in alt.lower() and len(alt.split()) >= 2:
-            best["display_title"] = alt
-        elif query_lower in animal_name.lower():
-            best["display_title"] = query.capitalize()
+# Load data (memory-mapped, so workers forked from this process share the pages)
+# Segment files never change, so the manifest tells when the index has been updated
+DATA_FILES = ["index/segments.json", "image_embeddings.npy", "image_embeddings.idx", "image_embeddings.ivf"]
+
+# Everything a request reads from the data files. A reload opens a new Stores and
+# swaps it in with one assignment, and each request takes the current one once, at
+# the start, so it reads one version of the data throughout.
+Stores = namedtuple("Stores", ["corpus", "analyzer", "embeddings", "dense_index", "N", "avg_doc_length",
+                               "avg_field_lengths", "field_weights"])
+
+def load_stores():
+    corpus = SegmentedIndex("index")
+    # Queries are analysed the way the index was
+    analyzer = Analyzer.from_config(corpus.manifest.get("analyzer"))
+    embeddings = EmbeddingStore("image_embeddings")
+
+    # Dense retrieval uses the IVF index when it has been built, exact search otherwise
+    if os.path.exists("image_embeddings.ivf"):
+        dense_index = IVFIndex.open("image_embeddings.ivf", embeddings.vectors)
+    else:
+        dense_index = embeddings
+
+    # Per-field statistics for BM25F, if the index has them (empty otherwise)
+    avg_field_lengths = [length or 1 for length in corpus.avg_field_lengths]
+    field_weights = [bm25f_params.get(field, 1.0) for field in corpus.fields]
+    return Stores(corpus, analyzer, embeddings, dense_index, len(corpus), corpus.avg_doc_length,
+                  avg_field_lengths, field_weights)
+
+# BM25F parameters and field weights, as tuned by tune_params.py --model bm25f
+bm25f_params = load_params("bm25f", {"k1": 0.8, "b": 0.6, "title": 0.5, "alt_text": 0.5, "filename": 0.5, "animal_name": 4.0})
+
+stores = load_stores()
+RELOAD_CHECK_INTERVAL = 2  # Seconds between checks of DATA_FILES for changes
+data_files = FileWatcher(DATA_FILES, interval=RELOAD_CHECK_INTERVAL)
+
+# Thumbnails kept by the image cache are served from static/images/thumbs
+image_cache = ImageCache(CACHE_DIR, thumbnail_dir=THUMBNAIL_DIR) if os.path.isdir(CACHE_DIR) else None
+reload_lock = threading.Lock()
+
+# Caches keyed by the normalised query. Text embeddings only depend on the CLIP
+# model; result lists are dropped whenever the files in DATA_FILES change on disk.
+CACHE_TTL = 3600  # Seconds
+text_embedding_cache = LRUCache(maxsize=4096, ttl=CACHE_TTL)
+result_cache = LRUCache(maxsize=1024, ttl=CACHE_TTL)
+
+# BM25 parameters, as tuned by tune_params.py (ranking_params.json) if it has been run
+bm25_params = load_params("bm25", {"k1": 2.9, "b": 0.3})
+k1 = bm25_params["k1"]
+b = bm25_params["b"]
+
+SEARCH_MODES = ("bm25", "dense", "hybrid")
+BM25_CANDIDATES = 5  # Images retrieved by BM25 in bm25 and hybrid modes
+DENSE_CANDIDATES = 20  # Source pages whose images are retrieved by CLIP similarity in dense and hybrid modes
+PROXIMITY_DEPTH = 50  # BM25 matches of a multi-word query re-scored with the proximity boost
+PROXIMITY_WINDOW = 5  # Largest distance, in terms, at which two query terms count as near
+PHRASE_PATTERN = re.compile(r'"([^"]*)"')  # Quoted parts of a query must match as phrases
+
+def compute_idf(stores, term):
+    df = stores.corpus.df(term)
+    return math.log(1 + (stores.N / (df + 1))) if df > 0 else 0.1
+
+# Unit-length CLIP text embeddings of a list of queries, from one forward pass
+def encode_texts(queries):
+    text_input = clip.tokenize(queries).to(device)
+    with torch.no_grad():
+        text_features = model.encode_text(text_input).cpu().numpy()
+    return [features / np.linalg.norm(features) for features in text_features]
+
+# Optionally coalescing the CLIP encodes of concurrent requests: with
+# MICRO_BATCH_WAIT_MS set (e.g. 5), queries arriving within that many milliseconds
+# of each other are encoded in one forward pass
+MICRO_BATCH_WAIT_MS = float(os.environ.get("MICRO_BATCH_WAIT_MS", "0"))
+text_batcher = MicroBatcher(encode_texts, max_wait=MICRO_BATCH_WAIT_MS / 1000) if MICRO_BATCH_WAIT_MS > 0 else None
+
+def encode_queries(queries):
+    queries = [normalize_query(query) for query in queries]
+    features = {query: text_embedding_cache.get(query) for query in dict.fromkeys(queries)}
+    missing = [query for query, text_features in features.items() if text_features is None]
+    if missing:
+        encoded = text_batcher.map(missing) if text_batcher else encode_texts(missing)
+        for query, text_features in zip(missing, encoded):
+            text_features.flags.writeable = False  # Shared by every request for this query
+            text_embedding_cache.put(query, text_features)
+            features[query] = text_features
+    return [features[query] for query in queries]
+
+def encode_query(query):
+    return encode_queries([query])[0]
+
+# The stores for a request, reopened, and cached results dropped, after the indexer
+# or embed_images.py has rewritten any of the data files. Requests don't wait on each
+# other: the files are checked without the lock, at most every RELOAD_CHECK_INTERVAL
+# seconds, and the lock is only taken to load and swap in the new stores.
+def reload_if_changed():
+    global stores
+    if data_files.changed():
+        with reload_lock:
+            stores = load_stores()
+            result_cache.clear()
+    return stores
+
+# BM25 contribution of a term with `tf` occurrences in a document of length doc_len
+def bm25_term_score(idf_score, tf, doc_len, avg_doc_length, k1=k1, b=b):
+    numerator = tf * (k1 + 1)
+    denominator = tf + k1 * (1 - b + b * doc_len / avg_doc_length)
+    return idf_score * (numerator / (denominator + 1e-6))
+
+# BM25F (simple BM25F): a term's tf in each field, normalised by the field's length
+# and weighted by the field, is summed into one tf, which saturates once, so that
+# matches in the title or the animal name can count for more than matches in the
+# file name, from the index statistics alone.
+def bm25f_term_score(idf_score, field_tfs, doc_field_lengths, avg_field_lengths, weights,
+                     k1=bm25f_params["k1"], b=bm25f_params["b"]):
+    tf = 0
+    for weight, field_tf, field_length, avg_length in zip(weights, field_tfs, doc_field_lengths, avg_field_lengths):
+        tf += weight * field_tf / (1 - b + b * field_length / avg_length)
+    return idf_score * (tf * (k1 + 1) / (tf + k1 + 1e-6))
+
+# Top BM25 matches of a query as (document position, score), found document-at-a-time
+# with dynamic pruning (see pruning.py): the scores and order are those of scoring
+# every posting, but postings that can't reach the top k are mostly skipped
+def bm25_top_k(stores, terms, k=BM25_CANDIDATES, k1=k1, b=b):
+    doc_lengths = stores.corpus.doc_lengths
+    idf_scores = [compute_idf(stores, term) for term in terms]
+    cursors = [stores.corpus.cursor(term) for term in terms]
+
+    def score(j, doc, tf):
+        return bm25_term_score(idf_scores[j], tf, doc_lengths[doc], stores.avg_doc_length, k1, b)
+
+    # Largest tf and shortest document of a block
+    def bound(j, block):
+        max_tf, min_length, _ = block
+        return bm25_term_score(idf_scores[j], max_tf, min_length, stores.avg_doc_length, k1, b)
+
+    # Equal scores keep the order in which term-at-a-time scoring first met the documents
+    num_positions = len(doc_lengths) + 1
+    return max_score_top_k(cursors, k, score, bound, lambda doc, first: first * num_positions + doc)
+
+# Top BM25F matches of a query, found like bm25_top_k's. Postings are walked by
+# document, and each matching document's field tfs are looked up.
+def bm25f_top_k(stores, terms, k=BM25_CANDIDATES, k1=bm25f_params["k1"], b=bm25f_params["b"], weights=None):
+    corpus = stores.corpus
+    num_fields = len(corpus.fields)
+    if weights is None:
+        weights = stores.field_weights
+    idf_scores = [compute_idf(stores, term) for term in terms]
+    field_tfs = [corpus.field_tfs(term) for term in terms]
+    cursors = [corpus.cursor(term) for term in terms]
+
+    def score(j, doc, tf):
+        return bm25f_term_score(idf_scores[j], field_tfs[j][doc], corpus.field_lengths[doc], stores.avg_field_lengths,
+                                weights, k1, b)
+
+    # A field's tf is at most the block's largest tf, and the field at least that long
+    def bound(j, block):
+        max_tf = block[0]
+        return bm25f_term_score(idf_scores[j], [max_tf] * num_fields, [max_tf] * num_fields, stores.avg_field_lengths,
+                                weights, k1, b)
+
+    num_positions = len(corpus.doc_lengths) + 1
+    return max_score_top_k(cursors, k, score, bound, lambda doc, first: first * num_positions + doc)
+
+# Top keyword matches of a query: BM25F if the index has field statistics, BM25 otherwise
+def keyword_top_k(stores, terms, k=BM25_CANDIDATES):
+    return bm25f_top_k(stores, terms, k) if stores.corpus.fields else bm25_top_k(stores, terms, k)
+
+# Score keyword_top_k gives a document for a query's terms (with positions, for phrase matches)
+def keyword_score(stores, terms, doc):
+    corpus = stores.corpus
+    score = 0
+    for term in terms:
+        if corpus.fields:
+            field_tfs = corpus.field_tfs(term).get(doc)
+            if field_tfs:
+                score += bm25f_term_score(compute_idf(stores, term), field_tfs, corpus.field_lengths[doc],
+                                          stores.avg_field_lengths, stores.field_weights)
         else:
-            best["display_title"] = clean_display_title(animal_name or title)
-
-        best["alt_text"] = alt if alt else animal_name
-        results.append(best)
+            term_positions = corpus.positions(term).get(doc)
+            if term_positions:
+                score += bm25_term_score(compute_idf(stores, term), len(term_positions), corpus.doc_lengths[doc],
+                                         stores.avg_doc_length)
+    return score
+
+# Phrase and proximity matching, when the index stores term positions
+# (python indexer.py --positions). Positions count analysed terms, so stopwords
+# between two words don't keep them apart.
+#
+# Consecutive query terms found within PROXIMITY_WINDOW positions of each other, in
+# query order, add 1 / distance^2 per occurrence (1 for an exact phrase) to the
+# pair's proximity. That is scored like a BM25 term frequency, with the smaller
+# IDF of the two terms, and added to the document's BM25 score. Multi-word queries
+# re-score their best PROXIMITY_DEPTH BM25 matches this way, and queries with
+# quoted phrases only return images containing every phrase.
+#
+# The proximity boost is only added to BM25. BM25F's field weights already reward
+# query words found together in a short field such as the animal name, and adding
+# the boost to BM25F lowered MAP@5 (see benchmark_phrase.py).
+
+# (positions of the first term, positions of the second, IDF) of consecutive query terms
+def proximity_pairs(stores, terms):
+    positions = stores.corpus.positions
+    return [(positions(first), positions(second), min(compute_idf(stores, first), compute_idf(stores, second)))
+            for first, second in zip(terms, terms[1:]) if first != second]
+
+def proximity_score(stores, pairs, doc, k1=k1, b=b):
+    score = 0
+    for first_positions, second_positions, idf_score in pairs:
+        first, second = first_positions.get(doc), second_positions.get(doc)
+        if first and second:
+            nearness = 0
+            for i in first:
+                for j in second:
+                    if 0 < j - i <= PROXIMITY_WINDOW:
+                        nearness += 1 / (j - i) ** 2
+            if nearness:
+                score += bm25_term_score(idf_score, nearness, stores.corpus.doc_lengths[doc], stores.avg_doc_length, k1, b)
+    return score
+
+# Top matches of a multi-word query, by BM25 score plus proximity boost
+def proximity_top_k(stores, terms, k=BM25_CANDIDATES, k1=k1, b=b):
+    pairs = proximity_pairs(stores, terms)
+    matches = [(doc, score + proximity_score(stores, pairs, doc, k1, b))
+               for doc, score in bm25_top_k(stores, terms, PROXIMITY_DEPTH, k1, b)]
+    return heapq.nlargest(k, matches, key=lambda match: match[1])  # Ties keep their BM25 order
+
+# Positions of the documents containing a phrase; the documents of its rarest term
+# are checked against the positions of the others
+def phrase_documents(stores, phrase):
+    positions = [stores.corpus.positions(term) for term in phrase]
+    docs = set(min(positions, key=len))
+    for term_positions in positions:
+        docs.intersection_update(term_positions)
+    matches = set()
+    for doc in docs:
+        starts = set(positions[0][doc])
+        for offset in range(1, len(phrase)):
+            starts.intersection_update(position - offset for position in positions[offset][doc])
+            if not starts:
+                break
+        else:
+            matches.add(doc)
+    return matches
+
+# Top matches among the images containing every phrase, by keyword score, plus
+# proximity boost under BM25
+def phrase_top_k(stores, terms, phrases, k=BM25_CANDIDATES, k1=k1, b=b):
+    docs = set.intersection(*(phrase_documents(stores, phrase) for phrase in phrases))
+    pairs = proximity_pairs(stores, terms) if not stores.corpus.fields else []
+    matches = [(doc, keyword_score(stores, terms, doc) + proximity_score(stores, pairs, doc, k1, b))
+               for doc in sorted(docs)]
+    return heapq.nlargest(k, matches, key=lambda match: match[1])
+
+# Phrases of a query: its quoted parts of two or more terms
+def query_phrases(stores, query):
+    phrases = (stores.analyzer.analyze(text) for text in PHRASE_PATTERN.findall(query))
+    return [phrase for phrase in phrases if len(phrase) > 1]
+
+# Top keyword matches of each query, with phrases, and proximity under BM25, if the index has positions
+def bm25_candidates_many(stores, queries):
+    corpus = stores.corpus
+    candidates = []
+    for query, terms in zip(queries, stores.analyzer.analyze_many(queries)):
+        terms = [term for term in terms if term in corpus]
+        phrases = query_phrases(stores, query) if corpus.has_positions else []
+        if phrases:
+            candidates.append(phrase_top_k(stores, terms, phrases))
+        elif corpus.has_positions and not corpus.fields and len(terms) > 1:
+            candidates.append(proximity_top_k(stores, terms))
+        else:
+            candidates.append(keyword_top_k(stores, terms))
+    return candidates
+
+def bm25_candidates(stores, query):
+    return bm25_candidates_many(stores, [query])[0]
+
+# Nearest images to the CLIP text embedding as (document position, BM25 score of 0),
+# from the `limit` nearest source pages, as results show one image per page.
+# Embedded images that aren't in the index (near-duplicates dropped by dedup.py,
+# or images deleted since the IVF index was built) are skipped, and more rows are
+# asked for until there are enough pages or no more rows. An IVF index over no
+# images, or an empty embedding store, gives no candidates.
+def dense_candidates(stores, text_features, limit=DENSE_CANDIDATES):
+    group_ids = stores.corpus.group_ids
+    k = limit
+    while True:
+        rows, _ = stores.dense_index.search(text_features, k)
+        positions = (stores.corpus.find_url(stores.embeddings.url(row)) for row in rows)
+        positions = [position for position in positions if position is not None]
+        groups = list(dict.fromkeys(group_ids[position] for position in positions))
+        if len(groups) >= limit or len(rows) < k:
+            nearest = set(groups[:limit])
+            return [(position, 0.0) for position in positions if group_ids[position] in nearest]
+        k *= 2
+
+# Results for a list of queries. Queries not in the result cache are encoded by
+# CLIP in one batch and their BM25 candidates are scored together.
+def search_many(queries, top_k=20, mode="bm25"):
+    stores = reload_if_changed()
+    queries = [normalize_query(query) for query in queries]
+    results = {query: result_cache.get((mode, top_k, query)) for query in dict.fromkeys(queries)}
+
+    missing = [query for query, query_results in results.items() if query_results is None]
+    if missing:
+        text_features = encode_queries(missing)
+        if mode in ("bm25", "hybrid"):
+            bm25_matches = bm25_candidates_many(stores, missing)
+        else:
+            bm25_matches = [[] for _ in missing]
+        for query, query_features, matches in zip(missing, text_features, bm25_matches):
+            results[query] = rank_images(stores, query, top_k, mode, query_features, matches)
+            result_cache.put((mode, top_k, query), results[query])
+
+    # Copies, so callers can't modify the cached results
+    return [[dict(res) for res in results[query]] for query in queries]
+
+def search(query, top_k=20, mode="bm25"):
+    return search_many([query], top_k, mode)[0]
+
+def rank_images(stores, query, top_k, mode, text_features, bm25_matches):
+    corpus = stores.corpus
+    # Candidates from BM25, from the ANN index, or the union of both
+    candidates = dict(bm25_matches)
+    if mode in ("dense", "hybrid"):
+        for position, score in dense_candidates(stores, text_features):
+            candidates.setdefault(position, score)
+
+    # One image per source page: the page's highest-scoring candidate, ties going to
+    # its canonical image. Groups, canonical images and display titles are worked out
+    # by the indexer (document_store.py), so this only looks them up, and results are
+    # new dicts, never the stored documents or another query's results.
+    order = sorted(candidates.items(), key=lambda c: (-c[1], -corpus.image_scores[c[0]], c[0]))
+    seen = set()
+    results = []
+    for position, score in order:
+        group = corpus.group_ids[position]
+        if group in seen:
+            continue
+        seen.add(group)
+        res = corpus[position]
+        res["score"] = round(score, 4)
+        res["display_title"] = corpus.display_title(position)
+        res["alt_text"] = res.get("alt_text", "").strip() or res.get("animal_name", "").strip()
+        results.append(res)
 
     # --- CLIP reranking ---
-    # Encode query using CLIP
-    text_input = clip.tokenize([query]).to(device)
-    with torch.no_grad():
-        text_features = model.encode_text(text_input)[0].cpu().numpy()
-        text_features /= np.linalg.norm(text_features)
-
-    for res in results:
-        url = res["image_url"]
-        if url in embedding_dict:
-            image_feat = embedding_dict[url]
-            similarity = cosine_similarity(text_features, image_feat)
-            res["clip_score"] = float(similarity)
-        else:
-            res["clip_score"] = 0.0
+    # Stored image embeddings are unit length, so one batched product gives every cosine
+    clip_scores = stores.embeddings.similarities(text_features, [res["image_url"] for res in results])
+    for res, clip_score in zip(results, clip_scores):
+        res["clip_score"] = float(clip_score)
 
-       # Combine BM25 and CLIP score (weighted) + boost exact animal name match
+    # Combine keyword and CLIP score (weighted)
     for res in results:
         bm25_score = res.get("score", 0.0)
         clip_score = res.get("clip_score", 0.0)
-        base_score = 0.5 * bm25_score + 10.0 * clip_score
+        res["final_score"] = 0.5 * bm25_score + 10.0 * clip_score
 
-        animal_name = res.get("animal_name", "").lower()
-        if query.lower() in animal_name:
-            base_score += 3.0  # ✅ Boost if query matches animal name
+    # Safe sorting using final_score
+    results = heapq.nlargest(top_k, results, key=lambda x: x.get("final_score", 0))
+    for res in results:
+        res["thumbnail"] = image_cache.thumbnail(res["image_url"]) if image_cache else None
+    return results
 
-        res["final_score"] = base_score
+def bm25_search(query, top_k=20):
+    return search(query, top_k, mode="bm25")
 
-    # Safe sorting using final_score
-    results = sorted(results, key=lambda x: x.get("final_score", 0), reverse=True)
-    return results[:top_k]
+def bm25_search_many(queries, top_k=20):
+    return search_many(queries, top_k, mode="bm25")
 
 
 @app.route("/", methods=["GET", "POST"])
 def index():
     results = []
     query = ""
+    mode = "bm25"
     if request.method == "POST":
         query = request.form.get("query")
-        results = bm25_search(query)
-    return render_template("index.html", results=results, query=query)
+        mode = request.form.get("mode", "bm25")
+        if mode not in SEARCH_MODES:
+            mode = "bm25"
+        results = search(query, mode=mode)
+    return render_template("index.html", results=results, query=query, mode=mode)
+
+@app.route("/cache_stats")
+def cache_stats():
+    return jsonify({"text_embeddings": text_embedding_cache.stats(), "results": result_cache.stats()})
 
 if __name__ == "__main__":
     app.run(debug=True)
@@ -0,0 +1,54 @@
+import json
+import sys
+import time
+import nltk
+from nltk.corpus import stopwords
+from nltk.stem import PorterStemmer
+from nltk.tokenize import word_tokenize
+from analyzer import Analyzer
+from indexer import document_text
+
+# Throughput of analyzer.py against the NLTK analysis it replaced (word_tokenize,
+# isalnum filter, NLTK stopwords), over the text indexed for every image surrogate,
+# without and with Porter stemming. Each pass starts from an empty stem cache.
+#
+#   python benchmark_analyzer.py [passes over the corpus]
+
+passes = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+
+nltk.download('punkt')
+nltk.download('stopwords')
+
+with open("image_surrogates.json", "r", encoding="utf-8") as f:
+    texts = [document_text(item) for item in json.load(f)] * passes
+print(f"Analysing {len(texts)} texts ({len(texts) // passes} surrogates x {passes} passes)\n")
+
+stop_words = set(stopwords.words("english"))
+porter = PorterStemmer()
+
+def nltk_analyze(text, stem):
+    tokens = [t for t in word_tokenize(text.lower()) if t.isalnum() and t not in stop_words]
+    return [porter.stem(t) for t in tokens] if stem else tokens
+
+def timed(analyze_all):
+    start = time.perf_counter()
+    results = analyze_all()
+    return results, time.perf_counter() - start
+
+num_chars = sum(len(text) for text in texts)
+print(f"{'analysis':<32} {'texts/s':>10} {'MB/s':>7} {'speed-up':>9}")
+for stem in (False, True):
+    baseline, baseline_seconds = timed(lambda: [nltk_analyze(text, stem) for text in texts])
+    analyzer = Analyzer(stem=stem)
+    single, single_seconds = timed(lambda: [analyzer.analyze(text) for text in texts])
+    analyzer = Analyzer(stem=stem)
+    batch, batch_seconds = timed(lambda: analyzer.analyze_many(texts))
+
+    num_tokens = sum(len(terms) for terms in batch)
+    suffix = " + stemming" if stem else ""
+    for name, seconds in ((f"NLTK{suffix}", baseline_seconds), (f"Analyzer.analyze{suffix}", single_seconds),
+                          (f"Analyzer.analyze_many{suffix}", batch_seconds)):
+        print(f"{name:<32} {len(texts) / seconds:>10,.0f} {num_chars / seconds / 1e6:>7.2f} {baseline_seconds / seconds:>8.1f}x")
+    # NLTK keeps tokens like "250px-atelerix" or "young.jpg" whole, which the isalnum filter then drops
+    kept = sum(len(set(a) & set(b)) for a, b in zip(baseline, batch)) / max(sum(len(set(a)) for a in baseline), 1)
+    print(f"{kept:.1%} of NLTK's terms also found; {num_tokens / max(sum(map(len, baseline)), 1):.2f}x as many tokens\n")
@@ -0,0 +1,50 @@
+import os
+import sys
+import time
+import numpy as np
+from ann_index import IVFIndex
+from embedding_store import EmbeddingStore, top_k
+
+# Recall and throughput of the IVF index against exact (brute-force) search.
+#
+# Queries are stored image embeddings with Gaussian noise added, which stand in
+# for CLIP text embeddings landing near the images they describe. Without an
+# embedding store (python embed_images.py), a synthetic clustered collection of
+# 20,000 512-d vectors is used instead.
+#
+#   python benchmark_ann.py [k] [number of queries]
+
+k = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+n_queries = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+rng = np.random.default_rng(0)
+
+if os.path.exists("image_embeddings.npy"):
+    vectors = np.asarray(EmbeddingStore("image_embeddings").vectors, dtype=np.float32)
+    print(f"Using {len(vectors)} embeddings from image_embeddings.npy")
+else:
+    centers = rng.standard_normal((500, 512))
+    vectors = (centers[rng.integers(0, len(centers), 20000)] + 1.5 * rng.standard_normal((20000, 512))).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    print(f"Using {len(vectors)} synthetic clustered embeddings")
+
+queries = vectors[rng.choice(len(vectors), n_queries)] + 0.05 * rng.standard_normal((n_queries, vectors.shape[1])).astype(np.float32)
+queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+
+start = time.perf_counter()
+exact = [set(top_k(vectors @ query, k)) for query in queries]
+exact_qps = n_queries / (time.perf_counter() - start)
+
+start = time.perf_counter()
+ivf = IVFIndex.build(vectors)
+print(f"Built IVF index with {len(ivf.centroids)} lists in {time.perf_counter() - start:.2f}s\n")
+
+print(f"{'search':<16}{'recall@' + str(k):>10}{'queries/sec':>14}{'speedup':>10}")
+print(f"{'exact':<16}{1.0:>10.3f}{exact_qps:>14.0f}{1.0:>9.1f}x")
+for n_probe in (1, 2, 4, 8, 16, 32):
+    if n_probe > len(ivf.centroids):
+        break
+    start = time.perf_counter()
+    found = [ivf.search(query, k, n_probe)[0] for query in queries]
+    qps = n_queries / (time.perf_counter() - start)
+    recall = np.mean([len(exact_rows & set(rows.tolist())) / k for exact_rows, rows in zip(exact, found)])
+    print(f"{'ivf n_probe=' + str(n_probe):<16}{recall:>10.3f}{qps:>14.0f}{qps / exact_qps:>9.1f}x")
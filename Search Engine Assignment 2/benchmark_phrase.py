@@ -0,0 +1,67 @@
+import json
+import sys
+import time
+import app
+from app import bm25_top_k, keyword_top_k, phrase_top_k, proximity_top_k
+from ir_eval import evaluate
+
+# Latency and top-5 quality of BM25 with the positional index (python indexer.py
+# --positions) against plain BM25, over the multi-word queries in queries.txt:
+#   BM25              bm25_top_k, the bag-of-words ranking
+#   BM25 + proximity  proximity_top_k, what the app runs for unquoted multi-word
+#                     queries if the index has no field statistics
+#   BM25F             keyword_top_k, what it runs for them otherwise
+#   phrase            phrase_top_k with the whole query quoted
+# Every pass starts with cold postings and positions caches.
+#
+#   python benchmark_phrase.py [passes]
+
+passes = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+stores = app.stores
+
+if not stores.corpus.has_positions:
+    sys.exit("The index has no term positions; rebuild it with python indexer.py --positions")
+
+with open("queries.txt", "r", encoding="utf-8") as f:
+    queries = [line.strip() for line in f if line.strip()]
+with open("ground_truth_filtered.json", "r", encoding="utf-8") as f:
+    ground_truth = json.load(f)
+
+# Analysed terms of the multi-word queries
+query_terms = {}
+for query, terms in zip(queries, stores.analyzer.analyze_many(queries)):
+    terms = [term for term in terms if term in stores.corpus]
+    if len(terms) > 1:
+        query_terms[query] = terms
+print(f"{len(query_terms)} of {len(queries)} queries have more than one indexed term, {passes} passes\n")
+
+def clear_caches():
+    corpus = stores.corpus
+    for cache in (corpus.postings, corpus.positions, corpus.field_tfs, corpus.df):
+        cache.cache_clear()
+    for index, _, _ in corpus.segments:
+        for cache in (index.postings, index.positions, index.field_tfs, index._block_postings):
+            cache.cache_clear()
+
+rankers = {
+    "BM25": lambda terms: bm25_top_k(stores, terms),
+    "BM25 + proximity": lambda terms: proximity_top_k(stores, terms),
+    "BM25F": lambda terms: keyword_top_k(stores, terms),
+    "phrase": lambda terms: phrase_top_k(stores, terms, [terms]),
+}
+
+qrels = {query: {url: 1 for url in ground_truth[query]} for query in query_terms if query in ground_truth}
+print(f"{'ranking':<18} {'ms/query':>9} {'vs BM25':>8} {'MAP@5':>7} {'P@5':>7}")
+baseline = None
+for name, rank in rankers.items():
+    seconds = []
+    for _ in range(passes):
+        clear_caches()
+        start = time.perf_counter()
+        results = {query: rank(terms) for query, terms in query_terms.items()}
+        seconds.append(time.perf_counter() - start)
+    ms = min(seconds) / len(query_terms) * 1000
+    baseline = baseline or ms
+    rankings = {query: [stores.corpus[doc]["image_url"] for doc, _ in results[query]] for query in qrels}
+    metrics = evaluate(qrels, rankings, [5])
+    print(f"{name:<18} {ms:>9.3f} {ms / baseline:>7.2f}x {metrics['map']:>7.4f} {metrics['P_5']:>7.4f}")
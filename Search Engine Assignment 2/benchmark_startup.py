@@ -0,0 +1,117 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+# Comparing app.py's data loading before (json.load of every file into the heap)
+# and after (memory-mapped document, index and embedding stores).
+#
+# Each loader runs in a fresh interpreter and reports its load time plus resident
+# and anonymous memory, once right after loading and once after touching all of
+# the data (every embedding and every postings byte). Anonymous memory is heap
+# that each forked worker ends up holding its own copy of; the rest of the resident
+# set is file-backed pages that all workers share through the page cache.
+# CLIP model loading is left out as it costs the same for both.
+#
+# If image_embeddings.json has not been generated yet, random 512-d embeddings are
+# written for every image in image_surrogates.json so that both loaders have
+# something to read.
+#
+#   python benchmark_startup.py
+
+def memory_kb():
+    usage = {}
+    for path, keys in (("/proc/self/status", ("VmRSS",)), ("/proc/self/smaps_rollup", ("Anonymous",))):
+        try:
+            with open(path) as f:
+                for line in f:
+                    name, _, value = line.partition(":")
+                    if name in keys:
+                        usage[name] = int(value.split()[0])
+        except OSError:
+            pass
+    if "VmRSS" not in usage:
+        import resource
+        usage["VmRSS"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return usage["VmRSS"], usage.get("Anonymous")
+
+def load_json(embeddings_json):
+    import numpy as np
+    with open("image_surrogates.json", "r", encoding="utf-8") as f:
+        documents = json.load(f)
+    data = {}
+    for path in ("index/inverted_index.json", "index/tf_index.json", "index/bm25_data.json"):
+        with open(path, "r", encoding="utf-8") as f:
+            data[path] = json.load(f)
+    with open(embeddings_json, "r", encoding="utf-8") as f:
+        image_embeddings = json.load(f)
+    embedding_dict = {img["image_url"]: np.array(img["embedding"]) for img in image_embeddings}
+    # Everything is already on the heap, so there is nothing left to touch
+    return (documents, data, embedding_dict), lambda: None
+
+def load_mmap(embeddings_prefix):
+    from segment_index import SegmentedIndex
+    from embedding_store import EmbeddingStore
+    corpus = SegmentedIndex("index")
+    embeddings = EmbeddingStore(embeddings_prefix)
+
+    def touch():
+        float(embeddings.vectors.sum())
+        for index, _, _ in corpus.segments:
+            sum(index._postings)
+
+    return (corpus, embeddings), touch
+
+def run_child(loader, path):
+    import numpy as np  # imported before measuring, as app.py always needs it
+    rss_before, anonymous_before = memory_kb()
+    start = time.perf_counter()
+    data, touch = (load_json if loader == "json" else load_mmap)(path)
+    load_seconds = time.perf_counter() - start
+    rss_loaded, anonymous_loaded = memory_kb()
+    touch()
+    rss_touched, anonymous_touched = memory_kb()
+    print(json.dumps({
+        "load_ms": load_seconds * 1000,
+        "rss_kb": [rss_loaded - rss_before, rss_touched - rss_before],
+        "anonymous_kb": None if anonymous_before is None else [anonymous_loaded - anonymous_before, anonymous_touched - anonymous_before],
+    }))
+
+def write_synthetic_embeddings(directory):
+    import numpy as np
+    from embedding_store import write_embedding_store
+    with open("image_surrogates.json", "r", encoding="utf-8") as f:
+        urls = [img["image_url"] for img in json.load(f)]
+    vectors = np.random.default_rng(0).standard_normal((len(urls), 512)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    embeddings_json = os.path.join(directory, "image_embeddings.json")
+    with open(embeddings_json, "w", encoding="utf-8") as f:
+        json.dump([{"image_url": url, "embedding": vector.tolist()} for url, vector in zip(urls, vectors)], f, indent=2)
+    prefix = os.path.join(directory, "image_embeddings")
+    write_embedding_store(prefix, urls, vectors)
+    return embeddings_json, prefix
+
+def main():
+    with tempfile.TemporaryDirectory() as directory:
+        if os.path.exists("image_embeddings.json") and os.path.exists("image_embeddings.npy"):
+            embeddings_json, prefix = "image_embeddings.json", "image_embeddings"
+        else:
+            print("image_embeddings.json not found, using synthetic embeddings")
+            embeddings_json, prefix = write_synthetic_embeddings(directory)
+
+        print(f"{'loader':<8}{'load time':>12}{'RSS':>12}{'RSS (touched)':>16}{'anonymous':>12}{'anonymous (touched)':>22}")
+        for loader, path in (("json", embeddings_json), ("mmap", prefix)):
+            output = subprocess.run([sys.executable, __file__, "--child", loader, path],
+                                    capture_output=True, text=True, check=True).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            rss = [f"{kb / 1024:.1f} MB" for kb in result["rss_kb"]]
+            anonymous = [f"{kb / 1024:.1f} MB" for kb in result["anonymous_kb"]] if result["anonymous_kb"] else ["n/a", "n/a"]
+            print(f"{loader:<8}{result['load_ms']:>9.1f} ms{rss[0]:>12}{rss[1]:>16}{anonymous[0]:>12}{anonymous[1]:>22}")
+
+if __name__ == "__main__":
+    if len(sys.argv) == 4 and sys.argv[1] == "--child":
+        run_child(sys.argv[2], sys.argv[3])
+    else:
+        main()
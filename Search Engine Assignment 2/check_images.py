@@ -1,12 +1,14 @@
 import json
 from collections import Counter
 from urllib.parse import urlparse
+from embedding_store import EmbeddingStore
 
-#with open("image_surrogates.json", "r", encoding="utf-8") as f:
- #   images = json.load(f)
+with open("image_surrogates.json", "r", encoding="utf-8") as f:
+    surrogates = json.load(f)
 
-with open("image_embeddings.json", "r", encoding="utf-8") as f:
-    images = json.load(f)
+# Images that have an embedding in the store
+embeddings = EmbeddingStore("image_embeddings")
+images = [img for img in surrogates if embeddings.row(img["image_url"]) is not None]
 
 # Count by category (roughly from source_page)
 sources = [img["source_page"].split("/wiki/")[-1] for img in images if "source_page" in img]
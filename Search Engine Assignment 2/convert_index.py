@@ -0,0 +1,60 @@
+import json
+import os
+import time
+from segment_index import SegmentWriter, SegmentedIndex
+from embedding_store import write_embedding_store
+from ann_index import build_ivf_file
+
+# Converting the JSON files written by earlier versions of indexer.py and
+# embed_images.py into the binary stores read by app.py:
+#   index/tf_index.json + image_surrogates.json  ->  a single segment listed in index/segments.json
+#   image_embeddings.json                       ->  image_embeddings.npy + image_embeddings.idx
+
+json_files = ["index/inverted_index.json", "index/tf_index.json", "index/bm25_data.json"]
+
+start = time.perf_counter()
+with open("index/tf_index.json", "r", encoding="utf-8") as f:
+    tf_index = json.load(f)
+with open("image_surrogates.json", "r", encoding="utf-8") as f:
+    documents = json.load(f)
+
+# The JSON index used positions in image_surrogates.json as document IDs, so they
+# are the segment ordinals; documents without terms get a length of 0
+doc_lengths = [0] * len(documents)
+postings = {}
+for doc_id, term_counts in tf_index.items():
+    doc_lengths[int(doc_id)] = sum(term_counts.values())
+    for term, tf in term_counts.items():
+        postings.setdefault(term, []).append((int(doc_id), tf))
+
+segment = SegmentWriter("index").rebuild(documents, postings=postings, doc_lengths=doc_lengths)
+print(f"Converted {len(postings)} terms over {len(documents)} documents to segment {segment['name']} in {time.perf_counter() - start:.2f}s")
+
+# Comparing disk size and load time with the JSON files
+json_size = sum(os.path.getsize(path) for path in json_files if os.path.exists(path))
+start = time.perf_counter()
+for path in json_files:
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            json.load(f)
+json_load_time = time.perf_counter() - start
+
+start = time.perf_counter()
+SegmentedIndex("index")
+binary_load_time = time.perf_counter() - start
+
+index_size = os.path.getsize(os.path.join("index", segment["name"] + ".index.bin"))
+print(f"JSON indexes:  {json_size / 1024:10.1f} KB, loaded in {json_load_time * 1000:8.1f} ms")
+print(f"Segment index: {index_size / 1024:10.1f} KB, loaded in {binary_load_time * 1000:8.1f} ms")
+
+if os.path.exists("image_embeddings.json"):
+    with open("image_embeddings.json", "r", encoding="utf-8") as f:
+        image_embeddings = json.load(f)
+    write_embedding_store(
+        "image_embeddings",
+        [img["image_url"] for img in image_embeddings],
+        [img["embedding"] for img in image_embeddings],
+    )
+    print(f"Converted {len(image_embeddings)} embeddings to image_embeddings.npy")
+    build_ivf_file("image_embeddings")
+    print("Built the IVF index image_embeddings.ivf")
@@ -0,0 +1,93 @@
+import json
+import sqlite3
+import time
+
+# Persistent crawl state for crawler.py, kept in SQLite so that it survives crashes:
+#
+#   crawls       one row per crawl; `finished` stays NULL until the crawl completes
+#   frontier     the pages of a crawl in crawl order, with a flag once each is done
+#   pages        per visited page: ETag, Last-Modified and SHA-256 of the last body
+#   page_images  the images extracted from each page when it last changed
+#   images       the image set emitted by the last finished crawl, for computing deltas
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS crawls (id INTEGER PRIMARY KEY, started REAL, finished REAL);
+CREATE TABLE IF NOT EXISTS frontier (crawl_id INTEGER, position INTEGER, url TEXT, done INTEGER DEFAULT 0,
+                                     PRIMARY KEY (crawl_id, position));
+CREATE TABLE IF NOT EXISTS pages (url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, content_hash TEXT, fetched REAL);
+CREATE TABLE IF NOT EXISTS page_images (url TEXT, position INTEGER, record TEXT, PRIMARY KEY (url, position));
+CREATE TABLE IF NOT EXISTS images (image_url TEXT PRIMARY KEY, record TEXT);
+"""
+
+class CrawlState:
+    def __init__(self, path="crawl_state.db"):
+        self.db = sqlite3.connect(path)
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    # The unfinished crawl to resume, or None
+    def unfinished_crawl(self):
+        row = self.db.execute("SELECT id FROM crawls WHERE finished IS NULL ORDER BY id DESC LIMIT 1").fetchone()
+        return row[0] if row else None
+
+    def start_crawl(self, links):
+        with self.db:
+            crawl_id = self.db.execute("INSERT INTO crawls (started) VALUES (?)", (time.time(),)).lastrowid
+            self.db.executemany("INSERT INTO frontier (crawl_id, position, url) VALUES (?, ?, ?)",
+                                [(crawl_id, position, url) for position, url in enumerate(links)])
+        return crawl_id
+
+    # [(url, done)] in crawl order
+    def frontier(self, crawl_id):
+        rows = self.db.execute("SELECT url, done FROM frontier WHERE crawl_id = ? ORDER BY position", (crawl_id,))
+        return [(url, bool(done)) for url, done in rows]
+
+    # {url: (etag, last_modified, content_hash)} of previously fetched pages
+    def validators(self, urls):
+        validators = {}
+        for url in urls:
+            row = self.db.execute("SELECT etag, last_modified, content_hash FROM pages WHERE url = ?", (url,)).fetchone()
+            if row:
+                validators[url] = row
+        return validators
+
+    def page_images(self, url):
+        rows = self.db.execute("SELECT record FROM page_images WHERE url = ? ORDER BY position", (url,))
+        return [json.loads(record) for record, in rows]
+
+    # Marking a page done. `validators` is (etag, last_modified, content_hash), or None
+    # to keep the stored ones; `images` is None when the page is unchanged.
+    def record_page(self, crawl_id, url, validators=None, images=None):
+        with self.db:
+            if validators is not None:
+                self.db.execute("INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?)", (url, *validators, time.time()))
+            if images is not None:
+                self.db.execute("DELETE FROM page_images WHERE url = ?", (url,))
+                self.db.executemany("INSERT INTO page_images VALUES (?, ?, ?)",
+                                    [(url, position, json.dumps(image)) for position, image in enumerate(images)])
+            self.db.execute("UPDATE frontier SET done = 1 WHERE crawl_id = ? AND url = ?", (crawl_id, url))
+
+    # Finishing a crawl whose result is `images`; returns the changes since the
+    # previous finished crawl as {"added": [...], "changed": [...], "removed": [image_url, ...]}.
+    # `unreached` are the pages of the frontier the crawl stopped before, e.g. at its
+    # image limit: their images are carried over from when they were last fetched,
+    # so they are not reported as removed.
+    def finish_crawl(self, crawl_id, images, unreached=()):
+        previous = {image_url: json.loads(record) for image_url, record in self.db.execute("SELECT image_url, record FROM images")}
+        current = {image["image_url"]: image for image in images}
+        for url in unreached:
+            for image in self.page_images(url):
+                current.setdefault(image["image_url"], image)
+        delta = {
+            "added": [image for url, image in current.items() if url not in previous],
+            "changed": [image for url, image in current.items() if url in previous and previous[url] != image],
+            "removed": [url for url in previous if url not in current],
+        }
+        with self.db:
+            self.db.execute("DELETE FROM images")
+            self.db.executemany("INSERT INTO images VALUES (?, ?)", [(url, json.dumps(image)) for url, image in current.items()])
+            self.db.execute("DELETE FROM frontier WHERE crawl_id = ?", (crawl_id,))
+            self.db.execute("UPDATE crawls SET finished = ? WHERE id = ?", (time.time(), crawl_id))
+        return delta
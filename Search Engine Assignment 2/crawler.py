@@ -1,14 +1,22 @@
+import argparse
+import hashlib
 import requests
 from bs4 import BeautifulSoup
 import json
+import threading
 import time
 import os
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from tqdm import tqdm
+from crawl_state import CrawlState
+from image_cache import CACHE_DIR, THUMBNAIL_DIR, ImageCache
 import shutil
 import re
 
 BASE_URL = "https://en.wikipedia.org"
-API_URL = "https://en.wikipedia.org/w/api.php"
 
 CATEGORIES = [
     "Mammals_of_Africa",
@@ -20,65 +28,142 @@ CATEGORIES = [
     "Reptiles_of_North_America",
     "Birds_of_South_America",
     "Mammals_of_South_America",
-    "Birds_of_Australia"
+    "Birds_of_Australia",
     "Reptiles_of_Africa",
     "Birds_of_North_America"
 ]
 
+CONCURRENCY = 8  # Pages fetched at once
+RATE_PER_HOST = 5.0  # Requests per second to any one host
+BURST = 5  # Requests a host may receive back to back before the rate applies
+MAX_RETRIES = 5  # Retries of failed requests, with exponential backoff
+TIMEOUT = 30  # Seconds
+USER_AGENT = "search-engine-project-crawler/1.0 (educational image search crawler)"
+FETCH_WINDOW = 4  # Pages fetched ahead of the one being consumed, per thread
+FETCH_FAILED = object()  # What fetch_page returns for a page it couldn't fetch
 
-visited_pages = set()
-seen_urls = set()
-image_data = []
+# Token bucket: `rate` tokens a second, holding at most `capacity`; each request takes one
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
 
-def get_animal_links_from_category(category, limit=300):
-    links = []
-    params = {
-        "action": "query",
-        "list": "categorymembers",
-        "cmtitle": f"Category:{category}",
-        "cmlimit": "max",
-        "format": "json"
-    }
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
 
-    print(f" Getting pages from Category: {category}")
-    while len(links) < limit:
-        response = requests.get(API_URL, params=params)
-        data = response.json()
+# One token bucket per host, so politeness limits don't depend on the thread count
+class HostRateLimiter:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.buckets = {}
+        self.lock = threading.Lock()
 
-        for page in data["query"]["categorymembers"]:
-            title = page["title"]
-            if not title.startswith("Category:") and not title.startswith("File:"):
-                links.append(BASE_URL + "/wiki/" + title.replace(" ", "_"))
+    def acquire(self, url):
+        host = urlsplit(url).netloc
+        with self.lock:
+            if host not in self.buckets:
+                self.buckets[host] = TokenBucket(self.rate, self.capacity)
+            bucket = self.buckets[host]
+        bucket.acquire()
 
-        if "continue" in data:
-            params["cmcontinue"] = data["continue"]["cmcontinue"]
-        else:
-            break
+class Crawler:
+    def __init__(self, base_url=BASE_URL, concurrency=CONCURRENCY, rate=RATE_PER_HOST, burst=BURST,
+                 max_retries=MAX_RETRIES, timeout=TIMEOUT):
+        self.base_url = base_url.rstrip("/")
+        self.api_url = self.base_url + "/w/api.php"
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.limiter = HostRateLimiter(rate, burst)
 
-    return links[:limit]
+        # Keep-alive connections shared by all threads; 429 and 5xx responses and
+        # connection errors are retried with exponential backoff, honouring Retry-After
+        retry = Retry(total=max_retries, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504])
+        adapter = HTTPAdapter(pool_connections=concurrency, pool_maxsize=concurrency, max_retries=retry)
+        self.session = requests.Session()
+        self.session.headers["User-Agent"] = USER_AGENT
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
 
-def clean_animal_name(raw_name):
-    # Lowercase and replace underscores
-    name = raw_name.lower().replace("_", " ")
+    def get(self, url, **kwargs):
+        self.limiter.acquire(url)
+        return self.session.get(url, timeout=self.timeout, **kwargs)
 
-    # Remove things like '220px', digits, brackets, symbols, and collapse whitespace
-    name = re.sub(r'\b\d{2,4}px\b', '', name)
-    name = re.sub(r'[^a-z\s]', ' ', name)
-    name = re.sub(r'\s+', ' ', name)
+    def get_animal_links_from_category(self, category, limit=300):
+        links = []
+        params = {
+            "action": "query",
+            "list": "categorymembers",
+            "cmtitle": f"Category:{category}",
+            "cmlimit": "max",
+            "format": "json"
+        }
 
-    # Keep only the first 2-3 words (optional)
-    name = ' '.join(name.strip().split()[:3])
+        while len(links) < limit:
+            response = self.get(self.api_url, params=params)
+            data = response.json()
 
-    return name.title().strip()
+            for page in data["query"]["categorymembers"]:
+                title = page["title"]
+                if not title.startswith("Category:") and not title.startswith("File:"):
+                    links.append(self.base_url + "/wiki/" + title.replace(" ", "_"))
+
+            if "continue" in data:
+                params["cmcontinue"] = data["continue"]["cmcontinue"]
+            else:
+                break
+
+        return links[:limit]
 
-def extract_images_from_page(url):
-    try:
-        response = requests.get(url)
-        soup = BeautifulSoup(response.text, "html.parser")
+    # Fetching an article page, conditionally if it was fetched before. Returns the
+    # page's new (etag, last_modified, content_hash), or None to keep the stored ones,
+    # and its images before de-duplication across pages, or None if it is unchanged.
+    # Returns FETCH_FAILED instead if the page couldn't be fetched or parsed, so it
+    # stays undone and is fetched again when the crawl is resumed.
+    def fetch_page(self, url, validators=None):
+        etag, last_modified, content_hash = validators or (None, None, None)
+        headers = {}
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+        try:
+            response = self.get(url, headers=headers)
+            if response.status_code == 304:
+                return None, None
+            # A page deleted since it was listed has no images
+            if response.status_code in (404, 410):
+                return None, []
+            response.raise_for_status()
+            new_validators = (response.headers.get("ETag"), response.headers.get("Last-Modified"),
+                              hashlib.sha256(response.content).hexdigest())
+            # Servers that ignore conditional requests still send the same body
+            if new_validators[2] == content_hash:
+                return new_validators, None
+            return new_validators, self.extract_images(url, response.text)
+        except Exception as e:
+            print(f"Error processing {url}: {e}")
+            return FETCH_FAILED
+
+    def extract_images(self, url, html):
+        page_images = []
+        soup = BeautifulSoup(html, "html.parser")
         title = soup.find("h1").get_text()
         content = soup.find("div", class_="mw-parser-output")
         if not content:
-            return
+            return page_images
 
         images = content.find_all("img")
         for img in images:
@@ -97,60 +182,182 @@ def extract_images_from_page(url):
             if not filename.endswith((".jpg", ".jpeg", ".png")):
                 continue
 
-            image_url = "https:" + src
-            if image_url in seen_urls:
-                continue
-            seen_urls.add(image_url)
-
             # Use alt if available, otherwise fallback to filename (without extension)
             raw_name = alt.strip() if alt.strip() else filename.split(".")[0]
             animal_name = clean_animal_name(raw_name)
 
-            image_data.append({
+            page_images.append({
                 "title": title,
-                "image_url": image_url,
+                "image_url": "https:" + src,
                 "alt_text": alt,
                 "source_page": url,
                 "animal_name": animal_name
             })
+        return page_images
+
+    # Crawling every category, or resuming the crawl that was interrupted. Each page
+    # is recorded in `state` as soon as it is processed; pages are fetched
+    # concurrently, at most FETCH_WINDOW per thread ahead, but consumed in category
+    # order, so the output is the same as a sequential crawl's. Returns the images
+    # and the delta since the last crawl. A crawl stopped at `max_images` keeps the
+    # images of the pages it didn't reach from their last fetch, so only the pages
+    # it visited can lose images. If some pages failed the crawl is left
+    # unfinished, with those pages undone, and the delta is None: running it again
+    # retries them.
+    def crawl(self, state, categories=CATEGORIES, limit=300, max_images=10000):
+        with ThreadPoolExecutor(self.concurrency) as pool:
+            crawl_id = state.unfinished_crawl()
+            if crawl_id is None:
+                category_links = list(pool.map(lambda category: self.get_animal_links_from_category(category, limit), categories))
+
+                links = []
+                visited_pages = set()
+                for category, animal_links in zip(categories, category_links):
+                    print(f"Found {len(animal_links)} animal pages in {category}")
+                    for link in animal_links:
+                        if link not in visited_pages:
+                            visited_pages.add(link)
+                            links.append(link)
+                crawl_id = state.start_crawl(links)
+
+            frontier = state.frontier(crawl_id)
+            pending = [url for url, done in frontier if not done]
+            if len(pending) < len(frontier):
+                print(f"Resuming crawl: {len(frontier) - len(pending)} of {len(frontier)} pages already done")
+            validators = state.validators(pending)
+            to_fetch = iter(pending)
+            futures = {}
+
+            def fetch_ahead():
+                while len(futures) < FETCH_WINDOW * self.concurrency:
+                    url = next(to_fetch, None)
+                    if url is None:
+                        return
+                    futures[url] = pool.submit(self.fetch_page, url, validators.get(url))
+
+            fetch_ahead()
+            seen_urls = set()
+            image_data = []
+            changed = 0
+            fetched = 0
+            failed = []
+            reached = 0
+            for url, done in tqdm(frontier, desc="Crawling pages"):
+                if len(image_data) >= max_images:
+                    break
+                reached += 1
+                if not done:
+                    result = futures.pop(url).result()
+                    fetch_ahead()
+                    fetched += 1
+                    if result is FETCH_FAILED:
+                        failed.append(url)
+                        continue
+                    new_validators, page_images = result
+                    state.record_page(crawl_id, url, new_validators, page_images)
+                    changed += page_images is not None
+                for image in state.page_images(url):
+                    if image["image_url"] not in seen_urls:
+                        seen_urls.add(image["image_url"])
+                        image_data.append(image)
+
+            for future in futures.values():
+                future.cancel()
+
+        print(f"{changed} of {fetched} fetched pages were new or changed")
+        if failed:
+            print(f"{len(failed)} pages couldn't be fetched; run the crawl again to retry them")
+            return image_data, None
+        unreached = [url for url, _ in frontier[reached:]]
+        return image_data, state.finish_crawl(crawl_id, image_data, unreached)
+
+    # Downloading images into the image cache, so later stages need no network;
+    # images that are already cached are not fetched again
+    def cache_images(self, images, cache):
+        def fetch(image):
+            try:
+                cache.fetch(image["image_url"], self.get)
+            except Exception as e:
+                print(f"Error caching {image['image_url']}: {e}")
 
-    except Exception as e:
-        print(f"Error processing {url}: {e}")
+        with ThreadPoolExecutor(self.concurrency) as pool:
+            list(tqdm(pool.map(fetch, images), total=len(images), desc="Caching images"))
+
+def clean_animal_name(raw_name):
+    # Lowercase and replace underscores
+    name = raw_name.lower().replace("_", " ")
+
+    # Remove things like '220px', digits, brackets, symbols, and collapse whitespace
+    name = re.sub(r'\b\d{2,4}px\b', '', name)
+    name = re.sub(r'[^a-z\s]', ' ', name)
+    name = re.sub(r'\s+', ' ', name)
+
+    # Keep only the first 2-3 words (optional)
+    name = ' '.join(name.strip().split()[:3])
+
+    return name.title().strip()
+
+def save_images(image_data, delta, json_file="image_surrogates.json"):
+    # Backup existing file
+    if os.path.exists(json_file):
+        shutil.copy(json_file, json_file + ".bak")
+
+    # Load existing data (if any)
+    existing = []
+    if os.path.exists(json_file):
+        try:
+            with open(json_file, "r", encoding="utf-8") as f:
+                existing = json.load(f)
+        except Exception as e:
+            print(f" Couldn't load existing file: {e}")
+    else:
+        print(" No previous file found. Creating new dataset.")
+
+    # Merge + deduplicate based on image_url, dropping images that have disappeared
+    combined = {img["image_url"]: img for img in existing}
+    for image_url in delta["removed"]:
+        combined.pop(image_url, None)
+    for img in image_data:
+        combined[img["image_url"]] = img
+    all_data = list(combined.values())
+
+    with open(json_file, "w", encoding="utf-8") as f:
+        json.dump(all_data, f, indent=2)
+
+    print(f"\n Saved total {len(all_data)} unique images to {json_file}")
 
 # --- MAIN ---
-for category in CATEGORIES:
-    animal_links = get_animal_links_from_category(category, limit=300)
-    print(f"Found {len(animal_links)} animal pages in {category}")
-
-    for link in tqdm(animal_links, desc=f"Crawling {category}"):
-        if len(image_data) >= 10000:
-            break
-        if link not in visited_pages:
-            extract_images_from_page(link)
-            visited_pages.add(link)
-            time.sleep(0.5)
-
-# Backup existing file
-json_file = "image_surrogates.json"
-if os.path.exists(json_file):
-    shutil.copy(json_file, json_file + ".bak")
-
-# Load existing data (if any)
-existing = []
-if os.path.exists(json_file):
-    try:
-        with open(json_file, "r", encoding="utf-8") as f:
-            existing = json.load(f)
-    except Exception as e:
-        print(f" Couldn't load existing file: {e}")
-else:
-    print(" No previous file found. Creating new dataset.")
-
-# Merge + deduplicate based on image_url
-combined = {img["image_url"]: img for img in existing + image_data}
-all_data = list(combined.values())
-
-with open(json_file, "w", encoding="utf-8") as f:
-    json.dump(all_data, f, indent=2)
-
-print(f"\n Saved total {len(all_data)} unique images to {json_file}")
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Crawl animal images from Wikipedia category pages")
+    parser.add_argument("--base-url", default=BASE_URL, help="Wikipedia to crawl, e.g. http://localhost:8000 for stub_wiki_server.py")
+    parser.add_argument("--concurrency", type=int, default=CONCURRENCY)
+    parser.add_argument("--rate", type=float, default=RATE_PER_HOST, help="Requests per second per host")
+    parser.add_argument("--burst", type=int, default=BURST)
+    parser.add_argument("--retries", type=int, default=MAX_RETRIES)
+    parser.add_argument("--limit", type=int, default=300, help="Pages per category")
+    parser.add_argument("--max-images", type=int, default=10000)
+    parser.add_argument("--output", default="image_surrogates.json")
+    parser.add_argument("--state", default="crawl_state.db", help="Crawl state, kept between runs")
+    parser.add_argument("--delta", default="crawl_delta.json", help="Where to write the images added, changed and removed by this crawl")
+    parser.add_argument("--cache-images", action="store_true", help="Also download the images into the image cache")
+    parser.add_argument("--image-cache", default=CACHE_DIR)
+    parser.add_argument("--thumbnails", action="store_true", help="Keep thumbnails of the cached images for the web UI")
+    args = parser.parse_args()
+
+    crawler = Crawler(args.base_url, args.concurrency, args.rate, args.burst, args.retries)
+    start = time.perf_counter()
+    state = CrawlState(args.state)
+    image_data, delta = crawler.crawl(state, CATEGORIES, args.limit, args.max_images)
+    state.close()
+    if delta is None:
+        # Nothing is written until every page has been fetched
+        raise SystemExit(1)
+    print(f"Crawled {len(image_data)} images in {time.perf_counter() - start:.1f}s: "
+          f"{len(delta['added'])} added, {len(delta['changed'])} changed, {len(delta['removed'])} removed")
+
+    with open(args.delta, "w", encoding="utf-8") as f:
+        json.dump(delta, f, indent=2)
+    save_images(image_data, delta, args.output)
+
+    if args.cache_images:
+        crawler.cache_images(image_data, ImageCache(args.image_cache, thumbnail_dir=THUMBNAIL_DIR if args.thumbnails else None))
@@ -0,0 +1,239 @@
+import json
+import os
+import re
+import time
+from collections import Counter
+from io import BytesIO
+import numpy as np
+from PIL import Image
+from document_store import image_score_for
+from embedding_store import EmbeddingStore
+from image_cache import CACHE_DIR, ImageCache
+
+# Near-duplicate detection, run when the index is rebuilt. Wikipedia serves one
+# file at several thumbnail widths and on several pages, and the same photo is
+# sometimes uploaded again or re-cropped. Copies are clustered with three tests
+# and only one image per cluster, its canonical image, is indexed:
+#
+#   same file        thumbnails of one Wikimedia file (.../thumb/a/ab/X.jpg/220px-X.jpg),
+#                    known from the URLs alone
+#   perceptual hash  64-bit dHash of the cached image, the brightness gradients of a
+#                    9x8 grayscale copy, within HASH_DISTANCE bits
+#   CLIP embedding   cosine similarity of the image embeddings of COSINE_THRESHOLD or more
+#
+# Hashes and embeddings are bucketed by locality-sensitive hashing instead of
+# being compared pairwise. A dHash is cut into HASH_BANDS bands, and hashes
+# sharing a band are compared; hashes within HASH_DISTANCE < HASH_BANDS bits
+# always share one. An embedding falls in one bucket per band of LSH_BITS signs
+# against random hyperplanes, after centring the embeddings, which otherwise all
+# lie on the same side of most hyperplanes. Where both images of a pair have a
+# hash and an embedding, a pair found by one test must also pass a looser version
+# of the other, so lookalike hashes of different photos, or two photos of one
+# species, are not copies.
+#
+# Images not in the image cache have no hash and those not embedded yet no
+# embedding; they only take the tests they can. The canonical image of a cluster
+# is its most fully described one (document_store.image_score_for), then the
+# first crawled.
+#
+# The images of a crawl delta are deduplicated against the images already indexed
+# (deduplicate_delta), which are compared with the new images but not with each
+# other. Hashes are kept in the image cache's manifest, so those of the indexed
+# images are only computed once.
+
+HASH_BANDS = 4  # 16-bit bands of a dHash
+HASH_DISTANCE = 3  # Largest number of differing bits between copies' hashes
+HASH_CHECK = 12  # Largest number for pairs found by their embeddings
+LSH_BANDS = 24  # Buckets of each embedding
+LSH_BITS = 8  # Hyperplanes per band
+COSINE_THRESHOLD = 0.95  # Smallest cosine similarity between copies' embeddings
+COSINE_CHECK = 0.9  # Smallest for pairs found by their hashes
+
+_THUMBNAIL = re.compile(r"/thumb/(.+?)/\d+px-[^/]*$")
+
+# The Wikimedia file an image URL is a thumbnail of, or the URL itself
+def original_file(url):
+    match = _THUMBNAIL.search(url)
+    return match.group(1) if match else url
+
+# 64-bit difference hash of an image's bytes
+def dhash(content):
+    image = Image.open(BytesIO(content))
+    image.draft("L", (36, 32))  # Decoding JPEGs at a reduced size
+    pixels = np.asarray(image.convert("L").resize((9, 8), Image.LANCZOS), dtype=np.int16)
+    return int(np.packbits(pixels[:, 1:] > pixels[:, :-1]).view(">u8")[0])
+
+def hamming(a, b):
+    return bin(a ^ b).count("1")
+
+class _Clusters:
+    def __init__(self, n):
+        self.parent = list(range(n))
+
+    def find(self, i):
+        while self.parent[i] != i:
+            self.parent[i] = self.parent[self.parent[i]]
+            i = self.parent[i]
+        return i
+
+    # Joining the clusters of two images; False if they were already one
+    def union(self, i, j):
+        i, j = self.find(i), self.find(j)
+        if i == j:
+            return False
+        self.parent[max(i, j)] = min(i, j)
+        return True
+
+# dHash of every image in the cache that PIL can read, by image number
+def image_hashes(images, cache):
+    hashes = {}
+    for i, image in enumerate(images):
+        h = cache.perceptual_hash(image["image_url"], dhash)
+        if h is not None:
+            hashes[i] = h
+    return hashes
+
+# Unit-length embedding of every embedded image, by image number
+def image_embeddings(images, embeddings):
+    rows = {i: embeddings.row(image["image_url"]) for i, image in enumerate(images)}
+    rows = {i: row for i, row in rows.items() if row is not None}
+    if not rows:
+        return {}
+    vectors = np.asarray(embeddings.vectors[list(rows.values())], dtype=np.float32)
+    return dict(zip(rows, vectors))
+
+# Numbers of the images in each LSH bucket with more than one
+def _embedding_buckets(numbers, vectors, seed=0):
+    centred = vectors - vectors.mean(axis=0)
+    planes = np.random.default_rng(seed).standard_normal((vectors.shape[1], LSH_BANDS * LSH_BITS)).astype(np.float32)
+    signs = (centred @ planes > 0).reshape(len(vectors), LSH_BANDS, LSH_BITS)
+    keys = signs @ (1 << np.arange(LSH_BITS))
+    for band in range(LSH_BANDS):
+        _, bucket_of, sizes = np.unique(keys[:, band], return_inverse=True, return_counts=True)
+        order = np.argsort(bucket_of, kind="stable")
+        for bucket in np.split(order, np.cumsum(sizes)[:-1]):
+            if len(bucket) > 1:
+                yield [numbers[k] for k in bucket]
+
+# Clusters of near-duplicate images, as lists of image numbers, and the number of
+# copies each test found; `hashes` and `vectors` are {image number: dHash or
+# embedding} of the images that have them. Pairs of two of the first `indexed`
+# images are not compared.
+def find_duplicates(images, hashes=None, vectors=None, indexed=0):
+    hashes = hashes or {}
+    vectors = vectors or {}
+    clusters = _Clusters(len(images))
+    found = Counter()
+
+    first_of_file = {}
+    for i, image in enumerate(images):
+        j = first_of_file.setdefault(original_file(image["image_url"]), i)
+        if j != i and clusters.union(j, i):
+            found["same file"] += 1
+
+    hash_buckets = {}
+    for i, h in hashes.items():
+        for band in range(HASH_BANDS):
+            hash_buckets.setdefault((band, (h >> (16 * band)) & 0xFFFF), []).append(i)
+    for bucket in hash_buckets.values():
+        for a, i in enumerate(bucket):
+            for j in bucket[a + 1:]:
+                if max(i, j) < indexed:
+                    continue
+                if hamming(hashes[i], hashes[j]) > HASH_DISTANCE or clusters.find(i) == clusters.find(j):
+                    continue
+                if i in vectors and j in vectors and float(vectors[i] @ vectors[j]) < COSINE_CHECK:
+                    continue
+                if clusters.union(i, j):
+                    found["perceptual hash"] += 1
+
+    if len(vectors) > 1:
+        numbers = list(vectors)
+        matrix = np.stack([vectors[i] for i in numbers])
+        for bucket in _embedding_buckets(numbers, matrix):
+            if max(bucket) < indexed:
+                continue
+            bucket_vectors = np.stack([vectors[i] for i in bucket])
+            similarities = bucket_vectors @ bucket_vectors.T
+            for a, b in zip(*np.nonzero(np.triu(similarities >= COSINE_THRESHOLD, 1))):
+                i, j = bucket[a], bucket[b]
+                if max(i, j) < indexed or clusters.find(i) == clusters.find(j):
+                    continue
+                if i in hashes and j in hashes and hamming(hashes[i], hashes[j]) > HASH_CHECK:
+                    continue
+                if clusters.union(i, j):
+                    found["CLIP embedding"] += 1
+
+    members = {}
+    for i in range(len(images)):
+        members.setdefault(clusters.find(i), []).append(i)
+    return list(members.values()), found
+
+def canonical_image(images, cluster):
+    return min(cluster, key=lambda i: (-image_score_for(images[i]), i))
+
+# The images without their near-duplicates, in crawl order, and a report of what
+# was dropped. The first `indexed` images are ones already indexed, one per
+# cluster: the others are compared with them, and only those that aren't copies of
+# them are returned.
+def deduplicate(images, cache=None, embeddings=None, indexed=0):
+    start = time.perf_counter()
+    hashes = image_hashes(images, cache) if cache is not None else {}
+    vectors = image_embeddings(images, embeddings) if embeddings is not None else {}
+    clusters, found = find_duplicates(images, hashes, vectors, indexed)
+    kept = sorted(canonical_image(images, cluster) for cluster in clusters if min(cluster) >= indexed)
+    report = {
+        "images": len(images) - indexed,
+        "kept": len(kept),
+        "hashed": sum(i >= indexed for i in hashes),
+        "embedded": sum(i >= indexed for i in vectors),
+        "found": dict(found),
+        "clusters": sorted((cluster for cluster in clusters if len(cluster) > 1 and max(cluster) >= indexed),
+                           key=len, reverse=True),
+        "seconds": time.perf_counter() - start,
+    }
+    return [images[i] for i in kept], report
+
+# A crawl delta without the added and changed images that are near-duplicates of
+# the images indexed (`indexed_urls`) or of each other, and a report. The indexed
+# copy of a cluster stays its canonical image; indexed images found to have
+# changed into a copy of another are removed.
+def deduplicate_delta(delta, indexed_urls, cache=None, embeddings=None):
+    images = delta["added"] + delta["changed"]
+    touched = {image["image_url"] for image in images}.union(delta["removed"])
+    indexed = [{"image_url": url} for url in sorted(indexed_urls or ()) if url not in touched]
+    kept, report = deduplicate(indexed + images, cache, embeddings, len(indexed))
+    kept_urls = {image["image_url"] for image in kept}
+    dropped = [image["image_url"] for image in images if image["image_url"] not in kept_urls]
+    delta = {
+        "added": [image for image in delta["added"] if image["image_url"] in kept_urls],
+        "changed": [image for image in delta["changed"] if image["image_url"] in kept_urls],
+        "removed": delta["removed"] + dropped,
+    }
+    return delta, report
+
+def describe(report):
+    dropped = report["images"] - report["kept"]
+    found = ", ".join(f"{count} by {test}" for test, count in report["found"].items()) or "none"
+    return (f" Dropped {dropped} near-duplicate images ({found}): {report['images']} -> {report['kept']} images, "
+            f"{dropped / max(report['images'], 1):.1%} fewer, in {report['seconds']:.1f} s "
+            f"({report['hashed']} hashed, {report['embedded']} embedded)")
+
+# The image cache and embedding store, where they exist
+def open_sources(cache_dir=CACHE_DIR, embeddings_prefix="image_embeddings"):
+    cache = ImageCache(cache_dir, thumbnail_dir=None) if os.path.isdir(cache_dir) else None
+    embeddings = EmbeddingStore(embeddings_prefix) if os.path.exists(embeddings_prefix + ".npy") else None
+    return cache, embeddings
+
+# Reporting the near-duplicate clusters of image_surrogates.json without indexing anything
+if __name__ == "__main__":
+    with open("image_surrogates.json", "r", encoding="utf-8") as f:
+        images = json.load(f)
+    kept, report = deduplicate(images, *open_sources())
+    print(describe(report))
+    for cluster in report["clusters"][:10]:
+        canonical = canonical_image(images, cluster)
+        print(f"\n {len(cluster)} copies, keeping {images[canonical]['image_url']}")
+        for i in cluster:
+            if i != canonical:
+                print(f"   {images[i]['image_url']} ({images[i]['source_page']})")
@@ -0,0 +1,89 @@
+import hashlib
+import json
+from binary_index import StringTable, _array, _array_bytes, open_sections, pack_strings, write_sections
+
+# Document store: the image surrogates as one JSON record per document, in a
+# memory-mapped file written with write_sections. Records are decoded on access,
+# so each lookup returns a fresh dict. Numbers are little-endian, as in the binary
+# index, so a store can be read on any machine.
+#
+#   records          JSON records stored back to back
+#   records.offsets  u64 start of each record
+#   urls             image URLs in sorted order, for lookups by URL
+#   urls.offsets     u64 start of each URL
+#   url_docs         u32 position of the document with each URL
+#
+# and what search shows of each document, worked out once when the store is written:
+#
+#   group_ids        u64 group of the document: images of the same source page share
+#                    one, and search shows one image per group
+#   image_scores     u32 how well the image stands for its page whatever the query,
+#                    the words in its alt text; a page's canonical image is its
+#                    highest-scoring one
+#   titles           title to display with each document, stored like records
+#   titles.offsets   u64 start of each title
+
+def group_id_for(doc):
+    page = f"{doc.get('title', '')}\n{doc.get('source_page', '')}"
+    return int(hashlib.sha1(page.encode("utf-8")).hexdigest()[:16], 16)
+
+# The most fully described image of a page stands for it
+def image_score_for(doc):
+    return len(doc.get("alt_text", "").split())
+
+def clean_display_title(text):
+    blacklist = {
+        "a", "an", "the", "close", "view", "photo", "image", "standing", "in", "on", "by",
+        "bush", "area", "kruger", "park", "wildlife", "zoo", "africa"
+    }
+    words = text.lower().strip().split()
+    filtered = [word for word in words if word not in blacklist]
+    if not filtered:
+        return text.title()
+    final_words = filtered[:3]
+    return " ".join(w.capitalize() for w in final_words)
+
+# The animal name, or the page title, without filler words; the alt text is shown apart
+def display_title_for(doc):
+    return clean_display_title(doc.get("animal_name", "").strip() or doc.get("title", "").strip())
+
+def write_documents(path, documents):
+    blob, offsets = pack_strings(json.dumps(doc, ensure_ascii=False) for doc in documents)
+    urls = [doc.get("image_url", "") for doc in documents]
+    order = sorted(range(len(urls)), key=urls.__getitem__)
+    url_blob, url_offsets = pack_strings(urls[i] for i in order)
+    titles_blob, titles_offsets = pack_strings(display_title_for(doc) for doc in documents)
+    write_sections(path, [
+        ("records", blob),
+        ("records.offsets", offsets),
+        ("urls", url_blob),
+        ("urls.offsets", url_offsets),
+        ("url_docs", _array_bytes("I", order)),
+        ("group_ids", _array_bytes("Q", map(group_id_for, documents))),
+        ("image_scores", _array_bytes("I", map(image_score_for, documents))),
+        ("titles", titles_blob),
+        ("titles.offsets", titles_offsets),
+    ])
+
+class DocumentStore:
+    def __init__(self, path):
+        sections = open_sections(path)
+        if "group_ids" not in sections:
+            raise ValueError(f"{path} was written by an older version of write_documents without display data; rebuild the index")
+        self._records = StringTable(sections["records"], sections["records.offsets"])
+        self._urls = StringTable(sections["urls"], sections["urls.offsets"])
+        self._url_docs = _array("I", sections["url_docs"])
+        self.group_ids = _array("Q", sections["group_ids"])
+        self.image_scores = _array("I", sections["image_scores"])
+        self.display_titles = StringTable(sections["titles"], sections["titles.offsets"])
+
+    def __len__(self):
+        return len(self._records)
+
+    def __getitem__(self, i):
+        return json.loads(self._records[i])
+
+    # Position of the document with an image URL, or None
+    def find_url(self, url):
+        i = self._urls.find(url)
+        return self._url_docs[i] if i is not None else None
@@ -1,50 +1,127 @@
+import argparse
 import os
 import json
 import torch
 import clip
 import requests
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
 from io import BytesIO
+from requests.adapters import HTTPAdapter
 from tqdm import tqdm
+from embedding_store import EmbeddingWriter
+from image_cache import CACHE_DIR, THUMBNAIL_DIR, ImageCache
+from ann_index import build_ivf_file
+from segment_index import indexed_urls
 
-# Load CLIP model
-device = "cuda" if torch.cuda.is_available() else "cpu"
-model, preprocess = clip.load("ViT-B/32", device=device)
+# Embedding every image in image_surrogates.json with CLIP as a pipeline:
+#   download threads -> decode/preprocess threads -> batched inference (main thread)
+# Each batch of embeddings is appended to image_embeddings.log as soon as it is
+# computed, so an interrupted run loses at most one batch; restarting skips every
+# image that is already in the store or the log. Images are read through the local
+# image cache, so re-embedding (e.g. with another model) needs no downloads.
 
-# Load image metadata
-with open("image_surrogates.json", "r", encoding="utf-8") as f:
-    images = json.load(f)
+# Storage precision of the embedding matrix ("float16" halves its size, "float32" keeps full precision)
+EMBEDDING_DTYPE = "float16"
 
-image_embeddings = []
+BATCH_SIZE = 32  # Images per CLIP forward pass
+DOWNLOAD_WORKERS = 16
+PREPROCESS_WORKERS = os.cpu_count() or 4
+USER_AGENT = "search-engine-project-crawler/1.0 (educational image search crawler)"
 
-print(f" Processing {len(images)} images with CLIP...")
+def download_image(session, url, cache=None):
+    if cache is not None:
+        return cache.fetch(url, lambda url: session.get(url, timeout=10))
+    response = session.get(url, timeout=10)
+    response.raise_for_status()
+    return response.content
 
-for img in tqdm(images):
-    try:
-        url = img["image_url"]
-        response = requests.get(url, timeout=10)
-        image = Image.open(BytesIO(response.content)).convert("RGB")
-        image_input = preprocess(image).unsqueeze(0).to(device)
+def prepare_image(content, preprocess):
+    image = Image.open(BytesIO(content)).convert("RGB")
+    return preprocess(image)
 
-        with torch.no_grad():
-            image_features = model.encode_image(image_input)
-            image_features /= image_features.norm(dim=-1, keepdim=True)  # normalize
+# Preprocessed images as (url, tensor or exception), in the order of `urls`, with
+# at most `window` images downloading or being preprocessed at a time
+def prepared_images(urls, preprocess, window, download_workers=DOWNLOAD_WORKERS, preprocess_workers=PREPROCESS_WORKERS, cache=None):
+    session = requests.Session()
+    session.headers["User-Agent"] = USER_AGENT
+    adapter = HTTPAdapter(pool_connections=download_workers, pool_maxsize=download_workers)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
 
-        # Save vector and metadata
-        image_embeddings.append({
-            "image_url": url,
-            "title": img.get("title", ""),
-            "alt_text": img.get("alt_text", ""),
-            "source_page": img.get("source_page", ""),
-            "animal_name": img.get("animal_name", ""),
-            "embedding": image_features[0].cpu().tolist()
-        })
+    with ThreadPoolExecutor(download_workers) as downloads, ThreadPoolExecutor(preprocess_workers) as decoders:
+        # Each download hands its bytes straight to the preprocessing pool
+        def fetch(url):
+            content = download_image(session, url, cache)
+            return decoders.submit(prepare_image, content, preprocess)
 
-    except Exception as e:
-        print(f" Skipped image {img['image_url']} due to error: {e}")
+        pending = deque()
+        urls = iter(urls)
+        while True:
+            while len(pending) < window:
+                url = next(urls, None)
+                if url is None:
+                    break
+                pending.append((url, downloads.submit(fetch, url)))
+            if not pending:
+                return
+            url, future = pending.popleft()
+            try:
+                yield url, future.result().result()
+            except Exception as e:
+                yield url, e
 
-# Save all embeddings
-with open("image_embeddings.json", "w", encoding="utf-8") as f:
-    json.dump(image_embeddings, f, indent=2)
+def encode_batch(model, device, tensors):
+    with torch.no_grad():
+        image_features = model.encode_image(torch.stack(tensors).to(device))
+        image_features /= image_features.norm(dim=-1, keepdim=True)  # normalize
+    return image_features.float().cpu().numpy()
 
-print(f"\n Saved {len(image_embeddings)} image embeddings to image_embeddings.json")
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Embed the crawled images with CLIP")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--download-workers", type=int, default=DOWNLOAD_WORKERS)
+    parser.add_argument("--preprocess-workers", type=int, default=PREPROCESS_WORKERS)
+    parser.add_argument("--image-cache", default=CACHE_DIR, help="Image cache directory; empty to always download")
+    parser.add_argument("--thumbnails", action="store_true", help="Keep thumbnails of the cached images for the web UI")
+    args = parser.parse_args()
+
+    # Load CLIP model
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    model, preprocess = clip.load("ViT-B/32", device=device)
+
+    # Load image metadata
+    with open("image_surrogates.json", "r", encoding="utf-8") as f:
+        images = json.load(f)
+    image_urls = list(dict.fromkeys(img["image_url"] for img in images))
+
+    # Vectors are saved keyed by URL; metadata stays in image_surrogates.json
+    writer = EmbeddingWriter("image_embeddings", dtype=EMBEDDING_DTYPE)
+    done = writer.embedded_urls()
+    todo = [url for url in image_urls if url not in done]
+    print(f" Processing {len(todo)} images with CLIP ({len(image_urls) - len(todo)} already embedded)...")
+
+    cache = ImageCache(args.image_cache, thumbnail_dir=THUMBNAIL_DIR if args.thumbnails else None) if args.image_cache else None
+    images_in = prepared_images(todo, preprocess, 4 * args.batch_size, args.download_workers, args.preprocess_workers, cache)
+    batch_urls, batch_tensors = [], []
+    for url, result in tqdm(images_in, total=len(todo)):
+        if isinstance(result, Exception):
+            print(f" Skipped image {url} due to error: {result}")
+            continue
+        batch_urls.append(url)
+        batch_tensors.append(result)
+        if len(batch_tensors) == args.batch_size:
+            writer.append(batch_urls, encode_batch(model, device, batch_tensors))
+            batch_urls, batch_tensors = [], []
+    if batch_tensors:
+        writer.append(batch_urls, encode_batch(model, device, batch_tensors))
+
+    # Merge the log into one normalised matrix with a URL -> row index, dropping images no longer crawled
+    count = writer.finish(keep=set(image_urls))
+    print(f"\n Saved {count} image embeddings to image_embeddings.npy")
+
+    # Build the ANN index used for dense (CLIP-only) retrieval, over the indexed images:
+    # the near-duplicates the indexer dropped keep their embeddings for dedup.py only
+    ivf = build_ivf_file("image_embeddings", keep=indexed_urls())
+    print(f" Saved IVF index with {len(ivf.centroids)} lists over {len(ivf.list_rows)} embeddings to image_embeddings.ivf")
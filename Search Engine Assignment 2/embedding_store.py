@@ -0,0 +1,184 @@
+import os
+import struct
+import numpy as np
+from binary_index import StringTable, open_sections, pack_strings, write_sections
+
+# Embedding store: CLIP image embeddings as one contiguous, L2-normalised
+# float16 or float32 matrix in `<prefix>.npy`, opened memory-mapped, plus a URL
+# index in `<prefix>.idx` (written with write_sections) that maps each image URL
+# to its row. As rows are unit length, cosine similarity is a plain dot product.
+#
+#   urls          image URLs in sorted order
+#   urls.offsets  u64 start of each URL
+#   rows          u32 matrix row of each URL
+#   positions     u32 position in `urls` of each matrix row
+#
+# EmbeddingWriter adds embeddings in chunks: they are appended to `<prefix>.log`
+# (magic, u32 dimension, then per embedding a u32 URL length, the UTF-8 URL and
+# the unit-length float32 vector) and merged into the store by finish(). A
+# record cut short by a crash is dropped when the log is reopened.
+
+_CHUNK = 65536  # Rows scored at a time by exhaustive search
+_LOG_MAGIC = b"SEEMB"
+_LOG_HEADER = struct.Struct("<5sI")
+_URL_LENGTH = struct.Struct("<I")
+
+# Indices of the k largest scores, best first
+def top_k(scores, k):
+    if k >= len(scores):
+        return np.argsort(-scores, kind="stable")
+    best = np.argpartition(-scores, k - 1)[:k]
+    return best[np.argsort(-scores[best], kind="stable")]
+
+def normalize_rows(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms > 0, norms, 1)
+
+def write_embedding_store(prefix, urls, vectors, dtype="float16"):
+    _write_store(prefix, urls, normalize_rows(vectors).astype(dtype))
+
+# Writing already normalised vectors
+def _write_store(prefix, urls, vectors):
+    with open(prefix + ".npy.tmp", "wb") as f:
+        np.save(f, vectors)
+    os.replace(prefix + ".npy.tmp", prefix + ".npy")
+
+    order = sorted(range(len(urls)), key=urls.__getitem__)
+    positions = np.empty(len(order), dtype="<u4")
+    positions[order] = np.arange(len(order))
+    blob, offsets = pack_strings(urls[row] for row in order)
+    write_sections(prefix + ".idx", [
+        ("urls", blob),
+        ("urls.offsets", offsets),
+        ("rows", np.asarray(order, dtype="<u4").tobytes()),
+        ("positions", positions.tobytes()),
+    ])
+
+class EmbeddingStore:
+    def __init__(self, prefix):
+        self.vectors = np.load(prefix + ".npy", mmap_mode="r")
+        sections = open_sections(prefix + ".idx")
+        self._urls = StringTable(sections["urls"], sections["urls.offsets"])
+        self._rows = np.frombuffer(sections["rows"], dtype="<u4")
+        self._positions = np.frombuffer(sections["positions"], dtype="<u4")
+
+    def __len__(self):
+        return len(self._rows)
+
+    def row(self, url):
+        i = self._urls.find(url)
+        return int(self._rows[i]) if i is not None else None
+
+    def url(self, row):
+        return self._urls[int(self._positions[row])]
+
+    # Embedding of an image, or None if it was never embedded
+    def get(self, url):
+        row = self.row(url)
+        return self.vectors[row] if row is not None else None
+
+    # Cosine similarity of a unit-length query vector with each image, computed as one
+    # matrix-vector product over the matching rows; images without an embedding get 0
+    def similarities(self, query_vector, urls):
+        rows = [self.row(url) for url in urls]
+        found = [i for i, row in enumerate(rows) if row is not None]
+        scores = np.zeros(len(urls), dtype=np.float32)
+        if found:
+            matrix = self.vectors[[rows[i] for i in found]].astype(np.float32)
+            scores[found] = matrix @ np.asarray(query_vector, dtype=np.float32)
+        return scores
+
+    # Exact top-k rows for a unit-length query, with their cosine similarities
+    def search(self, query_vector, k):
+        query_vector = np.asarray(query_vector, dtype=np.float32)
+        scores = np.empty(len(self.vectors), dtype=np.float32)
+        for start in range(0, len(self.vectors), _CHUNK):
+            scores[start:start + _CHUNK] = np.asarray(self.vectors[start:start + _CHUNK], dtype=np.float32) @ query_vector
+        best = top_k(scores, k)
+        return best, scores[best]
+
+class EmbeddingWriter:
+    def __init__(self, prefix, dtype="float16"):
+        self.prefix = prefix
+        self.dtype = dtype
+        self.log_path = prefix + ".log"
+        self.stored_urls = []
+        self.dim = None
+        if os.path.exists(prefix + ".npy") and os.path.exists(prefix + ".idx"):
+            store = EmbeddingStore(prefix)
+            self.stored_urls = [store.url(row) for row in range(len(store))]
+            self.dim = store.vectors.shape[1]
+        self.log_urls, self.log_vectors, log_dim = self._read_log()
+        self.dim = log_dim or self.dim
+
+    def _read_log(self):
+        urls, vectors = [], []
+        if not os.path.exists(self.log_path):
+            return urls, vectors, None
+        with open(self.log_path, "rb") as f:
+            data = f.read()
+        if len(data) < _LOG_HEADER.size:
+            os.remove(self.log_path)
+            return urls, vectors, None
+        magic, dim = _LOG_HEADER.unpack_from(data, 0)
+        if magic != _LOG_MAGIC:
+            raise ValueError(f"{self.log_path} is not an embedding log")
+        position = _LOG_HEADER.size
+        while position + _URL_LENGTH.size <= len(data):
+            (length,) = _URL_LENGTH.unpack_from(data, position)
+            end = position + _URL_LENGTH.size + length + 4 * dim
+            if end > len(data):
+                break
+            urls.append(data[position + _URL_LENGTH.size:position + _URL_LENGTH.size + length].decode("utf-8"))
+            vectors.append(np.frombuffer(data, dtype="<f4", count=dim, offset=end - 4 * dim))
+            position = end
+        # Cutting off a partly written record
+        if position < len(data):
+            with open(self.log_path, "r+b") as f:
+                f.truncate(position)
+        return urls, vectors, dim
+
+    # URLs that already have an embedding, in the store or in the log
+    def embedded_urls(self):
+        return set(self.stored_urls) | set(self.log_urls)
+
+    # Appending a chunk of embeddings to the log; it is on disk when this returns
+    def append(self, urls, vectors):
+        vectors = normalize_rows(vectors)
+        if self.dim is not None and vectors.shape[1] != self.dim:
+            raise ValueError(f"Expected {self.dim}-d embeddings, got {vectors.shape[1]}-d")
+        self.dim = vectors.shape[1]
+        if not os.path.exists(self.log_path):
+            with open(self.log_path, "wb") as f:
+                f.write(_LOG_HEADER.pack(_LOG_MAGIC, self.dim))
+
+        chunk = bytearray()
+        for url, vector in zip(urls, vectors):
+            encoded = url.encode("utf-8")
+            chunk += _URL_LENGTH.pack(len(encoded)) + encoded + vector.astype("<f4").tobytes()
+        with open(self.log_path, "ab") as f:
+            f.write(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+        self.log_urls.extend(urls)
+        self.log_vectors.extend(vectors)
+
+    # Merging the log into the store; embeddings of URLs not in `keep` are dropped
+    def finish(self, keep=None):
+        rows = {}
+        if self.stored_urls:
+            stored = np.load(self.prefix + ".npy")
+            for url, vector in zip(self.stored_urls, stored):
+                rows[url] = vector
+        for url, vector in zip(self.log_urls, self.log_vectors):
+            rows[url] = vector.astype(self.dtype)
+        if keep is not None:
+            rows = {url: vector for url, vector in rows.items() if url in keep}
+        urls = list(rows)
+        vectors = np.array(list(rows.values()), dtype=self.dtype).reshape(len(urls), self.dim or 0)
+        _write_store(self.prefix, urls, vectors)
+        if os.path.exists(self.log_path):
+            os.remove(self.log_path)
+        self.stored_urls, self.log_urls, self.log_vectors = urls, [], []
+        return len(urls)
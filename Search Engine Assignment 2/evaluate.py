@@ -1,45 +1,30 @@
 import json
-from app import bm25_search  # directly use your app's bm25+CLIP search
+from app import bm25_search_many  # directly use your app's bm25+CLIP search
 from tqdm import tqdm
+from ir_eval import evaluate
 
-def precision_at_k(retrieved, relevant, k):
-    retrieved_at_k = retrieved[:k]
-    relevant_retrieved = [doc for doc in retrieved_at_k if doc in relevant]
-    return len(relevant_retrieved) / k
-
-def average_precision(retrieved, relevant):
-    hits = 0
-    sum_precisions = 0.0
-    for i, doc in enumerate(retrieved):
-        if doc in relevant:
-            hits += 1
-            sum_precisions += hits / (i + 1)
-    return sum_precisions / len(relevant) if relevant else 0.0
+BATCH_SIZE = 32  # Queries encoded by CLIP per forward pass
 
 def evaluate_all(queries, ground_truth, k_values=[5, 10]):
-    map_total = 0
-    precision_totals = {k: 0 for k in k_values}
-    num_queries = 0
-
-    for query in tqdm(queries, desc="Evaluating"):
-        if query not in ground_truth:
-            continue
+    queries = [query for query in queries if query in ground_truth]
+    all_results = []
+    for start in tqdm(range(0, len(queries), BATCH_SIZE), desc="Evaluating"):
+        all_results += bm25_search_many(queries[start:start + BATCH_SIZE], top_k=max(k_values))
 
-        relevant = ground_truth[query]
-        results = bm25_search(query, top_k=max(k_values))
-        retrieved_urls = [r["image_url"] for r in results]
-
-        num_queries += 1
-        map_total += average_precision(retrieved_urls, relevant)
-        for k in k_values:
-            precision_totals[k] += precision_at_k(retrieved_urls, relevant, k)
+    # Every image in a query's ground truth counts as relevant
+    qrels = {query: {url: 1 for url in ground_truth[query]} for query in queries}
+    rankings = {query: [r["image_url"] for r in results] for query, results in zip(queries, all_results)}
+    metrics = evaluate(qrels, rankings, k_values)
 
     results = {
-        "MAP": round(map_total / num_queries, 4)
+        "MAP": round(metrics["map"], 4)
     }
     for k in k_values:
-        results[f"Precision@{k}"] = round(precision_totals[k] / num_queries, 4)
-    
+        results[f"Precision@{k}"] = round(metrics[f"P_{k}"], 4)
+    for k in k_values:
+        results[f"nDCG@{k}"] = round(metrics[f"ndcg_cut_{k}"], 4)
+        results[f"Recall@{k}"] = round(metrics[f"recall_{k}"], 4)
+    results["MRR"] = round(metrics["recip_rank"], 4)
     return results
 
 # Load queries
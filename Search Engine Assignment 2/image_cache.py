@@ -0,0 +1,198 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from io import BytesIO
+import requests
+from requests.adapters import HTTPAdapter
+from PIL import Image
+
+# Content-addressed cache of downloaded images, shared by crawler.py,
+# embed_images.py and app.py. Image bytes are stored once per SHA-256 under
+# `objects/`, and `manifest.db` maps each URL to the hash of its content:
+#
+#   urls               url -> hash
+#   objects            hash -> size in bytes, thumbnail included, and time of last access
+#   perceptual_hashes  hash -> 64-bit perceptual hash of the image (see dedup.py)
+#
+# Optionally, when `thumbnail_dir` is set (e.g. THUMBNAIL_DIR), a JPEG thumbnail
+# of each image is kept there as `<hash>.jpg`, which app.py serves from
+# static/images/thumbs. Once the objects and their thumbnails take more than
+# `max_bytes`, the least recently used ones are evicted together. The crawler,
+# embedder and app share the manifest, so the total is read from it before every
+# eviction rather than counted by each process.
+
+CACHE_DIR = "image_cache"
+THUMBNAIL_DIR = os.path.join("static", "images", "thumbs")
+MAX_BYTES = 2 * 1024 ** 3
+DOWNLOAD_TIMEOUT = 30  # Seconds, as crawler.py
+DOWNLOAD_POOL_SIZE = 8
+THUMBNAIL_SIZE = (320, 320)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS urls (url TEXT PRIMARY KEY, hash TEXT);
+CREATE TABLE IF NOT EXISTS objects (hash TEXT PRIMARY KEY, size INTEGER, accessed REAL);
+CREATE INDEX IF NOT EXISTS urls_by_hash ON urls (hash);
+CREATE TABLE IF NOT EXISTS perceptual_hashes (hash TEXT PRIMARY KEY, value INTEGER);
+"""
+
+class ImageCache:
+    def __init__(self, directory=CACHE_DIR, max_bytes=MAX_BYTES, thumbnail_dir=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.thumbnail_dir = thumbnail_dir
+        os.makedirs(os.path.join(directory, "objects"), exist_ok=True)
+        if thumbnail_dir:
+            os.makedirs(thumbnail_dir, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(directory, "manifest.db"), check_same_thread=False, timeout=30)
+        self.db.executescript(SCHEMA)
+        self.lock = threading.Lock()
+        # Keep-alive connections for downloads without a downloader of their own,
+        # shared by the threads using the cache
+        adapter = HTTPAdapter(pool_connections=DOWNLOAD_POOL_SIZE, pool_maxsize=DOWNLOAD_POOL_SIZE)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def _object_path(self, content_hash):
+        return os.path.join(self.directory, "objects", content_hash[:2], content_hash)
+
+    def _thumbnail_path(self, content_hash):
+        return os.path.join(self.thumbnail_dir, content_hash + ".jpg")
+
+    def hash_of(self, url):
+        with self.lock:
+            row = self.db.execute("SELECT hash FROM urls WHERE url = ?", (url,)).fetchone()
+        return row[0] if row else None
+
+    # Cached bytes of an image, or None
+    def get(self, url):
+        content_hash = self.hash_of(url)
+        if content_hash is None:
+            return None
+        try:
+            with open(self._object_path(content_hash), "rb") as f:
+                content = f.read()
+        except OSError:
+            return None
+        with self.lock, self.db:
+            self.db.execute("UPDATE objects SET accessed = ? WHERE hash = ?", (time.time(), content_hash))
+        return content
+
+    def put(self, url, content):
+        content_hash = hashlib.sha256(content).hexdigest()
+        path = self._object_path(content_hash)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(temp_path, "wb") as f:
+                f.write(content)
+            os.replace(temp_path, path)
+        size = len(content)
+        if self.thumbnail_dir:
+            if not os.path.exists(self._thumbnail_path(content_hash)):
+                self._write_thumbnail(content, content_hash)
+            try:
+                size += os.path.getsize(self._thumbnail_path(content_hash))
+            except OSError:
+                pass
+
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO urls VALUES (?, ?)", (url, content_hash))
+            self.db.execute("INSERT OR REPLACE INTO objects VALUES (?, ?, ?)", (content_hash, size, time.time()))
+        self.evict(keep=content_hash)
+        return content_hash
+
+    def _write_thumbnail(self, content, content_hash):
+        try:
+            image = Image.open(BytesIO(content)).convert("RGB")
+            image.thumbnail(THUMBNAIL_SIZE)
+            temp_path = f"{self._thumbnail_path(content_hash)}.{threading.get_ident()}.tmp"
+            image.save(temp_path, "JPEG", quality=85)
+            os.replace(temp_path, self._thumbnail_path(content_hash))
+        except Exception as e:
+            print(f" Couldn't make a thumbnail of {content_hash}: {e}")
+
+    # Read-through: the cached bytes, or the bytes downloaded with `download(url)`
+    # (a GET on the cache's session, timing out after DOWNLOAD_TIMEOUT, by default),
+    # which are then cached if the download succeeded
+    def fetch(self, url, download=None):
+        content = self.get(url)
+        if content is None:
+            response = download(url) if download else self.session.get(url, timeout=DOWNLOAD_TIMEOUT)
+            response.raise_for_status()
+            content = response.content
+            self.put(url, content)
+        return content
+
+    # Perceptual hash of a cached image, computed from its bytes by `compute` the
+    # first time and kept in the manifest; None if it isn't cached or can't be read.
+    # Hashes are unsigned 64-bit and stored as SQLite's signed integers.
+    def perceptual_hash(self, url, compute):
+        content_hash = self.hash_of(url)
+        if content_hash is None:
+            return None
+        with self.lock:
+            row = self.db.execute("SELECT value FROM perceptual_hashes WHERE hash = ?", (content_hash,)).fetchone()
+        if row:
+            return row[0] % 2**64
+        content = self.get(url)
+        if content is None:
+            return None
+        try:
+            value = compute(content)
+        except Exception:
+            return None  # Not an image PIL can read
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO perceptual_hashes VALUES (?, ?)",
+                            (content_hash, value - 2**64 if value >= 2**63 else value))
+        return value
+
+    # Thumbnail path relative to static/, or None
+    def thumbnail(self, url):
+        content_hash = self.hash_of(url)
+        if content_hash is None or not self.thumbnail_dir:
+            return None
+        if not os.path.exists(self._thumbnail_path(content_hash)):
+            return None
+        return os.path.relpath(self._thumbnail_path(content_hash), "static").replace(os.sep, "/")
+
+    # Size of every cached object and thumbnail, by whichever process cached it
+    def total_bytes(self):
+        with self.lock:
+            return self.db.execute("SELECT COALESCE(SUM(size), 0) FROM objects").fetchone()[0]
+
+    # Removing least recently used objects and their thumbnails until the cache fits in max_bytes
+    def evict(self, keep=None):
+        with self.lock:
+            total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM objects").fetchone()[0]
+            if total <= self.max_bytes:
+                return 0
+            evicted = []
+            for content_hash, size in self.db.execute("SELECT hash, size FROM objects ORDER BY accessed").fetchall():
+                if total <= self.max_bytes:
+                    break
+                if content_hash == keep:
+                    continue
+                evicted.append(content_hash)
+                total -= size
+            with self.db:
+                self.db.executemany("DELETE FROM objects WHERE hash = ?", [(h,) for h in evicted])
+                self.db.executemany("DELETE FROM urls WHERE hash = ?", [(h,) for h in evicted])
+                self.db.executemany("DELETE FROM perceptual_hashes WHERE hash = ?", [(h,) for h in evicted])
+        # Thumbnails go too, wherever a cache opened with thumbnails left them
+        thumbnail_dir = self.thumbnail_dir or THUMBNAIL_DIR
+        for content_hash in evicted:
+            for path in (self._object_path(content_hash), os.path.join(thumbnail_dir, content_hash + ".jpg")):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+        return len(evicted)
+
+if __name__ == "__main__":
+    cache = ImageCache(thumbnail_dir=THUMBNAIL_DIR)
+    evicted = cache.evict()
+    count = cache.db.execute("SELECT COUNT(*) FROM urls").fetchone()[0]
+    print(f" {count} images, {cache.total_bytes() / 1024 ** 2:.1f} MB in {CACHE_DIR}/ ({evicted} evicted)")
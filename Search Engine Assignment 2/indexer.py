@@ -1,25 +1,12 @@
+import argparse
 import json
-import os
 import re
-import nltk
-from collections import defaultdict
-from nltk.corpus import stopwords
-from nltk.tokenize import word_tokenize
-
-nltk.download('punkt')
-nltk.download('stopwords')
-
-# Load data
-with open("image_surrogates.json", "r", encoding="utf-8") as f:
-    data = json.load(f)
-
-stop_words = set(stopwords.words("english"))
-inverted_index = defaultdict(set)
-tf_index = defaultdict(lambda: defaultdict(int))
-
-def preprocess(text):
-    tokens = word_tokenize(text.lower())
-    return [t for t in tokens if t.isalnum() and t not in stop_words]
+import time
+import os
+from analyzer import Analyzer
+from ann_index import build_ivf_file, update_ivf_file
+from dedup import deduplicate, deduplicate_delta, describe, open_sources
+from segment_index import SegmentWriter, indexed_urls
 
 def clean_animal_name(animal_name):
     animal_name = animal_name.lower()
@@ -28,45 +15,87 @@ def clean_animal_name(animal_name):
     animal_name = re.sub(r'\s+', ' ', animal_name)  # collapse whitespace
     return animal_name.strip()
 
-# Build index
-for idx, item in enumerate(data):
-    doc_id = str(idx)
+# Fields of an image surrogate, indexed with their own tfs and lengths for BM25F
+FIELDS = ("title", "alt_text", "filename", "animal_name")
 
+# Text of each field of an image surrogate
+def document_fields(item):
     title = item.get("title", "")
     alt = item.get("alt_text", "")
     filename = item.get("image_url", "").split("/")[-1].replace("_", " ").lower()
     animal_name = clean_animal_name(item.get("animal_name", ""))
-
-    full_text = f"{title} {alt} {filename} {animal_name}"
-    terms = preprocess(full_text)
-
-    for term in terms:
-        inverted_index[term].add(doc_id)
-        tf_index[doc_id][term] += 1
-
-# Convert sets to lists
-inverted_index = {term: list(postings) for term, postings in inverted_index.items()}
-
-# Save to 'index' folder
-os.makedirs("index", exist_ok=True)
-
-with open("index/inverted_index.json", "w", encoding="utf-8") as f:
-    json.dump(inverted_index, f, indent=2)
-
-with open("index/tf_index.json", "w", encoding="utf-8") as f:
-    json.dump(tf_index, f, indent=2)
-
-# BM25 doc lengths
-doc_lengths = {doc_id: sum(freqs.values()) for doc_id, freqs in tf_index.items()}
-avg_doc_length = sum(doc_lengths.values()) / len(doc_lengths)
-
-bm25_data = {
-    "doc_lengths": doc_lengths,
-    "avg_doc_length": avg_doc_length
-}
-
-with open("index/bm25_data.json", "w", encoding="utf-8") as f:
-    json.dump(bm25_data, f, indent=2)
-
-print(f" Indexed {len(data)} images.")
-print(f" Saved index files in 'index/' folder.")
+    return [title, alt, filename, animal_name]
+
+# Text indexed for an image surrogate
+def document_text(item):
+    return " ".join(document_fields(item))
+
+# Terms of each field of a list of image surrogates, or of the whole surrogate
+# (the fields' terms one after the other) if not `by_field`
+def document_terms(items, analyzer, by_field=True):
+    terms = analyzer.analyze_many([text for item in items for text in document_fields(item)])
+    field_terms = [terms[start:start + len(FIELDS)] for start in range(0, len(terms), len(FIELDS))]
+    if by_field:
+        return field_terms
+    return [[term for terms in fields for term in terms] for fields in field_terms]
+
+# Terms of each field of each image surrogate in turn, analysed as the index builder asks for them
+def iter_document_terms(items, analyzer):
+    return ([analyzer.analyze(text) for text in document_fields(item)] for item in items)
+
+# Full rebuild from image_surrogates.json, or applying the delta written by the
+# crawler (python indexer.py --delta crawl_delta.json) as a new segment
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the segmented BM25 index in index/")
+    parser.add_argument("--delta", help="Apply a crawl delta instead of rebuilding the whole index")
+    parser.add_argument("--merge", action="store_true", help="Merge all segments into one")
+    parser.add_argument("--stem", action="store_true", help="Porter-stem terms when rebuilding (deltas keep the index's setting)")
+    parser.add_argument("--positions", action="store_true",
+                        help="Store term positions for phrase queries and proximity ranking when rebuilding (deltas keep the index's setting)")
+    parser.add_argument("--memory-budget", type=int, default=256,
+                        help="MB of postings held in memory when rebuilding before they are spilled to disk")
+    parser.add_argument("--keep-duplicates", action="store_true",
+                        help="Index near-duplicate images too instead of one image per cluster of copies")
+    args = parser.parse_args()
+
+    writer = SegmentWriter("index")
+    start = time.perf_counter()
+    if args.delta:
+        with open(args.delta, "r", encoding="utf-8") as f:
+            delta = json.load(f)
+        # New and changed images that are copies of indexed ones are left out
+        if not args.keep_duplicates:
+            delta, report = deduplicate_delta(delta, indexed_urls(), *open_sources())
+            print(describe(report))
+        # New segments are analysed like the ones already in the index
+        analyzer = Analyzer.from_config(writer.manifest.get("analyzer"))
+        by_field = bool(writer.manifest.get("fields"))
+        writer.apply_delta(delta, lambda items: document_terms(items, analyzer, by_field))
+        print(f" Applied delta: {len(delta['added'])} added, {len(delta['changed'])} changed, "
+              f"{len(delta['removed'])} removed in {(time.perf_counter() - start) * 1000:.1f} ms")
+        if os.path.exists("image_embeddings.npy"):
+            ivf = update_ivf_file("image_embeddings", keep=indexed_urls())
+            print(f" Updated the IVF index to {len(ivf.list_rows)} image embeddings.")
+        if writer.maybe_merge_in_background():
+            print(f" Merging {len(writer.manifest['segments'])} segments in the background")
+    elif args.merge:
+        writer.merge()
+        print(f" Merged segments in {(time.perf_counter() - start) * 1000:.1f} ms")
+    else:
+        # Load data
+        with open("image_surrogates.json", "r", encoding="utf-8") as f:
+            data = json.load(f)
+        # One image per cluster of near-duplicates, found with the image cache and
+        # CLIP embeddings where they exist (dedup.py)
+        if not args.keep_duplicates:
+            data, report = deduplicate(data, *open_sources())
+            print(describe(report))
+        analyzer = Analyzer(stem=args.stem)
+        writer.rebuild(data, iter_document_terms(data, analyzer), analyzer_config=analyzer.config(),
+                       memory_budget=args.memory_budget * 2**20, positional=args.positions, fields=FIELDS)
+        print(f" Indexed {len(data)} images.")
+        # Dense retrieval only searches the images just indexed
+        if os.path.exists("image_embeddings.npy"):
+            ivf = build_ivf_file("image_embeddings", keep={item["image_url"] for item in data})
+            print(f" Rebuilt the IVF index over {len(ivf.list_rows)} image embeddings.")
+    print(f" Saved index files in 'index/' folder.")
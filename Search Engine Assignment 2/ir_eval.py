@@ -0,0 +1,122 @@
+import argparse
+import numpy as np
+
+# In-process evaluation of ranked results, computing the same numbers as trec_eval
+# without writing run files or starting a subprocess
+#
+#   qrels     {query_id: {doc_id: relevance}}; relevance >= 1 counts as relevant and
+#             is the gain used by nDCG
+#   rankings  {query_id: [doc_id, ...]} best first
+#
+# Every query's ranking is turned into a row of gains, padded to the longest ranking,
+# and each measure is computed for all queries at once on that matrix. Values are
+# computed and averaged in the same order of operations as trec_eval, so they agree
+# to the last printed digit: averages are taken over the queries that have both
+# qrels and a ranking, in query_id order, and scored runs are ordered by score,
+# then by doc_id in reverse.
+
+K_VALUES = (5, 10, 20)
+
+def read_qrels(path):
+    qrels = {}
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) == 4:
+                query_id, _, doc_id, relevance = fields
+                qrels.setdefault(query_id, {})[doc_id] = int(relevance)
+    return qrels
+
+# {query_id: [(doc_id, score), ...]} from the lines of a TREC run file
+def parse_run(lines):
+    run = {}
+    for line in lines:
+        fields = line.split()
+        if len(fields) == 6:
+            query_id, _, doc_id, _, score, _ = fields
+            run.setdefault(query_id, []).append((doc_id, float(score)))
+    return run
+
+def read_run(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return parse_run(f)
+
+# Rankings of a scored run in trec_eval's order, which ignores the rank column
+def rank_run(run):
+    rankings = {}
+    for query_id, results in run.items():
+        results = sorted(results, key=lambda result: result[0], reverse=True)
+        results.sort(key=lambda result: result[1], reverse=True)
+        rankings[query_id] = [doc_id for doc_id, _ in results]
+    return rankings
+
+# Ideal gains (every relevant judgement, highest first, padded to `depth`) and number
+# of relevant documents of each query
+def ideal_gains(qrels, query_ids, depth, relevance_level=1):
+    ideal = np.zeros((len(query_ids), depth))
+    num_rel = np.zeros(len(query_ids))
+    for row, query_id in enumerate(query_ids):
+        levels = sorted((relevance for relevance in qrels[query_id].values() if relevance >= relevance_level), reverse=True)
+        num_rel[row] = len(levels)
+        levels = levels[:depth]
+        ideal[row, :len(levels)] = levels
+    return ideal, num_rel
+
+# {measure: value per query} from the gains of each query's ranking (queries x ranks)
+def measures(gains, ideal, num_rel, k_values=K_VALUES, relevance_level=1):
+    depth = max(gains.shape[1], ideal.shape[1], *k_values)
+    gains = np.pad(gains, ((0, 0), (0, depth - gains.shape[1])))
+    ideal = np.pad(ideal, ((0, 0), (0, depth - ideal.shape[1])))
+    relevant = gains >= relevance_level
+    hits = np.cumsum(relevant, axis=1)
+    ranks = np.arange(1, depth + 1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # Sums along a ranking are cumulative sums: they add up rank by rank
+        precision_sums = np.cumsum(np.where(relevant, hits / ranks, 0.0), axis=1)[:, -1]
+        first_hit = np.argmax(relevant, axis=1)
+        per_query = {
+            "map": np.where(num_rel > 0, precision_sums / num_rel, 0.0),
+            "set_recall": np.where(num_rel > 0, hits[:, -1] / num_rel, 0.0),
+            "recip_rank": np.where(relevant.any(axis=1), 1 / (first_hit + 1), 0.0),
+        }
+        discounts = np.log2(ranks + 1)
+        dcg = np.cumsum(np.where(gains > 0, gains, 0) / discounts, axis=1)
+        idcg = np.cumsum(ideal / discounts, axis=1)
+        for k in k_values:
+            per_query[f"P_{k}"] = hits[:, k - 1] / k
+            per_query[f"recall_{k}"] = np.where(num_rel > 0, hits[:, k - 1] / num_rel, 0.0)
+            per_query[f"ndcg_cut_{k}"] = np.where(idcg[:, k - 1] > 0, dcg[:, k - 1] / idcg[:, k - 1], 0.0)
+    return per_query
+
+# Means of per-query measures, in query order, with the number of queries as num_q
+def average(per_query):
+    results = {measure: sum(values.tolist()) / len(values) if len(values) else 0.0 for measure, values in per_query.items()}
+    results["num_q"] = len(next(iter(per_query.values()), []))
+    return results
+
+# {measure: mean over queries}: map, P_k, recall_k, ndcg_cut_k, set_recall, recip_rank and num_q
+def evaluate(qrels, rankings, k_values=K_VALUES, relevance_level=1):
+    query_ids = sorted(query_id for query_id in rankings if query_id in qrels)
+    depth = max([len(rankings[query_id]) for query_id in query_ids] + [1])
+    gains = np.zeros((len(query_ids), depth))
+    for row, query_id in enumerate(query_ids):
+        judgements = qrels[query_id]
+        gains[row, :len(rankings[query_id])] = [judgements.get(doc_id, 0) for doc_id in rankings[query_id]]
+    ideal, num_rel = ideal_gains(qrels, query_ids, depth, relevance_level)
+    return average(measures(gains, ideal, num_rel, k_values, relevance_level))
+
+def format_results(results):
+    return "\n".join(f"{measure:<16}all\t{value:.4f}" if measure != "num_q" else f"{measure:<16}all\t{value}"
+                     for measure, value in results.items())
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Evaluate TREC run files against qrels")
+    parser.add_argument("qrels")
+    parser.add_argument("runs", nargs="+")
+    parser.add_argument("-k", type=int, nargs="+", default=list(K_VALUES), help="Cutoffs for P, recall and nDCG")
+    args = parser.parse_args()
+
+    qrels = read_qrels(args.qrels)
+    for path in args.runs:
+        print(f"== {path}")
+        print(format_results(evaluate(qrels, rank_run(read_run(path)), args.k)))
@@ -0,0 +1,61 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+# Coalescing calls made concurrently from several request threads into one batched
+# call. The first item to arrive opens a window of `max_wait` seconds; everything
+# submitted within it (up to `max_batch` items) is passed to `batch_fn` as a single
+# list, and each caller gets back its own entry of the returned list.
+
+class MicroBatcher:
+    def __init__(self, batch_fn, max_wait=0.005, max_batch=64):
+        self.batch_fn = batch_fn
+        self.max_wait = max_wait
+        self.max_batch = max_batch
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self.batches = self.items = 0
+
+    # The worker is started on first use rather than at import, so that it also
+    # runs in worker processes forked after the app module was loaded
+    def _ensure_worker(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def submit(self, item):
+        self._ensure_worker()
+        future = Future()
+        self._queue.put((item, future))
+        return future
+
+    def map(self, items):
+        futures = [self.submit(item) for item in items]
+        return [future.result() for future in futures]
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            self.batches += 1
+            self.items += len(batch)
+            try:
+                results = self.batch_fn([item for item, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
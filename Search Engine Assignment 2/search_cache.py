@@ -0,0 +1,96 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# Caches for the web app: CLIP text embeddings and ranked result lists, keyed by
+# the normalised query. Entries expire after `ttl` seconds and the least recently
+# used entry is evicted once `maxsize` entries are held.
+
+# Lowercasing and collapsing whitespace, so "Leopard " and "leopard" share an entry
+def normalize_query(query):
+    return " ".join(query.lower().split())
+
+class LRUCache:
+    def __init__(self, maxsize=1024, ttl=3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (expiry time, value)
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = self.expirations = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+# Detecting when any of a set of files is replaced or modified on disk. The files
+# are stat'ed at most every `interval` seconds, so callers can check on every request.
+class FileWatcher:
+    def __init__(self, paths, interval=0):
+        self.paths = list(paths)
+        self.interval = interval
+        self._signature = self.signature()
+        self._next_check = time.monotonic() + interval
+        self._lock = threading.Lock()
+
+    def signature(self):
+        signature = []
+        for path in self.paths:
+            try:
+                stat = os.stat(path)
+                signature.append((stat.st_mtime_ns, stat.st_size, stat.st_ino))
+            except OSError:
+                signature.append(None)
+        return signature
+
+    # True once per change, the first time the files are stat'ed after the change;
+    # checks within `interval` seconds of the last one return False without stat'ing
+    def changed(self):
+        now = time.monotonic()
+        if now < self._next_check:
+            return False
+        self._next_check = now + self.interval
+        signature = self.signature()
+        with self._lock:
+            if signature == self._signature:
+                return False
+            self._signature = signature
+            return True
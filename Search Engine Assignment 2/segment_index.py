@@ -0,0 +1,507 @@
+import hashlib
+import heapq
+import json
+import os
+import threading
+from bisect import bisect_right
+from functools import lru_cache
+from itertools import groupby, repeat
+from binary_index import IndexReader, PostingsCursor, write_index
+from document_store import DocumentStore, write_documents
+from index_builder import MEMORY_BUDGET, IndexBuilder
+
+# Segment-based index. The corpus is split into immutable segments, each a binary
+# index (`<name>.index.bin`) plus a document store (`<name>.documents.bin`) whose
+# positions match the index ordinals. `segments.json` lists the live segments,
+# oldest first, together with each segment's tombstones:
+#
+#   {"next_segment": 3, "segments": [{"name": "seg_000001", "num_docs": 4594, "deleted": [12, 40],
+#                                     "length_total": 51021, "num_with_terms": 4580,
+#                                     "field_totals": [20113, 14740, 9652, 6516]}, ...],
+#    "analyzer": {"stopwords": "english", "stem": false}, "positions": true,
+#    "fields": ["title", "alt_text", "filename", "animal_name"]}
+#
+# `length_total`, `num_with_terms` and `field_totals` add up the lengths of the
+# segment's live documents with at least one term, and are kept up to date as
+# documents are tombstoned, so readers get the average lengths without reading
+# every document's.
+# `analyzer` is the configuration of the analyzer.Analyzer the documents were
+# analysed with, which queries and later segments must be analysed with too.
+# `positions` says whether segments store term positions, for phrase queries, and
+# `fields` the fields whose tfs and lengths they store, for BM25F; later segments
+# and merges keep them too.
+#
+# New or changed images go into a new segment and the copies they replace are
+# tombstoned, so an update only costs as much as the images it touches. Merging
+# rewrites segments into one without their tombstoned documents, reusing the stored
+# postings. Segment files are never modified, and segments.json is replaced
+# atomically, so readers always see a consistent index.
+#
+# Documents are identified by doc_id_for(image_url), which doesn't depend on the
+# order of image_surrogates.json. There must be only one writer at a time. The
+# writer keeps each segment's tombstones in a set, saved as a sorted list.
+
+MANIFEST = "segments.json"
+MERGE_FACTOR = 8  # Segments allowed before indexer.py merges them in the background
+
+def doc_id_for(image_url):
+    return hashlib.sha1(image_url.encode("utf-8")).hexdigest()[:16]
+
+def segment_paths(directory, name):
+    return os.path.join(directory, name + ".index.bin"), os.path.join(directory, name + ".documents.bin")
+
+def load_manifest(directory):
+    path = os.path.join(directory, MANIFEST)
+    if not os.path.exists(path):
+        return {"next_segment": 1, "segments": []}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def save_manifest(directory, manifest):
+    path = os.path.join(directory, MANIFEST)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(manifest, f, default=sorted)  # Tombstone sets as sorted lists
+    os.replace(path + ".tmp", path)
+
+# Totals of the lengths of the live documents with at least one term, over which
+# lengths are averaged, as write_index does
+def length_totals(doc_lengths, field_lengths=None, num_fields=0, deleted=()):
+    length_total = num_with_terms = 0
+    field_totals = [0] * num_fields
+    for ordinal, length in enumerate(doc_lengths):
+        if length and ordinal not in deleted:
+            length_total += length
+            num_with_terms += 1
+            for field in range(num_fields):
+                field_totals[field] += field_lengths[ordinal * num_fields + field]
+    return {"length_total": length_total, "num_with_terms": num_with_terms, "field_totals": field_totals}
+
+# Writing a segment from documents and their term lists, or ready-made postings (a
+# mapping, or (term, postings) pairs in term order). Term lists may be produced
+# lazily: they are consumed one document at a time by an index_builder.IndexBuilder,
+# which spills its postings to disk past `memory_budget` bytes. A positional
+# segment stores the position of every term occurrence as well. With `fields`, the
+# term lists are given per field and the segment stores the tf of every term in
+# each field and the length of each field (`field_lengths` with ready-made postings).
+def write_segment(directory, name, documents, doc_terms=None, postings=None, doc_lengths=None,
+                  memory_budget=MEMORY_BUDGET, positional=False, fields=None, field_lengths=None):
+    index_path, documents_path = segment_paths(directory, name)
+    if postings is None:
+        builder = IndexBuilder(memory_budget=memory_budget, temp_dir=directory, positions=positional, fields=fields)
+        for doc, terms in zip(documents, doc_terms):
+            if fields:
+                builder.add_fields(doc_id_for(doc.get("image_url", "")), terms)
+            else:
+                builder.add_terms(doc_id_for(doc.get("image_url", "")), terms)
+        builder.write(index_path)
+        doc_lengths, field_lengths = builder.doc_lengths, builder.field_lengths
+    else:
+        doc_ids = [doc_id_for(doc.get("image_url", "")) for doc in documents]
+        write_index(index_path, doc_ids, doc_lengths, postings, positional=positional,
+                    fields=fields, field_lengths=field_lengths)
+    write_documents(documents_path, documents)
+    segment = {"name": name, "num_docs": len(documents), "deleted": set()}
+    segment.update(length_totals(doc_lengths, field_lengths, len(fields or ())))
+    return segment
+
+class SegmentWriter:
+    def __init__(self, directory="index"):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.manifest = load_manifest(directory)
+        for segment in self.manifest["segments"]:
+            segment["deleted"] = set(segment["deleted"])
+        self.lock = threading.Lock()
+        self.merge_thread = None
+        self._stores = {}
+        self._indexes = {}
+        # Segments listed before their length totals were kept
+        for segment in self.manifest["segments"]:
+            if "length_total" not in segment:
+                index = self._index(segment["name"])
+                segment.update(length_totals(index.doc_lengths, getattr(index, "field_lengths", None),
+                                             len(index.fields), segment["deleted"]))
+
+    def _store(self, name):
+        if name not in self._stores:
+            self._stores[name] = DocumentStore(segment_paths(self.directory, name)[1])
+        return self._stores[name]
+
+    def _index(self, name):
+        if name not in self._indexes:
+            self._indexes[name] = IndexReader(segment_paths(self.directory, name)[0], cache_size=0)
+        return self._indexes[name]
+
+    # Tombstoning a document of a segment and taking its lengths off the segment's totals
+    def _tombstone(self, segment, ordinal):
+        segment["deleted"].add(ordinal)
+        index = self._index(segment["name"])
+        length = index.doc_lengths[ordinal]
+        if length:
+            segment["length_total"] -= length
+            segment["num_with_terms"] -= 1
+            num_fields = len(segment["field_totals"])
+            for field in range(num_fields):
+                segment["field_totals"][field] -= index.field_lengths[ordinal * num_fields + field]
+
+    def _new_segment_name(self):
+        name = f"seg_{self.manifest['next_segment']:06d}"
+        self.manifest["next_segment"] += 1
+        return name
+
+    # Tombstoning the live copies of images; returns how many were found
+    def _delete(self, urls):
+        deleted = 0
+        for url in urls:
+            for segment in reversed(self.manifest["segments"]):
+                position = self._store(segment["name"]).find_url(url)
+                if position is not None and position not in segment["deleted"]:
+                    self._tombstone(segment, position)
+                    deleted += 1
+                    break
+        return deleted
+
+    # Replacing every segment with one built from the whole corpus, analysed as
+    # described by `analyzer_config` (unknown if None), with positions if `positional`
+    # and per-field statistics if `fields`
+    def rebuild(self, documents, doc_terms=None, postings=None, doc_lengths=None, analyzer_config=None,
+                memory_budget=MEMORY_BUDGET, positional=False, fields=None):
+        with self.lock:
+            name = self._new_segment_name()
+            segment = write_segment(self.directory, name, documents, doc_terms, postings, doc_lengths,
+                                    memory_budget, positional, fields)
+            old_segments = self.manifest["segments"]
+            self.manifest["segments"] = [segment]
+            if analyzer_config is not None:
+                self.manifest["analyzer"] = analyzer_config
+            else:
+                self.manifest.pop("analyzer", None)
+            if positional:
+                self.manifest["positions"] = True
+            else:
+                self.manifest.pop("positions", None)
+            if fields:
+                self.manifest["fields"] = list(fields)
+            else:
+                self.manifest.pop("fields", None)
+            save_manifest(self.directory, self.manifest)
+            self._remove_files(old_segments)
+        return segment
+
+    def _add(self, documents, doc_terms):
+        # The last copy wins if an image appears more than once
+        latest = {doc.get("image_url", ""): i for i, doc in enumerate(documents)}
+        keep = sorted(latest.values())
+        documents = [documents[i] for i in keep]
+        doc_terms = [doc_terms[i] for i in keep]
+        self._delete(list(latest))
+        name = self._new_segment_name()
+        positional = self.manifest.get("positions", False)
+        fields = self.manifest.get("fields")
+        self.manifest["segments"].append(write_segment(self.directory, name, documents, doc_terms,
+                                                       positional=positional, fields=fields))
+
+    # Adding documents in a new segment; older copies of the same images are tombstoned
+    def add_documents(self, documents, doc_terms):
+        if not documents:
+            return
+        with self.lock:
+            self._add(documents, doc_terms)
+            save_manifest(self.directory, self.manifest)
+
+    def delete_documents(self, urls):
+        with self.lock:
+            deleted = self._delete(urls)
+            save_manifest(self.directory, self.manifest)
+        return deleted
+
+    # Applying a crawl delta from crawler.py; `analyze` gives the term lists of a list
+    # of documents, per field if the index has fields
+    def apply_delta(self, delta, analyze):
+        documents = delta["added"] + delta["changed"]
+        with self.lock:
+            self._delete(delta["removed"])
+            if documents:
+                self._add(documents, analyze(documents))
+            save_manifest(self.directory, self.manifest)
+
+    # Merging all current segments into one, leaving out tombstoned documents. The
+    # segments' sorted term tables are k-way merged, so postings are copied one term
+    # at a time. Documents added or deleted while the merge runs are kept track of.
+    def merge(self):
+        with self.lock:
+            snapshot = [dict(segment, deleted=set(segment["deleted"])) for segment in self.manifest["segments"]]
+            if len(snapshot) < 2 and not any(segment["deleted"] for segment in snapshot):
+                return
+            name = self._new_segment_name()
+            positional = self.manifest.get("positions", False)
+            fields = self.manifest.get("fields")
+
+        documents = []
+        doc_lengths = []
+        field_lengths = []
+        indexes = []
+        new_ordinals = {}
+        for segment in snapshot:
+            index = self._index(segment["name"])
+            store = self._store(segment["name"])
+            deleted = segment["deleted"]
+            ordinals = {}
+            for ordinal in range(segment["num_docs"]):
+                if ordinal not in deleted:
+                    ordinals[ordinal] = len(documents)
+                    documents.append(store[ordinal])
+                    doc_lengths.append(index.doc_lengths[ordinal])
+                    if fields:
+                        field_lengths.extend(index.field_lengths[ordinal * len(fields):(ordinal + 1) * len(fields)])
+            indexes.append((index, ordinals))
+            new_ordinals[segment["name"]] = ordinals
+
+        # A segment's postings of a term, with their positions and field tfs if stored
+        def stored_postings(index, term):
+            term_postings = index.postings(term)
+            if positional:
+                term_postings = [posting + (positions,) for posting, positions in zip(term_postings, index.positions(term))]
+            if fields:
+                term_postings = [posting + (field_tfs,) for posting, field_tfs in zip(term_postings, index.field_tfs(term))]
+            return term_postings
+
+        # Segments are in ordinal order, so a term's postings are concatenated segment by segment
+        def postings():
+            terms = heapq.merge(*(zip(index.terms, repeat(number)) for number, (index, _) in enumerate(indexes)))
+            for term, group in groupby(terms, key=lambda entry: entry[0]):
+                term_postings = []
+                for _, number in group:
+                    index, ordinals = indexes[number]
+                    term_postings += [(ordinals[posting[0]],) + posting[1:] for posting in stored_postings(index, term)
+                                      if posting[0] in ordinals]
+                if term_postings:
+                    yield term, term_postings
+        merged = write_segment(self.directory, name, documents, postings=postings(), doc_lengths=doc_lengths,
+                               positional=positional, fields=fields, field_lengths=field_lengths)
+
+        with self.lock:
+            # Carrying over tombstones added to the merged segments in the meantime
+            for segment in self.manifest["segments"]:
+                ordinals = new_ordinals.get(segment["name"])
+                if ordinals is not None:
+                    for ordinal in segment["deleted"]:
+                        if ordinal in ordinals:
+                            self._tombstone(merged, ordinals[ordinal])
+            self.manifest["segments"] = [merged] + [s for s in self.manifest["segments"] if s["name"] not in new_ordinals]
+            save_manifest(self.directory, self.manifest)
+            self._remove_files(snapshot)
+
+    # Merging in a background thread once there are more than MERGE_FACTOR segments
+    def maybe_merge_in_background(self):
+        if len(self.manifest["segments"]) <= MERGE_FACTOR or (self.merge_thread and self.merge_thread.is_alive()):
+            return None
+        self.merge_thread = threading.Thread(target=self.merge)
+        self.merge_thread.start()
+        return self.merge_thread
+
+    def _remove_files(self, segments):
+        for segment in segments:
+            self._stores.pop(segment["name"], None)
+            self._indexes.pop(segment["name"], None)
+            for path in segment_paths(self.directory, segment["name"]):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass  # Still mapped by a reader on Windows; left behind
+
+# Image URLs of the live documents of the index in `directory`, or None if there is no index
+def indexed_urls(directory="index"):
+    if not os.path.exists(os.path.join(directory, MANIFEST)):
+        return None
+    return set(SegmentedIndex(directory, cache_size=0).urls())
+
+# Reading the live documents of every segment as one corpus. Documents are
+# addressed by position: segments are laid end to end in manifest order, so
+# positions change when segments are merged and must not be stored.
+class SegmentedIndex:
+    def __init__(self, directory="index", cache_size=1024):
+        self.manifest = load_manifest(directory)
+        self.bases = []
+        self.segments = []
+        num_positions = 0
+        for segment in self.manifest["segments"]:
+            index_path, documents_path = segment_paths(directory, segment["name"])
+            index = IndexReader(index_path, cache_size=cache_size)
+            store = DocumentStore(documents_path)
+            self.bases.append(num_positions)
+            self.segments.append((index, store, frozenset(segment["deleted"])))
+            num_positions += index.num_docs
+        self.has_positions = bool(self.segments) and all(index.has_positions for index, _, _ in self.segments)
+        # Field statistics are only used if every segment has the same fields
+        field_names = {index.fields for index, _, _ in self.segments}
+        self.fields = field_names.pop() if len(field_names) == 1 else ()
+
+        # Per-document arrays of the segments, by position
+        self.doc_lengths = SegmentArray(self.bases, [index.doc_lengths for index, _, _ in self.segments])
+        self.group_ids = SegmentArray(self.bases, [store.group_ids for _, store, _ in self.segments])
+        self.image_scores = SegmentArray(self.bases, [store.image_scores for _, store, _ in self.segments])
+        self.field_lengths = None  # The lengths of a document's fields, if the index has fields
+        if self.fields:
+            self.field_lengths = SegmentArray(self.bases, [index.field_lengths for index, _, _ in self.segments],
+                                              len(self.fields))
+
+        # Lengths averaged over live documents with at least one term, from the segments' totals
+        num_live = length_total = num_with_terms = 0
+        field_totals = [0] * len(self.fields)
+        for segment, (index, _, deleted) in zip(self.manifest["segments"], self.segments):
+            num_live += segment["num_docs"] - len(deleted)
+            if "length_total" not in segment:  # Written before the totals were kept
+                segment = length_totals(index.doc_lengths, getattr(index, "field_lengths", None),
+                                        len(index.fields), deleted)
+            length_total += segment["length_total"]
+            num_with_terms += segment["num_with_terms"]
+            if self.fields:
+                field_totals = [total + segment_total for total, segment_total in zip(field_totals, segment["field_totals"])]
+        self.num_docs = num_live
+        self.avg_doc_length = length_total / num_with_terms if num_with_terms else 0
+        self.avg_field_lengths = [total / num_with_terms for total in field_totals] if num_with_terms else field_totals
+        self.postings = lru_cache(maxsize=cache_size)(self._read_postings)
+        self.positions = lru_cache(maxsize=cache_size)(self._read_positions)
+        self.field_tfs = lru_cache(maxsize=cache_size)(self._read_field_tfs)
+        self.df = lru_cache(maxsize=cache_size)(self._live_df)
+
+    def __len__(self):
+        return self.num_docs
+
+    def __getitem__(self, position):
+        i = bisect_right(self.bases, position) - 1
+        return self.segments[i][1][position - self.bases[i]]
+
+    def display_title(self, position):
+        i = bisect_right(self.bases, position) - 1
+        return self.segments[i][1].display_titles[position - self.bases[i]]
+
+    # Image URLs of the live documents
+    def urls(self):
+        for _, store, deleted in self.segments:
+            for ordinal in range(len(store)):
+                if ordinal not in deleted:
+                    yield store[ordinal].get("image_url", "")
+
+    # Position of the live document with an image URL, or None
+    def find_url(self, url):
+        for base, (_, store, deleted) in zip(reversed(self.bases), reversed(self.segments)):
+            ordinal = store.find_url(url)
+            if ordinal is not None and ordinal not in deleted:
+                return base + ordinal
+        return None
+
+    def __contains__(self, term):
+        return self.df(term) > 0
+
+    # Number of live documents containing a term; only segments with tombstones need their postings read
+    def _live_df(self, term):
+        df = 0
+        for index, _, deleted in self.segments:
+            if deleted:
+                df += sum(1 for ordinal, _ in index.postings(term) if ordinal not in deleted)
+            else:
+                df += index.df(term)
+        return df
+
+    # Cursor over the live postings of a term, by position, for top-k retrieval (see pruning.py)
+    def cursor(self, term):
+        parts = [(base, index.cursor(term), deleted) for base, (index, _, deleted) in zip(self.bases, self.segments) if term in index]
+        return SegmentedCursor(parts)
+
+    # (position, tf) of every live document containing a term
+    def _read_postings(self, term):
+        postings = []
+        for base, (index, _, deleted) in zip(self.bases, self.segments):
+            postings.extend((base + ordinal, tf) for ordinal, tf in index.postings(term) if ordinal not in deleted)
+        return tuple(postings)
+
+    # {position: term positions in the document} of every live document containing a term
+    def _read_positions(self, term):
+        positions = {}
+        for base, (index, _, deleted) in zip(self.bases, self.segments):
+            for (ordinal, _), term_positions in zip(index.postings(term), index.positions(term)):
+                if ordinal not in deleted:
+                    positions[base + ordinal] = term_positions
+        return positions
+
+    # {position: (tf in each field, ...)} of every live document containing a term
+    def _read_field_tfs(self, term):
+        field_tfs = {}
+        for base, (index, _, deleted) in zip(self.bases, self.segments):
+            for (ordinal, _), tfs in zip(index.postings(term), index.field_tfs(term)):
+                if ordinal not in deleted:
+                    field_tfs[base + ordinal] = tfs
+        return field_tfs
+
+# An array of the segments laid end to end, by position, without copying it: the
+# segments' own arrays (memoryviews of their files) are looked up through the
+# positions where the segments start. With `width`, each document has that many
+# values, and a position gives the document's slice of them.
+class SegmentArray:
+    def __init__(self, bases, parts, width=1):
+        self.bases = bases
+        self.parts = parts
+        self.width = width
+        self._length = sum(len(part) for part in parts) // width
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, position):
+        i = bisect_right(self.bases, position) - 1
+        ordinal = position - self.bases[i]
+        if self.width == 1:
+            return self.parts[i][ordinal]
+        return self.parts[i][ordinal * self.width:(ordinal + 1) * self.width]
+
+# binary_index.PostingsCursor over segments laid end to end, skipping tombstoned
+# documents. Blocks are numbered across the segments in order.
+class SegmentedCursor:
+    END = PostingsCursor.END
+
+    def __init__(self, parts):
+        self._parts = parts
+        self._bounds = [cursor.block_bounds() for _, cursor, _ in parts]
+        self._first_blocks = [0]
+        for bounds in self._bounds[:-1]:
+            self._first_blocks.append(self._first_blocks[-1] + len(bounds))
+        self._part = 0
+        self._settle()
+
+    # Moving past tombstones and exhausted segments
+    def _settle(self):
+        while self._part < len(self._parts):
+            base, cursor, deleted = self._parts[self._part]
+            while cursor.doc in deleted:
+                cursor.next()
+            if cursor.doc != cursor.END:
+                self.doc, self.tf = base + cursor.doc, cursor.tf
+                return
+            self._part += 1
+        self.doc, self.tf = self.END, 0
+
+    def next(self):
+        self._parts[self._part][1].next()
+        self._settle()
+
+    def advance(self, target):
+        if self.doc >= target:
+            return
+        while self._part + 1 < len(self._parts) and self._parts[self._part + 1][0] <= target:
+            self._part += 1
+        base, cursor, _ = self._parts[self._part]
+        cursor.advance(target - base)
+        self._settle()
+
+    def block_bounds(self):
+        return [bound for bounds in self._bounds for bound in bounds]
+
+    def block_at(self, target):
+        for part in range(self._part, len(self._parts)):
+            base, cursor, _ = self._parts[part]
+            block = cursor.block_at(max(target - base, 0))
+            if block is not None:
+                return self._first_blocks[part] + block[0], base + block[1]
+        return None
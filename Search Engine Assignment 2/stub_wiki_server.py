@@ -0,0 +1,132 @@
+import argparse
+import json
+import threading
+import time
+import zlib
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+# Local stand-in for the parts of Wikipedia that crawler.py reads: the
+# categorymembers API (paginated with cmcontinue) and article pages with images.
+# Categories, pages and images are generated from their names, so every run serves
+# the same site.
+#
+#   python stub_wiki_server.py --port 8000 --latency 0.2 &
+#   python crawler.py --base-url http://localhost:8000 --output /tmp/surrogates.json
+#
+# --latency delays every response to make the effect of concurrency visible, and
+# --fail-first answers the first request for every URL with a 503 to exercise the
+# crawler's retries. Paths added to the server's `fail_paths` (e.g. by tests) are
+# answered with a 503 every time. Article pages carry an ETag and Last-Modified and honour
+# If-None-Match; --revision 1 serves an edited site (a page dropped from each
+# category, some pages with a new image or a changed caption) for incremental crawls.
+
+PAGES_PER_CATEGORY = 40
+API_PAGE_SIZE = 25  # Category members per API response
+
+ANIMALS = ["Leopard", "Owl", "Frog", "Elephant", "Hyena", "Turtle", "Rabbit", "Lion", "Gecko", "Heron"]
+
+def category_members(category, revision=0):
+    seed = zlib.crc32(category.encode("utf-8"))
+    members = [f"Category:{category} by region", f"File:{category}.svg"]
+    for i in range(1 if revision else 0, PAGES_PER_CATEGORY):
+        members.append(f"{ANIMALS[(seed + i) % len(ANIMALS)]} {seed % 1000 + i}")
+    # Pages shared with the next category, as real categories overlap
+    members.append(f"{ANIMALS[seed % len(ANIMALS)]} shared")
+    return members
+
+def article_html(title, revision=0):
+    seed = zlib.crc32(title.encode("utf-8"))
+    name = title.split()[0]
+    images = []
+    for i in range(seed % 4 + 1):
+        filename = f"{name}_{seed}_{i}.jpg"
+        caption = "revised" if revision and seed % 3 == 1 and i == 0 else "photo"
+        images.append(f'<img src="//upload.wikimedia.org/wikipedia/commons/thumb/{i}/{filename}/220px-{filename}" alt="A {name.lower()} {caption} {i}">')
+    if revision and seed % 3 == 0:
+        images.append(f'<img src="//upload.wikimedia.org/wikipedia/commons/{name}_{seed}_new.jpg" alt="A new {name.lower()} photo">')
+    # Visuals the crawler has to filter out
+    images.append(f'<img src="//upload.wikimedia.org/wikipedia/commons/{name}_range_map.png" alt="Range map">')
+    images.append('<img src="//upload.wikimedia.org/wikipedia/commons/Wiki_logo.svg" alt="">')
+    images.append(f'<img src="/static/images/{name}_local.jpg" alt="{name}">')
+    return (f'<html><head><title>{title}</title></head><body><h1>{title}</h1>'
+            f'<div class="mw-parser-output"><p>The {title.lower()} is an animal.</p>{"".join(images)}</div>'
+            '</body></html>')
+
+class StubWikiHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep-alive, as Wikipedia serves it
+
+    def do_GET(self):
+        server = self.server
+        time.sleep(server.latency)
+        with server.lock:
+            server.requests += 1
+            first_request = self.path not in server.seen_paths
+            server.seen_paths.add(self.path)
+        if (server.fail_first and first_request) or self.path in server.fail_paths:
+            return self.reply(503, "text/plain", b"Service Unavailable")
+
+        url = urlsplit(self.path)
+        if url.path == "/w/api.php":
+            query = parse_qs(url.query)
+            category = query.get("cmtitle", ["Category:"])[0].split(":", 1)[1]
+            members = category_members(category, server.revision)
+            start = int(query.get("cmcontinue", ["0"])[0])
+            data = {"query": {"categorymembers": [{"title": title} for title in members[start:start + API_PAGE_SIZE]]}}
+            if start + API_PAGE_SIZE < len(members):
+                data["continue"] = {"cmcontinue": str(start + API_PAGE_SIZE)}
+            return self.reply(200, "application/json", json.dumps(data).encode("utf-8"))
+        if url.path.startswith("/wiki/"):
+            title = unquote(url.path[len("/wiki/"):]).replace("_", " ")
+            body = article_html(title, server.revision).encode("utf-8")
+            headers = {"ETag": f'"{zlib.crc32(body):08x}"', "Last-Modified": formatdate(1700000000 + server.revision * 86400, usegmt=True)}
+            if self.headers.get("If-None-Match") == headers["ETag"]:
+                with server.lock:
+                    server.not_modified += 1
+                return self.reply(304, None, b"", headers)
+            return self.reply(200, "text/html; charset=utf-8", body, headers)
+        return self.reply(404, "text/plain", b"Not Found")
+
+    def reply(self, status, content_type, body, headers=None):
+        self.send_response(status)
+        if content_type:
+            self.send_header("Content-Type", content_type)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def make_server(port=0, latency=0.0, fail_first=False, revision=0):
+    server = ThreadingHTTPServer(("127.0.0.1", port), StubWikiHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.fail_first = fail_first
+    server.revision = revision
+    server.lock = threading.Lock()
+    server.requests = 0
+    server.not_modified = 0
+    server.seen_paths = set()
+    server.fail_paths = set()
+    return server
+
+# Serving from a background thread; returns the server and its base URL
+def start_server(port=0, latency=0.0, fail_first=False, revision=0):
+    server = make_server(port, latency, fail_first, revision)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve a canned Wikipedia for testing crawler.py")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds to delay every response")
+    parser.add_argument("--fail-first", action="store_true", help="Answer the first request for each URL with a 503")
+    parser.add_argument("--revision", type=int, default=0, help="0 for the original site, 1 for the edited one")
+    args = parser.parse_args()
+    server = make_server(args.port, args.latency, args.fail_first, args.revision)
+    print(f"Serving stub Wikipedia on http://127.0.0.1:{server.server_address[1]}")
+    server.serve_forever()
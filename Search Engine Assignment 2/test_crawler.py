@@ -0,0 +1,189 @@
+import json
+import time
+import pytest
+from crawl_state import CrawlState
+from crawler import FETCH_WINDOW, Crawler, HostRateLimiter, save_images
+from stub_wiki_server import start_server
+
+# Tests of the crawler against stub_wiki_server.py, served on an ephemeral port
+# from a background thread:
+#
+#   python -m pytest test_crawler.py
+
+CATEGORIES = ["Mammals_of_Africa", "Birds_of_Australia", "Reptiles_of_Africa"]
+
+@pytest.fixture
+def stub():
+    server, base_url = start_server()
+    yield server, base_url
+    server.shutdown()
+    server.server_close()
+
+def crawl(base_url, state_path, max_images=10000, categories=CATEGORIES, limit=300, **kwargs):
+    kwargs = {"rate": 1000, "burst": 1000, **kwargs}
+    state = CrawlState(str(state_path))
+    try:
+        return Crawler(base_url, **kwargs).crawl(state, categories, limit, max_images)
+    finally:
+        state.close()
+
+def sizes(delta):
+    return {kind: len(items) for kind, items in delta.items()}
+
+def page_requests(server):
+    return [path for path in server.seen_paths if path.startswith("/wiki/")]
+
+# Every article image is found once, without the maps, logos and local images the
+# stub mixes in, in the order a sequential crawl finds them
+def test_crawl_output(stub, tmp_path):
+    server, base_url = stub
+    images, delta = crawl(base_url, tmp_path / "state.db", concurrency=8)
+    assert sizes(delta) == {"added": len(images), "changed": 0, "removed": 0}
+
+    urls = [image["image_url"] for image in images]
+    assert len(set(urls)) == len(urls)
+    assert all(url.startswith("https://upload.wikimedia.org/") and url.endswith(".jpg") for url in urls)
+    assert not any("range_map" in url or "logo" in url.lower() for url in urls)
+    pages = {image["source_page"] for image in images}
+    # Category and file members are skipped, and shared pages are crawled once
+    assert len(pages) == len(page_requests(server))
+    assert all(image["title"] == image["source_page"].rsplit("/", 1)[1].replace("_", " ") for image in images)
+
+    first, _ = crawl(base_url, tmp_path / "concurrent.db", categories=CATEGORIES[:2], limit=15, concurrency=8)
+    sequential, _ = crawl(base_url, tmp_path / "sequential.db", categories=CATEGORIES[:2], limit=15, concurrency=1)
+    assert first == sequential
+
+# Requests to a host are limited to its token bucket's rate after the burst,
+# whatever the concurrency, and hosts have separate buckets
+def test_rate_limit(stub, tmp_path):
+    server, base_url = stub
+    start = time.perf_counter()
+    crawl(base_url, tmp_path / "state.db", categories=CATEGORIES[:1], limit=12, concurrency=8, rate=10, burst=2)
+    elapsed = time.perf_counter() - start
+    assert server.requests >= 13
+    assert elapsed >= (server.requests - 2) / 10 - 0.05
+
+    limiter = HostRateLimiter(rate=10, capacity=3)
+    start = time.perf_counter()
+    for host in ("a.example", "b.example", "c.example"):
+        for _ in range(3):
+            limiter.acquire(f"https://{host}/page")
+    assert time.perf_counter() - start < 0.1
+    limiter.acquire("https://a.example/page")
+    assert time.perf_counter() - start >= 0.09
+
+# A 503 is retried, so a server failing every URL's first request gives the same crawl
+def test_retries(stub, tmp_path):
+    server, base_url = stub
+    expected, _ = crawl(base_url, tmp_path / "expected.db")
+    server.fail_first = True
+    server.seen_paths.clear()
+    requests_before = server.requests
+    images, delta = crawl(base_url, tmp_path / "state.db")
+    assert images == expected and delta is not None
+    assert server.requests - requests_before == 2 * len(server.seen_paths)
+
+# A crawler that takes a second over one page
+class SlowPageCrawler(Crawler):
+    def __init__(self, slow_url, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.slow_url = slow_url
+
+    def fetch_page(self, url, validators=None):
+        if url == self.slow_url:
+            time.sleep(1)
+        return super().fetch_page(url, validators)
+
+# Pages are fetched at most FETCH_WINDOW per thread ahead of the one consumed, even
+# while that one is slow, so a crawl stopped at --max-images leaves most of the
+# site unrequested
+def test_fetch_window(stub, tmp_path):
+    server, base_url = stub
+    total, _ = crawl(base_url, tmp_path / "full.db")
+    pages = list(dict.fromkeys(image["source_page"] for image in total))
+    server.seen_paths.clear()
+    state = CrawlState(str(tmp_path / "state.db"))
+    images, _ = SlowPageCrawler(pages[2], base_url, concurrency=4, rate=1000, burst=1000).crawl(state, CATEGORIES, max_images=20)
+    state.close()
+    reached = {image["source_page"] for image in images}
+    assert len(page_requests(server)) <= len(reached) + FETCH_WINDOW * 4 < len(pages)
+
+# Pages that can't be fetched leave the crawl unfinished, with nothing emitted; the
+# next run fetches only those pages and then emits the whole crawl's delta
+def test_failed_pages_are_retried(stub, tmp_path):
+    server, base_url = stub
+    expected, _ = crawl(base_url, tmp_path / "expected.db")
+    failing = sorted({image["source_page"] for image in expected})[::10]
+    server.fail_paths = {url[len(base_url):] for url in failing}
+    images, delta = crawl(base_url, tmp_path / "state.db", max_retries=0)
+    assert delta is None
+    assert not {image["source_page"] for image in images} & set(failing)
+    state = CrawlState(str(tmp_path / "state.db"))
+    assert sorted(url for url, done in state.frontier(state.unfinished_crawl()) if not done) == failing
+    state.close()
+
+    server.fail_paths = set()
+    server.seen_paths.clear()
+    images, delta = crawl(base_url, tmp_path / "state.db", max_retries=0)
+    assert sorted(server.seen_paths) == sorted(url[len(base_url):] for url in failing)
+    assert images == expected
+    assert sizes(delta) == {"added": len(expected), "changed": 0, "removed": 0}
+
+# A re-crawl of the edited site sends conditional requests, and its delta is the
+# difference between the two crawls' images
+def test_incremental_delta(stub, tmp_path):
+    server, base_url = stub
+    before, _ = crawl(base_url, tmp_path / "state.db")
+    server.revision = 1
+    after, delta = crawl(base_url, tmp_path / "state.db")
+    assert server.not_modified > 0
+
+    old = {image["image_url"]: image for image in before}
+    new = {image["image_url"]: image for image in after}
+    assert delta["added"] == [image for url, image in new.items() if url not in old]
+    assert delta["changed"] == [image for url, image in new.items() if url in old and old[url] != image]
+    assert delta["removed"] == [url for url in old if url not in new]
+    assert all(sizes(delta).values())
+
+    # Nothing changes on a third crawl, and every page is answered 304 Not Modified
+    server.not_modified = 0
+    again, delta = crawl(base_url, tmp_path / "state.db")
+    assert again == after and sizes(delta) == {"added": 0, "changed": 0, "removed": 0}
+    assert server.not_modified == len({image["source_page"] for image in after})
+
+# A crawl stopped at --max-images reports changes only on the pages it reached:
+# the images of the others are neither removed from the delta nor from the output
+def test_truncated_crawl_keeps_unreached_pages(stub, tmp_path):
+    server, base_url = stub
+    output = str(tmp_path / "surrogates.json")
+    images, delta = crawl(base_url, tmp_path / "state.db")
+    save_images(images, delta, output)
+    assert sizes(delta) == {"added": len(images), "changed": 0, "removed": 0}
+
+    truncated, delta = crawl(base_url, tmp_path / "state.db", max_images=50)
+    save_images(truncated, delta, output)
+    assert 50 <= len(truncated) < len(images)
+    assert sizes(delta) == {"added": 0, "changed": 0, "removed": 0}
+    with open(output, encoding="utf-8") as f:
+        assert json.load(f) == images
+
+    # The next full crawl starts afresh and finds nothing changed either
+    again, delta = crawl(base_url, tmp_path / "state.db")
+    assert again == images
+    assert sizes(delta) == {"added": 0, "changed": 0, "removed": 0}
+
+# On an edited site, a truncated crawl picks up the edits of the pages it reached
+# and carries the rest over until a full crawl reaches them
+def test_truncated_crawl_of_edited_site(stub, tmp_path):
+    server, base_url = stub
+    crawl(base_url, tmp_path / "state.db")
+    crawl(base_url, tmp_path / "reference.db")
+    server.revision = 1
+    truncated, delta = crawl(base_url, tmp_path / "state.db", max_images=50)
+    reached = {image["source_page"] for image in truncated}
+    assert all(image["source_page"] in reached for image in delta["added"] + delta["changed"])
+
+    edited, full_delta = crawl(base_url, tmp_path / "reference.db")
+    again, rest = crawl(base_url, tmp_path / "state.db")
+    assert again == edited
+    assert sizes(full_delta) == {kind: len(delta[kind]) + len(rest[kind]) for kind in delta}
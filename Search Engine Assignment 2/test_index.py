@@ -0,0 +1,363 @@
+import importlib
+import math
+import os
+import random
+from bisect import bisect_left
+from io import BytesIO
+import numpy as np
+import pytest
+from PIL import Image
+from analyzer import Analyzer
+from ann_index import IVFIndex, build_ivf_file, update_ivf_file
+from binary_index import IndexReader, PostingsCursor
+from dedup import deduplicate, deduplicate_delta
+from embedding_store import EmbeddingStore, write_embedding_store
+from image_cache import ImageCache
+from index_builder import IndexBuilder
+from pruning import max_score_top_k
+from segment_index import SegmentedIndex, SegmentWriter, indexed_urls
+
+# Tests of the index files and the retrieval built on them, over small random
+# corpora, so they take a few seconds:
+#
+#   python -m pytest
+#
+# The tests of app.py's ranking need CLIP and the app's data files, and are
+# skipped without them.
+
+FIELDS = ("title", "alt_text", "filename", "animal_name")
+VOCABULARY = [f"w{rank}" for rank in range(60)]
+
+# Term lists of each field of `n` random documents. Terms are drawn with Zipf-like
+# frequencies, so the commonest ones span several postings blocks, and some
+# documents have no terms at all.
+def random_fields(n, seed=0):
+    rng = random.Random(seed)
+    weights = [1 / (rank + 1) for rank in range(len(VOCABULARY))]
+    documents = [[rng.choices(VOCABULARY, weights, k=rng.randint(0, 4)) for _ in FIELDS] for _ in range(n)]
+    for ordinal in range(0, n, 50):
+        documents[ordinal] = [[] for _ in FIELDS]
+    return documents
+
+# {term: [(ordinal, tf, positions, field tfs), ...]} of documents given by field
+def expected_postings(documents):
+    postings = {}
+    for ordinal, field_terms in enumerate(documents):
+        terms = [term for terms in field_terms for term in terms]
+        for term in dict.fromkeys(terms):
+            positions = tuple(position for position, other in enumerate(terms) if other == term)
+            field_tfs = tuple(terms.count(term) for terms in field_terms)
+            postings.setdefault(term, []).append((ordinal, len(positions), positions, field_tfs))
+    return postings
+
+def walk(cursor):
+    docs = []
+    while cursor.doc != PostingsCursor.END:
+        docs.append((cursor.doc, cursor.tf))
+        cursor.next()
+    return docs
+
+# Writing an index with IndexBuilder, in memory or spilled to sorted runs, and reading it back
+@pytest.mark.parametrize("memory_budget", [256 << 20, 4096])
+def test_index_round_trip(tmp_path, memory_budget):
+    documents = random_fields(600)
+    builder = IndexBuilder(memory_budget=memory_budget, temp_dir=str(tmp_path), positions=True, fields=FIELDS)
+    for ordinal, field_terms in enumerate(documents):
+        builder.add_fields(f"doc{ordinal}", field_terms)
+    builder.write(str(tmp_path / "test.index.bin"))
+    assert (builder.num_runs > 1) == (memory_budget == 4096)
+
+    reader = IndexReader(str(tmp_path / "test.index.bin"))
+    expected = expected_postings(documents)
+    assert reader.num_docs == len(documents)
+    assert list(reader.doc_ids) == [f"doc{ordinal}" for ordinal in range(len(documents))]
+    assert list(reader.doc_lengths) == [sum(map(len, field_terms)) for field_terms in documents]
+    assert list(reader.field_lengths) == [len(terms) for field_terms in documents for terms in field_terms]
+    assert reader.fields == FIELDS and reader.has_positions
+    assert list(reader.terms) == sorted(expected)
+    assert max(reader.df(term) for term in expected) > 128  # Several blocks
+
+    for term, term_postings in expected.items():
+        assert reader.df(term) == len(term_postings)
+        assert reader.postings(term) == tuple((ordinal, tf) for ordinal, tf, _, _ in term_postings)
+        assert reader.positions(term) == tuple(positions for _, _, positions, _ in term_postings)
+        assert reader.field_tfs(term) == tuple(field_tfs for _, _, _, field_tfs in term_postings)
+        assert walk(reader.cursor(term)) == list(reader.postings(term))
+
+    assert "missing" not in reader
+    assert reader.df("missing") == 0 and reader.postings("missing") == ()
+    assert walk(reader.cursor("missing")) == []
+
+# Cursors skipping ahead land on the first posting at or after the target
+def test_cursor_advance(tmp_path):
+    documents = random_fields(600, seed=1)
+    builder = IndexBuilder(temp_dir=str(tmp_path))
+    for ordinal, field_terms in enumerate(documents):
+        builder.add_terms(f"doc{ordinal}", [term for terms in field_terms for term in terms])
+    builder.write(str(tmp_path / "test.index.bin"))
+    reader = IndexReader(str(tmp_path / "test.index.bin"))
+
+    rng = random.Random(1)
+    for term in VOCABULARY[:10]:
+        docs = [doc for doc, _ in reader.postings(term)]
+        cursor = reader.cursor(term)
+        target = 0
+        while True:
+            target += rng.randint(1, 40)
+            cursor.advance(target)
+            i = bisect_left(docs, target)
+            if i == len(docs):
+                assert cursor.doc == PostingsCursor.END
+                break
+            assert cursor.doc == docs[i]
+
+# Image surrogates for documents given by field; `version` changes their text
+def surrogates(documents, start=0, version=0):
+    return [{"image_url": f"https://example.org/{start + i}.jpg", "title": " ".join(field_terms[0]),
+             "alt_text": " ".join(field_terms[1]), "animal_name": " ".join(field_terms[3]),
+             "source_page": f"https://example.org/page{(start + i) % 97}", "version": version}
+            for i, field_terms in enumerate(documents)]
+
+# An index of three segments with tombstones: a rebuild, then added and changed
+# images, then deleted ones
+@pytest.fixture(scope="module")
+def corpus(tmp_path_factory):
+    directory = str(tmp_path_factory.mktemp("index"))
+    documents = random_fields(700, seed=2)
+    writer = SegmentWriter(directory)
+    writer.rebuild(surrogates(documents[:500]), documents[:500], positional=True, fields=FIELDS)
+    writer.add_documents(surrogates(documents[500:], 500), documents[500:])
+    changed = random_fields(60, seed=3)
+    writer.add_documents(surrogates(changed, 100, version=1), changed)
+    writer.delete_documents([f"https://example.org/{i}.jpg" for i in range(0, 700, 17)])
+    return SegmentedIndex(directory)
+
+# Random queries of the index's terms, some repeating a term
+def random_queries(corpus, n=40, seed=4):
+    rng = random.Random(seed)
+    terms = [term for term in VOCABULARY if term in corpus]
+    return [rng.choices(terms, k=rng.randint(1, 4)) for _ in range(n)]
+
+# Every live document scored term-at-a-time, best first, ties in the order the
+# terms first met the documents, as top-k retrieval returns them
+def exhaustive_top_k(corpus, terms, k, term_score):
+    scores = {}
+    first = {}
+    for j, term in enumerate(terms):
+        for doc, tf in corpus.postings(term):
+            scores[doc] = scores.get(doc, 0) + term_score(j, doc, tf)
+            first.setdefault(doc, j)
+    ranked = sorted(scores.items(), key=lambda match: (-match[1], first[match[0]], match[0]))
+    return ranked[:k]
+
+def assert_same_ranking(found, expected):
+    assert [doc for doc, _ in found] == [doc for doc, _ in expected]
+    assert [score for _, score in found] == pytest.approx([score for _, score in expected])
+
+# A BM25-like term score of a query's terms and its bound over a block, from the
+# index statistics alone
+def bm25_like(corpus, terms):
+    weights = [1 + math.log(corpus.num_docs / corpus.df(term)) for term in terms]
+
+    def score(j, doc, tf):
+        return weights[j] * tf / (tf + 0.5 + corpus.doc_lengths[doc] / corpus.avg_doc_length)
+
+    def bound(j, block):
+        max_tf, min_length, _ = block
+        return weights[j] * max_tf / (max_tf + 0.5 + min_length / corpus.avg_doc_length)
+    return score, bound
+
+def top_k(corpus, terms, k):
+    num_positions = len(corpus.doc_lengths) + 1
+    score, bound = bm25_like(corpus, terms)
+    cursors = [corpus.cursor(term) for term in terms]
+    return max_score_top_k(cursors, k, score, bound, lambda doc, first: first * num_positions + doc)
+
+# MaxScore with block-max bounds returns the top k of scoring every document, over
+# segments with tombstones
+@pytest.mark.parametrize("k", [1, 5, 20, 1000])
+def test_max_score_top_k_matches_exhaustive(corpus, k):
+    for terms in random_queries(corpus):
+        score, _ = bm25_like(corpus, terms)
+        assert_same_ranking(top_k(corpus, terms, k), exhaustive_top_k(corpus, terms, k, score))
+
+# Applying crawl deltas, and merging the segments, indexes the images a rebuild
+# from the final crawl would. Positions differ, so rankings may differ among
+# documents tied with the last one kept.
+@pytest.mark.parametrize("merge", [False, True])
+def test_deltas_match_rebuild(tmp_path, merge):
+    documents = random_fields(600, seed=5)
+    images = surrogates(documents[:400])
+    fields_of = {image["image_url"]: field_terms for image, field_terms in zip(images, documents)}
+    final = {image["image_url"]: image for image in images}
+    writer = SegmentWriter(str(tmp_path / "incremental"))
+    writer.rebuild(images, documents[:400], positional=True, fields=FIELDS)
+    for batch in range(2):
+        start = 400 + 100 * batch
+        added = surrogates(documents[start:start + 100], start)
+        changed_fields = random_fields(30, seed=6 + batch)
+        changed = surrogates(changed_fields, 10 + 50 * batch, version=batch + 1)
+        removed = [f"https://example.org/{i}.jpg" for i in range(200 + batch, 400, 13)]
+        fields_of.update((image["image_url"], field_terms) for image, field_terms in zip(added, documents[start:]))
+        fields_of.update((image["image_url"], field_terms) for image, field_terms in zip(changed, changed_fields))
+        writer.apply_delta({"added": added, "changed": changed, "removed": removed},
+                           lambda items: [fields_of[item["image_url"]] for item in items])
+        final.update((image["image_url"], image) for image in added + changed)
+        for url in removed:
+            final.pop(url, None)
+    if merge:
+        writer.merge()
+    incremental = SegmentedIndex(str(tmp_path / "incremental"))
+    assert len(incremental.segments) == (1 if merge else 3)
+
+    images = list(final.values())
+    SegmentWriter(str(tmp_path / "rebuilt")).rebuild(images, [fields_of[image["image_url"]] for image in images],
+                                                     positional=True, fields=FIELDS)
+    rebuilt = SegmentedIndex(str(tmp_path / "rebuilt"))
+
+    assert incremental.num_docs == rebuilt.num_docs == len(final)
+    assert incremental.avg_doc_length == pytest.approx(rebuilt.avg_doc_length)
+    assert incremental.avg_field_lengths == pytest.approx(rebuilt.avg_field_lengths)
+    assert [incremental.df(term) for term in VOCABULARY] == [rebuilt.df(term) for term in VOCABULARY]
+    for terms in random_queries(rebuilt, seed=7):
+        for k in (5, 20):
+            found = [(incremental[doc]["image_url"], score) for doc, score in top_k(incremental, terms, k)]
+            expected = [(rebuilt[doc]["image_url"], score) for doc, score in top_k(rebuilt, terms, k)]
+            assert [score for _, score in found] == pytest.approx([score for _, score in expected])
+            if expected:
+                last = expected[-1][1]
+                assert ({url for url, score in found if score > last + 1e-9} ==
+                        {url for url, score in expected if score > last + 1e-9})
+
+# JPEG bytes of a random picture: blocks of random grey levels, scaled up
+def random_jpeg(rng):
+    pixels = rng.integers(0, 256, (6, 8), dtype=np.uint8).repeat(20, axis=0).repeat(20, axis=1)
+    output = BytesIO()
+    Image.fromarray(pixels).save(output, "JPEG")
+    return output.getvalue()
+
+def image_url(name, width=None):
+    if width:
+        return f"https://upload.wikimedia.org/wikipedia/commons/thumb/a/ab/{name}.jpg/{width}px-{name}.jpg"
+    return f"https://upload.wikimedia.org/wikipedia/commons/{name}.jpg"
+
+# A crawl delta's copies of indexed images are left out of the index and of the
+# IVF index, whichever test finds them, and its other images are added to both
+def test_delta_drops_near_duplicates(tmp_path):
+    rng = np.random.default_rng(8)
+    cache = ImageCache(str(tmp_path / "cache"))
+    urls = [image_url(f"Animal_{i}", 220) for i in range(40)]
+    contents = [random_jpeg(rng) for _ in urls]
+    for url, content in zip(urls[:31] + urls[32:], contents[:31] + contents[32:]):
+        cache.put(url, content)
+    vectors = rng.standard_normal((40, 16))
+
+    def surrogate(url):
+        return {"image_url": url, "title": "Animal", "alt_text": "An animal", "animal_name": "Animal",
+                "source_page": "https://en.wikipedia.org/wiki/Animal"}
+
+    kept, report = deduplicate([surrogate(url) for url in urls[:30]], cache)
+    assert report["kept"] == 30
+    directory = str(tmp_path / "index")
+    SegmentWriter(directory).rebuild(kept, [["animal"]] * 30)
+
+    # Another width of image 0, the bytes of image 1 at another URL, the embedding of
+    # image 2 for image 31 (which is not cached, so has no hash to disagree), and
+    # another width of image 32 within the delta
+    added = [image_url("Animal_0", 440), image_url("Photo_1"), urls[31], urls[32], image_url("Animal_32", 440),
+             urls[33]]
+    cache.put(added[1], contents[1])
+    vectors[31] = vectors[2] + 0.01 * rng.standard_normal(16)
+    embedded = urls + [added[1]]
+    write_embedding_store(str(tmp_path / "embeddings"), embedded, np.vstack([vectors, vectors[1]]))
+    embeddings = EmbeddingStore(str(tmp_path / "embeddings"))
+    build_ivf_file(str(tmp_path / "embeddings"), n_lists=4, keep=indexed_urls(directory))
+
+    delta = {"added": [surrogate(url) for url in added], "changed": [], "removed": [urls[5]]}
+    delta, report = deduplicate_delta(delta, indexed_urls(directory), cache, embeddings)
+    assert [image["image_url"] for image in delta["added"]] == [urls[32], urls[33]]
+    assert sorted(delta["removed"]) == sorted([urls[5]] + added[:3] + added[4:5])
+    assert report["found"] == {"same file": 2, "perceptual hash": 1, "CLIP embedding": 1}
+
+    writer = SegmentWriter(directory)
+    writer.apply_delta(delta, lambda items: [["animal"]] * len(items))
+    expected = set(urls[:5] + urls[6:30] + urls[32:34])
+    assert indexed_urls(directory) == expected
+    ivf = update_ivf_file(str(tmp_path / "embeddings"), keep=indexed_urls(directory))
+    assert sorted(ivf.list_rows) == sorted(embeddings.row(url) for url in expected)
+    reopened = IVFIndex.open(str(tmp_path / "embeddings.ivf"), embeddings.vectors)
+    assert sorted(reopened.list_rows) == sorted(ivf.list_rows)
+
+# An IVF index over no embeddings finds nothing, and is trained once there are some
+def test_ivf_over_no_images(tmp_path):
+    prefix = str(tmp_path / "embeddings")
+    vectors = np.random.default_rng(9).standard_normal((50, 16))
+    urls = [image_url(f"Animal_{i}") for i in range(50)]
+    write_embedding_store(prefix, [], np.zeros((0, 16)))
+    assert len(build_ivf_file(prefix).search(vectors[0], 5)[0]) == 0
+    write_embedding_store(prefix, urls, vectors)
+    for ivf in (build_ivf_file(prefix, keep=set()), update_ivf_file(prefix, keep={"https://example.org/missing.jpg"})):
+        rows, scores = ivf.search(vectors[0], 5)
+        assert len(rows) == len(scores) == 0
+    assert len(IVFIndex.open(prefix + ".ivf", EmbeddingStore(prefix).vectors).search(vectors[0], 5)[0]) == 0
+    ivf = update_ivf_file(prefix, keep=set(urls))
+    assert len(ivf.centroids) > 0 and sorted(ivf.list_rows) == list(range(50))
+
+# Caches opened on one directory, as by the crawler and embedder, evict by their
+# combined size, least recently used first
+def test_shared_cache_eviction(tmp_path):
+    rng = np.random.default_rng(10)
+    contents = [rng.bytes(1000) for _ in range(6)]
+    first = ImageCache(str(tmp_path / "cache"), max_bytes=3500)
+    second = ImageCache(str(tmp_path / "cache"), max_bytes=3500)
+    for i, content in enumerate(contents[:3]):
+        first.put(image_url(f"Animal_{i}"), content)
+    for i, content in enumerate(contents[3:], 3):
+        second.put(image_url(f"Animal_{i}"), content)
+    assert first.total_bytes() == second.total_bytes() <= 3500
+    assert [first.get(image_url(f"Animal_{i}")) for i in range(6)] == [None] * 3 + contents[3:]
+
+# app.py, imported from its directory, or the test is skipped
+@pytest.fixture(scope="module")
+def app():
+    pytest.importorskip("torch")
+    pytest.importorskip("clip")
+    directory = os.path.dirname(os.path.abspath(__file__))
+    if not os.path.exists(os.path.join(directory, "image_embeddings.npy")):
+        pytest.skip("app.py needs image_embeddings.npy; run embed_images.py")
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        return importlib.import_module("app")
+    finally:
+        os.chdir(cwd)
+
+# The app's stores, with the test index in place of its own
+@pytest.fixture(scope="module")
+def stores(app, corpus):
+    return app.Stores(corpus, Analyzer(), None, None, len(corpus), corpus.avg_doc_length,
+                      [length or 1 for length in corpus.avg_field_lengths], [0.5, 1.0, 2.0, 4.0])
+
+@pytest.mark.parametrize("k", [1, 5, 20, 1000])
+def test_bm25_top_k_matches_exhaustive(app, stores, corpus, k):
+    for terms in random_queries(corpus):
+        idf_scores = [app.compute_idf(stores, term) for term in terms]
+
+        def term_score(j, doc, tf):
+            return app.bm25_term_score(idf_scores[j], tf, corpus.doc_lengths[doc], stores.avg_doc_length, 1.2, 0.75)
+
+        found = app.bm25_top_k(stores, terms, k, 1.2, 0.75)
+        assert_same_ranking(found, exhaustive_top_k(corpus, terms, k, term_score))
+
+@pytest.mark.parametrize("k", [1, 5, 20, 1000])
+def test_bm25f_top_k_matches_exhaustive(app, stores, corpus, k):
+    for terms in random_queries(corpus):
+        idf_scores = [app.compute_idf(stores, term) for term in terms]
+        field_tfs = [corpus.field_tfs(term) for term in terms]
+
+        def term_score(j, doc, tf):
+            return app.bm25f_term_score(idf_scores[j], field_tfs[j][doc], corpus.field_lengths[doc],
+                                        stores.avg_field_lengths, stores.field_weights, 1.2, 0.75)
+
+        found = app.bm25f_top_k(stores, terms, k, 1.2, 0.75)
+        assert_same_ranking(found, exhaustive_top_k(corpus, terms, k, term_score))
@@ -0,0 +1,24 @@
+import os
+import pytest
+
+# Both assignments run from their own directory, so the modules they share are
+# copied into each rather than imported from a package. This fails as soon as a
+# copy is edited without the other:
+#
+#   python -m pytest test_shared_modules.py
+
+SHARED_MODULES = ["analyzer.py", "binary_index.py", "index_builder.py", "ir_eval.py", "pruning.py", "tuning.py"]
+
+DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+OTHER_DIRECTORY = os.path.join(os.path.dirname(DIRECTORY), "Search Engine Assignment 1")
+
+def read(directory, name):
+    with open(os.path.join(directory, name), "rb") as f:
+        return f.read()
+
+@pytest.mark.parametrize("name", SHARED_MODULES)
+def test_shared_module_copies(name):
+    if not os.path.isdir(OTHER_DIRECTORY):
+        pytest.skip("Assignment 1 isn't checked out next to Assignment 2")
+    assert read(DIRECTORY, name) == read(OTHER_DIRECTORY, name), \
+        f"{name} differs between the assignments; copy the edited one over the other"
@@ -0,0 +1,163 @@
+import argparse
+import json
+import time
+import numpy as np
+import app
+import tuning
+
+# Tuning k1 and b of the app's BM25, or k1, b and the field weights of its BM25F,
+# against ground_truth_filtered.json
+#
+# BM25 picks the candidates that CLIP re-ranks, so it is tuned on its own ranking,
+# cut at the number of candidates it hands on. The term statistics of every query
+# are read from the index once (tf and length of each matching document, in each
+# field too, df and IDF of each term), and every setting is then scored for all
+# queries at once with the app's bm25_term_score or bm25f_term_score, adding up
+# terms in query order, so rankings are exactly those of bm25_top_k or bm25f_top_k,
+# ties included.
+#
+#   python tune_params.py --metric map
+#   python tune_params.py --model bm25f --metric map
+#
+# writes the best setting of every measure to ranking_params.json; the app uses the
+# one for --metric.
+
+K1_VALUES = [0.4, 0.8, 1.2, 1.6, 2.0, 2.4, 2.8, 3.2]
+B_VALUES = [0.0, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0]
+K_VALUES = (5, 10)
+METRICS = ("map", "ndcg_cut_5", "P_5", "recall_5", "recip_rank")
+# BM25F has a weight per field as well, so its grid is coarser
+BM25F_K1_VALUES = [0.8, 1.6, 2.4, 3.2]
+BM25F_B_VALUES = [0.0, 0.3, 0.6, 0.9]
+FIELD_WEIGHT_VALUES = [0.5, 1.0, 2.0, 4.0]
+# Valid values of each parameter; the search may go past the grid within them
+K1_DOMAIN = (0.01, None)
+B_DOMAIN = (0.0, 1.0)
+FIELD_WEIGHT_DOMAIN = (0.01, None)
+
+# The index and statistics the app opened when it was imported
+stores = app.stores
+
+# A segment_index.SegmentArray as one flat array, by position then value
+def positional_array(values):
+    return np.concatenate([np.asarray(part, dtype=np.float64) for part in values.parts])
+
+# Term statistics of every query, as flat arrays, one entry per matching (query term, document)
+def query_statistics(queries):
+    rows, positions, docs, tfs, idfs, dfs, field_tfs = [], [], [], [], [], [], []
+    num_fields = len(stores.corpus.fields)
+    for row, query_terms in enumerate(stores.analyzer.analyze_many(queries)):
+        terms = [term for term in query_terms if term in stores.corpus]
+        for position, term in enumerate(terms):
+            postings = stores.corpus.postings(term)
+            rows.extend([row] * len(postings))
+            positions.extend([position] * len(postings))
+            docs.extend(doc for doc, _ in postings)
+            tfs.extend(tf for _, tf in postings)
+            idfs.extend([app.compute_idf(stores, term)] * len(postings))
+            dfs.extend([stores.corpus.df(term)] * len(postings))
+            if num_fields:
+                term_field_tfs = stores.corpus.field_tfs(term)
+                field_tfs.extend(term_field_tfs[doc] for doc, _ in postings)
+    docs = np.array(docs, dtype=np.int64)
+    field_lengths = positional_array(stores.corpus.field_lengths).reshape(-1, num_fields) if num_fields else None
+    return {
+        "rows": np.array(rows, dtype=np.int64),
+        "positions": np.array(positions, dtype=np.int64),
+        "docs": docs,
+        "tf": np.array(tfs, dtype=np.float64),
+        "length": positional_array(stores.corpus.doc_lengths)[docs],
+        "idf": np.array(idfs),
+        "df": np.array(dfs, dtype=np.int64),
+        # Entries by field, for BM25F
+        "field_tf": np.array(field_tfs, dtype=np.float64).reshape(-1, num_fields).T if num_fields else None,
+        "field_length": field_lengths[docs].T if num_fields else None,
+    }
+
+class ScoreTuner:
+    def __init__(self, stats, num_queries, num_docs):
+        self.stats = stats
+        self.shape = (num_queries, num_docs)
+        positions = stats["positions"]
+        self.by_position = [np.flatnonzero(positions == position) for position in range(positions.max() + 1 if len(positions) else 0)]
+
+        # bm25_top_k breaks ties by the first query term a document contains, then by position
+        first = np.full(self.shape, np.iinfo(np.int64).max)
+        np.minimum.at(first, (stats["rows"], stats["docs"]), positions)
+        self.tie_rank = first * (num_docs + 1) + np.arange(num_docs)
+        self.matched = first != np.iinfo(np.int64).max
+
+    def bm25(self, k1, b):
+        stats = self.stats
+        return self.scores(app.bm25_term_score(stats["idf"], stats["tf"], stats["length"], stores.avg_doc_length, k1, b))
+
+    def bm25f(self, k1, b, weights):
+        stats = self.stats
+        return self.scores(app.bm25f_term_score(stats["idf"], stats["field_tf"], stats["field_length"],
+                                                stores.avg_field_lengths, weights, k1, b))
+
+    # Scores of the matching documents, summing the scores of their entries, and -inf for the others
+    def scores(self, entry_scores):
+        stats = self.stats
+        scores = np.zeros(self.shape)
+        for entries in self.by_position:
+            term_scores = np.zeros(self.shape)
+            term_scores[stats["rows"][entries], stats["docs"][entries]] = entry_scores[entries]
+            scores += term_scores
+        scores[~self.matched] = -np.inf
+        return scores
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tune BM25 or BM25F parameters against the ground truth")
+    parser.add_argument("--model", default="bm25", choices=("bm25", "bm25f"))
+    parser.add_argument("--queries", default="queries.txt")
+    parser.add_argument("--ground-truth", default="ground_truth_filtered.json")
+    parser.add_argument("--k1", type=float, nargs="+")
+    parser.add_argument("--b", type=float, nargs="+")
+    parser.add_argument("--weights", type=float, nargs="+", default=FIELD_WEIGHT_VALUES, help="Field weights tried for BM25F")
+    parser.add_argument("--depth", type=int, default=app.BM25_CANDIDATES, help="Rank cut-off of the BM25 ranking")
+    parser.add_argument("--rounds", type=int, default=2, help="Rounds of finer grids around the best settings")
+    parser.add_argument("--metric", default="map", choices=METRICS, help="Measure the saved parameters are chosen for")
+    parser.add_argument("--output", default=tuning.PARAMS_FILE)
+    args = parser.parse_args()
+    if args.model == "bm25f" and not stores.corpus.fields:
+        parser.error("the index has no field statistics; rebuild it with python indexer.py")
+
+    with open(args.queries, "r", encoding="utf-8") as f:
+        queries = [q.strip() for q in f if q.strip()]
+    with open(args.ground_truth, "r", encoding="utf-8") as f:
+        ground_truth = json.load(f)
+    # Every image in a query's ground truth counts as relevant, as in evaluate.py
+    qrels = {query: {url: 1 for url in ground_truth[query]} for query in queries if query in ground_truth}
+    query_ids = sorted(qrels)
+
+    start = time.perf_counter()
+    num_docs = len(stores.corpus.doc_lengths)
+    tuner = ScoreTuner(query_statistics(query_ids), len(query_ids), num_docs)
+    judged, ideal, num_rel = tuning.judgements(qrels, query_ids, num_docs, stores.corpus.find_url)
+    print(f"Statistics of {len(query_ids)} queries in {time.perf_counter() - start:.2f}s")
+
+    domains = {"k1": K1_DOMAIN, "b": B_DOMAIN}
+    if args.model == "bm25":
+        grid = {"k1": args.k1 or K1_VALUES, "b": args.b or B_VALUES}
+
+        def evaluate_setting(k1, b):
+            return tuning.evaluate_scores(tuner.bm25(k1, b), tuner.tie_rank, judged, ideal, num_rel, K_VALUES, args.depth)
+    else:
+        fields = stores.corpus.fields
+        grid = {"k1": args.k1 or BM25F_K1_VALUES, "b": args.b or BM25F_B_VALUES}
+        grid.update((field, args.weights) for field in fields)
+        domains.update((field, FIELD_WEIGHT_DOMAIN) for field in fields)
+
+        def evaluate_setting(k1, b, **weights):
+            scores = tuner.bm25f(k1, b, [weights[field] for field in fields])
+            return tuning.evaluate_scores(scores, tuner.tie_rank, judged, ideal, num_rel, K_VALUES, args.depth)
+
+    start = time.perf_counter()
+    results, best = tuning.search(evaluate_setting, grid, METRICS, args.rounds, domains)
+    elapsed = time.perf_counter() - start
+    print(f"{len(results)} settings in {elapsed:.2f}s ({elapsed * 1000 / len(results):.1f} ms each)")
+    for metric, setting in best.items():
+        print(f"  best {metric:<12} {results[setting][metric]:.4f}  " + ", ".join(f"{name}={value:g}" for name, value in zip(grid, setting)))
+    tuning.save_params(args.model, list(grid), results, best, args.metric, args.output)
+    print(f"Saved the best {args.metric} setting to {args.output}")